@@ -1,17 +1,90 @@
 #!/usr/bin/env python3
 
 import argparse
+import copy
+import csv
+import fcntl
+import fnmatch
+import gzip
+import hashlib
+import io
+import ipaddress
+import itertools
 import json
+import multiprocessing
+import multiprocessing.connection
+import socket
+import shutil
+import socketserver
 import subprocess
+import tarfile
 import os
-import wget
-from threading import Thread, Event
+import platform
+import re
+import shlex
+import signal
+import struct
+import tempfile
+from threading import Thread, Event, Condition, current_thread, main_thread
 import time
-from urllib.parse import urlparse
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 import sys as _sys
 
+# errors and the library API, DeployEngine is also importable from dcs_deploy
+from dcs_engine import (
+    DcsDeployError, UsageError, ConfigError, DependencyError, DownloadError, CommandError, DiskSpaceError, StepError,
+    ConfigSelection, DeployOptions, DeployResult, DeployEngine
+)
+
 dcs_deploy_version = "3.0.0"
 
+PARALLEL_EXTRACT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'parallel_extract.py')
+PARALLEL_COPY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'parallel_copy.py')
+DELTA_TOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local', 'overlays', 'hardware_support_layer',
+                               'resources', 'libs', 'dcs_delta', 'dcs_delta.py')
+OVERLAY_LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local', 'overlays', 'lib')
+# downloaded resources of config_db entry
+RESOURCE_KEYS = ["rootfs", "l4t", "nvidia_overlay", "airvolute_overlay", "nv_ota_tools"]
+
+
+class DeployArgumentParser(argparse.ArgumentParser):
+    """
+    ArgumentParser raising UsageError instead of exiting the process.
+    """
+    def exit(self, status=0, message=None):
+        raise UsageError((message or "").rstrip("\n"), status)
+
+    def error(self, message):
+        # usage is printed by UsageError.report, library callers get it in the error
+        self.exit(2, "%s%s: error: %s" % (self.format_usage(), self.prog, message))
+
+
+# Values of options below end up in sudo command lines and paths, they are checked when parsed
+# (also for jobs submitted to the serve mode) and quoted when used.
+USB_INSTANCE_PATTERN = re.compile(r"^[0-9]+-[0-9]+(\.[0-9]+)*$")
+UNIT_SERIAL_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+def usb_instance_arg(value:str) -> str:
+    if USB_INSTANCE_PATTERN.match(value) is None:
+        raise argparse.ArgumentTypeError("invalid USB instance '%s', expected port path like 1-4 or 1-2.3" % value)
+    return value
+
+
+def app_size_arg(value:str) -> str:
+    if not value.isdigit() or int(value) == 0:
+        raise argparse.ArgumentTypeError("invalid APP partition size '%s', expected whole number of GB" % value)
+    return value
+
+
+def unit_serial_arg(value:str) -> str:
+    if UNIT_SERIAL_PATTERN.match(value) is None:
+        raise argparse.ArgumentTypeError("invalid unit serial '%s', allowed are letters, digits, '.', '_' and '-'" % value)
+    return value
+
 
 # example: retcode = cmd_exec("sudo tar xpf %s --directory %s" % (self.rootfs_file_path, self.rootfs_extract_dir))
 def cmd_exec(command_line:str, print_command = False) -> int:
@@ -20,9 +93,7 @@ def cmd_exec(command_line:str, print_command = False) -> int:
     try:
         return subprocess.call(command_line, shell=True)
     except Exception as e:
-        print("Command %s execution failed!!. Error %s" % (command_line, str(e)))
-        print("Exitting!")
-        exit(5)
+        raise CommandError("Command %s execution failed!!. Error %s" % (command_line, str(e)))
 
 def check_and_create_symlink(link_path, target_path):
     """
@@ -54,11 +125,386 @@ def check_and_create_symlink(link_path, target_path):
         print(f"Failed to create symlink: {link_path} -> {target_path}")
     return create_ret
 
-def extract(source_file_path:str, destination_path:str) -> int:
-    if "tbz2" in source_file_path or "tar.bz2" in source_file_path:
-        return cmd_exec("sudo tar xpf " + source_file_path + " --directory " + destination_path + " -I lbzip2")
+def extract(source_file_path:str, destination_path:str, stream_size:int = None, exclude_file:str = None,
+            jobs:int = None, index = None) -> int:
+    """
+    Extract tar archive. When uncompressed size of the archive (stream_size) is known, progress is reported.
+    Members listed in exclude_file (exact names) are not extracted.
+    With jobs, files are written by resources/parallel_extract.py with jobs writer threads instead of tar.
+    With index (ArchiveIndex which is not built yet), the index is built from the extracted stream.
+    """
+    source = "-" if index is not None else source_file_path
+    if jobs:
+        command = f"sudo python3 {PARALLEL_EXTRACT_PATH} -j {jobs} -C {destination_path} {source}"
+        if exclude_file is not None:
+            command += " --exclude-from " + exclude_file
+        if stream_size:
+            command += " --stream-size %d" % stream_size
+        if index is not None:
+            return index.extract_and_build(source_file_path, command)
+        return cmd_exec(command)
+
+    command = "sudo tar xpf " + source + " --directory " + destination_path
+    if index is None and ("tbz2" in source_file_path or "tar.bz2" in source_file_path):
+        command += " -I lbzip2"
+    elif index is None and source_file_path.endswith(".zst"):
+        command += " -I zstd"
+    if exclude_file is not None:
+        command += " --anchored --no-wildcards --exclude-from=" + exclude_file
+    if index is not None:
+        return index.extract_and_build(source_file_path, command)
+    if not stream_size:
+        return cmd_exec(command)
+
+    # tar record has 10 KiB, report progress approximately each 0.5%
+    checkpoint = max(1, stream_size // 10240 // 200)
+    command += " --checkpoint=%d --checkpoint-action=echo=%%u" % checkpoint
+    try:
+        process = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE, text=True)
+    except Exception as e:
+        raise CommandError("Command %s execution failed!!. Error %s" % (command, str(e)))
+    for line in process.stderr:
+        value = line.strip().split(" ")[-1]
+        if line.startswith("tar: ") and value.isdigit():
+            done = min(int(value) * 10240, stream_size)
+            print("\r %3d%% (%s / %s)" % (done * 100 // stream_size, format_size(done), format_size(stream_size)), end="")
+        else:
+            print(line, end="")
+    print()
+    return process.wait()
+
+def download_file(url:str, dst_path:str, rate_limit:int = None, before_chunk = None, mirrors:list = None,
+                  sha256:str = None) -> int:
+    """
+    Download url into dst_path through temporary file, so partially downloaded file is never used.
+    rate_limit - bandwidth cap in bytes per second.
+    before_chunk - called before each chunk, returns True when it paused the download (eg. waiting for time window),
+                   raises DownloadPaused to stop the download (download_file returns MirrorDownload.PAUSED).
+    mirrors - other URLs of the same file, the fastest one is used and others are used on failure (see MirrorDownload).
+    sha256 - expected checksum of the file.
+    """
+    return MirrorDownload([url] + (mirrors or []), dst_path, sha256, rate_limit, before_chunk).run()
+
+def remove_partial_download(dst_path:str):
+    """
+    Remove partial file of interrupted download of dst_path. Only the download's own file is removed,
+    temporary sidecar files (.meta.json.<pid>.tmp, ...) belong to other running processes.
+    """
+    try:
+        os.remove(dst_path + MirrorDownload.PARTIAL_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+def load_download_metadata(dst_path:str):
+    """
+    Load HTTP validators (ETag, Last-Modified, Content-Length) stored next to downloaded file.
+    """
+    try:
+        with open(dst_path + ".meta.json") as metadata_file:
+            return json.load(metadata_file)
+    except (OSError, ValueError):
+        return None
+
+def save_download_metadata(dst_path:str, url:str, headers, sha256:str = None, mirror:str = None):
+    metadata = {
+        "url": url,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "content_length": headers.get("Content-Length"),
+        "checked": time.time(),
+        "sha256": sha256,
+        "mirror": mirror,
+    }
+    tmp_path = dst_path + ".meta.json.%d.tmp" % os.getpid()
+    with open(tmp_path, "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=4)
+    os.replace(tmp_path, dst_path + ".meta.json")
+
+def is_download_changed(url:str, dst_path:str, sha256:str = None) -> bool:
+    """
+    Check whether upstream file changed since it was downloaded. Conditional HEAD request is used
+    with stored validators. Without validators, Content-Length is compared with the downloaded file.
+    When expected sha256 of the file is known, it is compared with the downloaded file instead.
+    """
+    metadata = load_download_metadata(dst_path)
+    if metadata is not None and metadata.get("url") != url:
+        metadata = None
+    if sha256 is not None:
+        if metadata is None or metadata.get("sha256") is None:
+            metadata = metadata or {}
+            headers = {"ETag": metadata.get("etag"), "Last-Modified": metadata.get("last_modified"),
+                       "Content-Length": metadata.get("content_length")}
+            metadata["sha256"] = file_sha256(dst_path)
+            save_download_metadata(dst_path, url, headers, sha256=metadata["sha256"], mirror=metadata.get("mirror"))
+        return metadata["sha256"] != sha256.lower()
+    headers = {"User-Agent": "dcs_deploy/" + dcs_deploy_version}
+    if metadata is not None:
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+    request = urllib.request.Request(url, headers=headers, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            remote = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise
+
+    content_length = remote.get("Content-Length")
+    size_changed = content_length is None or int(content_length) != os.path.getsize(dst_path)
+    if metadata is not None and metadata.get("etag") and remote.get("ETag"):
+        changed = remote.get("ETag") != metadata["etag"]
+    elif metadata is not None and metadata.get("last_modified") and remote.get("Last-Modified"):
+        changed = remote.get("Last-Modified") != metadata["last_modified"]
     else:
-        return cmd_exec("sudo tar xpf " + source_file_path + " --directory " + destination_path)
+        changed = size_changed
+    if not changed:
+        # remember current validators, eg. for files downloaded by older dcs_deploy
+        save_download_metadata(dst_path, url, remote, sha256=metadata.get("sha256") if metadata is not None else None)
+    return changed
+
+def file_sha256(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as source_file:
+        for block in iter(lambda: source_file.read(4 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_source_stat(path:str) -> dict:
+    """
+    Size and modification time of file, data cached next to the file (index, hash) is valid only for the same source.
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+class DownloadPaused(Exception):
+    """
+    Raised by before_chunk callback of MirrorDownload to stop the download, the partial file is kept
+    and the download can be resumed by MirrorDownload.run(resume=True).
+    """
+
+
+class MirrorDownload:
+    """
+    Download of one file which is available on more mirrors (eg. upstream server, regional server
+    and LAN cache). Mirrors are probed with a small ranged request and the fastest one is used.
+    When the transfer fails, it continues from the next mirror at the same offset (HTTP Range).
+    Downloaded file is verified against expected sha256 when it is known.
+    """
+    PROBE_SIZE = 1024 * 1024
+    PROBE_TIMEOUT = 10
+    # size used to rank mirrors when the probe did not return size of the file
+    DEFAULT_SIZE = 1024 ** 3
+    CHUNK_SIZE = 256 * 1024
+    # file is downloaded only by holder of the resource lock, so the partial file does not need unique name
+    PARTIAL_SUFFIX = ".tmp"
+    # run() result when before_chunk paused the download
+    PAUSED = 1
+
+    def __init__(self, urls:list, dst_path:str, sha256:str = None, rate_limit:int = None, before_chunk = None):
+        self.urls = list(dict.fromkeys(urls))
+        self.dst_path = dst_path
+        self.sha256 = sha256.lower() if sha256 else None
+        self.rate_limit = rate_limit
+        self.before_chunk = before_chunk
+        self.tmp_path = dst_path + MirrorDownload.PARTIAL_SUFFIX
+        self.done = 0
+        self.total = None
+        # validator (ETag or Last-Modified) of the response the partial file started with, used in If-Range
+        self.validator = None
+        self.validator_url = None
+        self.headers = None
+
+    @staticmethod
+    def get_total_size(response) -> int:
+        content_range = response.headers.get("Content-Range")
+        if content_range is not None and "/" in content_range and not content_range.endswith("/*"):
+            return int(content_range.split("/")[-1])
+        if response.status == 200 and response.headers.get("Content-Length"):
+            return int(response.headers["Content-Length"])
+        return None
+
+    @staticmethod
+    def probe(url:str) -> dict:
+        """
+        Measure latency (time to response headers) and throughput of mirror.
+        """
+        result = {"url": url, "latency": None, "throughput": None, "size": None, "error": None}
+        request = urllib.request.Request(url, headers={"User-Agent": "dcs_deploy/" + dcs_deploy_version,
+                                                       "Range": "bytes=0-%d" % (MirrorDownload.PROBE_SIZE - 1)})
+        try:
+            start = time.monotonic()
+            with urllib.request.urlopen(request, timeout=MirrorDownload.PROBE_TIMEOUT) as response:
+                result["latency"] = time.monotonic() - start
+                result["size"] = MirrorDownload.get_total_size(response)
+                data = response.read(MirrorDownload.PROBE_SIZE)
+                result["throughput"] = len(data) / max(time.monotonic() - start - result["latency"], 0.001)
+        except Exception as e:
+            result["error"] = str(e)
+        return result
+
+    def rank(self) -> list:
+        """
+        Probe mirrors in parallel, sort them by expected download time. Mirrors which did not
+        answer the probe are kept at the end, they are tried when all others fail.
+        """
+        results = [None] * len(self.urls)
+        def run_probe(i):
+            results[i] = MirrorDownload.probe(self.urls[i])
+        threads = [Thread(target=run_probe, args=(i,)) for i in range(len(self.urls))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        available = [result for result in results if result["error"] is None]
+        size = next((result["size"] for result in available if result["size"]), MirrorDownload.DEFAULT_SIZE)
+        available.sort(key=lambda result: result["latency"] + size / max(result["throughput"], 1))
+        for result in available:
+            print("  mirror %s: latency %d ms, %s/s" % (result["url"], result["latency"] * 1000, format_size(result["throughput"])))
+        for result in results:
+            if result["error"] is not None:
+                print("  mirror %s: not available (%s)" % (result["url"], result["error"]))
+        return [result["url"] for result in available] + [result["url"] for result in results if result["error"] is not None]
+
+    def transfer(self, url:str, dst_file):
+        """
+        Download url into dst_file from current offset. Raises exception on error.
+        """
+        headers = {"User-Agent": "dcs_deploy/" + dcs_deploy_version}
+        if self.done > 0:
+            headers["Range"] = "bytes=%d-" % self.done
+            if self.validator is not None and self.validator_url == url:
+                # file changed since the partial file was started, server sends it whole
+                headers["If-Range"] = self.validator
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=60)
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and self.done > 0 and self.done == self.total:
+                # paused after the last chunk, nothing is left to download
+                return self.headers
+            raise
+        with response:
+            if self.done > 0 and response.status != 206:
+                print("Mirror %s does not support resuming or the file changed, downloading from the beginning." % url)
+                self.done = 0
+                self.total = None
+                self.digest = hashlib.sha256()
+                dst_file.seek(0)
+                dst_file.truncate()
+            if self.done == 0:
+                self.headers = response.headers
+                etag = response.headers.get("ETag")
+                self.validator = etag if etag and not etag.startswith("W/") else response.headers.get("Last-Modified")
+                self.validator_url = url
+            total = MirrorDownload.get_total_size(response)
+            if self.total is not None and total is not None and total != self.total:
+                raise OSError("file size differs from other mirrors (%d != %d)" % (total, self.total))
+            if total is not None:
+                self.total = total
+            rate_start = time.time()
+            rate_done = 0
+            while True:
+                if self.before_chunk is not None and self.before_chunk():
+                    rate_start = time.time()
+                    rate_done = 0
+                chunk = response.read(MirrorDownload.CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst_file.write(chunk)
+                self.digest.update(chunk)
+                self.done += len(chunk)
+                rate_done += len(chunk)
+                if self.rate_limit:
+                    ahead = rate_done / self.rate_limit - (time.time() - rate_start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+                if self.total:
+                    print("\r %3d%% (%s / %s)" % (self.done * 100 // self.total, format_size(self.done), format_size(self.total)), end="")
+            print()
+            if self.total is not None and self.done != self.total:
+                raise OSError("transfer ended at %s of %s" % (format_size(self.done), format_size(self.total)))
+            return response.headers
+
+    def download(self, urls:list, resume = False) -> dict:
+        """
+        Download file starting with the first of urls, on error continue with the next one.
+        Each mirror is tried twice. Returns headers of the last response.
+        With resume, download paused by before_chunk continues from its partial file.
+        """
+        self.digest = hashlib.sha256()
+        if resume and self.done > 0 and os.path.isfile(self.tmp_path) and os.path.getsize(self.tmp_path) == self.done:
+            # partial file could be replaced while the resource lock was not held, hash what is on disk
+            with open(self.tmp_path, "rb") as partial_file:
+                for block in iter(lambda: partial_file.read(4 * 1024 * 1024), b""):
+                    self.digest.update(block)
+            print("Resuming download at %s" % format_size(self.done))
+        else:
+            self.done = 0
+            self.total = None
+            self.validator = None
+        attempts = 2 * len(urls)
+        with open(self.tmp_path, "r+b" if self.done > 0 else "wb") as dst_file:
+            dst_file.seek(self.done)
+            dst_file.truncate()
+            for attempt in range(attempts):
+                url = urls[attempt % len(urls)]
+                try:
+                    headers = self.transfer(url, dst_file)
+                    self.url = url
+                    return headers
+                except DownloadPaused:
+                    raise
+                except Exception as e:
+                    print("\nGot error while downloading %s, Error: %s" % (url, str(e)))
+                    if attempt + 1 < attempts:
+                        print("Continuing from %s at %s" % (urls[(attempt + 1) % len(urls)], format_size(self.done)))
+        raise OSError("all mirrors failed")
+
+    def run(self, resume = False) -> int:
+        """
+        Returns 0 when the file was downloaded, PAUSED when before_chunk paused it (partial file is kept), -1 on error.
+        """
+        urls = self.urls
+        if len(urls) > 1:
+            print("Probing %d mirrors ..." % len(urls))
+            urls = self.rank()
+        # mirror serving corrupted file is skipped by starting from the next one
+        for first in range(len(urls)):
+            try:
+                headers = self.download(urls[first:] + urls[:first], resume and first == 0)
+            except DownloadPaused:
+                print("\nDownload of %s paused at %s." % (self.dst_path, format_size(self.done)))
+                return MirrorDownload.PAUSED
+            except Exception as e:
+                print("Download of %s failed: %s" % (self.dst_path, str(e)))
+                break
+            sha256 = self.digest.hexdigest()
+            if self.sha256 is None or sha256 == self.sha256:
+                os.replace(self.tmp_path, self.dst_path)
+                if self.url != self.urls[0]:
+                    # validators of mirror can not be compared with the primary URL
+                    headers = {"Content-Length": str(self.done)}
+                else:
+                    # Content-Length of resumed (ranged) response is not the size of the file
+                    headers = {"ETag": headers.get("ETag"), "Last-Modified": headers.get("Last-Modified"),
+                               "Content-Length": str(self.done)}
+                save_download_metadata(self.dst_path, self.urls[0], headers, sha256=sha256, mirror=self.url)
+                return 0
+            print("Checksum of downloaded file does not match! expected: %s, got: %s" % (self.sha256, sha256))
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return -1
+
+def format_size(size:int) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f TB" % size
 
 def cmd_exist(name: str) -> bool:
     """Check whether command `name` exist in system"""
@@ -72,7 +518,12 @@ def yes_no_question(question):
     no_choices = ['no', 'n']
 
     while True:
-        user_input = input(question + "([y]es/[N]o): ")
+        try:
+            user_input = input(question + "([y]es/[N]o): ")
+        except EOFError:
+            # non-interactive run (eg. serve mode job), keep default answer
+            print()
+            return False
         if user_input.lower() in yes_choices:
             return True
         elif user_input.lower() in no_choices:
@@ -82,9 +533,1437 @@ def yes_no_question(question):
         else:
             print('Type yes or no')
 
+class FileLock:
+    """
+    Cross-process lock based on flock(2). Lock is released when the process ends,
+    even when it is killed, so there are no stale locks to clean up.
+    """
+    def __init__(self, lock_path:str, shared = False, description:str = None):
+        self.lock_path = lock_path
+        self.shared = shared
+        self.description = description if description is not None else lock_path
+        self.lock_file = None
+
+    def acquire(self, blocking = True) -> bool:
+        if self.lock_file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        self.lock_file = open(self.lock_path, "a")
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.lock_file, mode | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if not blocking:
+                self.lock_file.close()
+                self.lock_file = None
+                return False
+        print("Waiting for %s, it is used by another dcs_deploy process ..." % self.description)
+        fcntl.flock(self.lock_file, mode)
+        return True
+
+    def release(self):
+        if self.lock_file is None:
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class ArchiveIndex:
+    """
+    Index of archive members stored next to the archive (<archive>.index.json.gz).
+    It is built once on the first use of the archive, so the size of extracted data and archive
+    content is known without decompressing the archive again.
+    """
+    INDEX_VERSION = 2
+    STREAM_CHUNK_SIZE = 1024 * 1024
+    # members are stored as [name, size, mode, type, offset, linkname] lists to keep the index small
+    NAME, SIZE, MODE, TYPE, OFFSET, LINKNAME = range(6)
+
+    def __init__(self, archive_path:str):
+        self.archive_path = archive_path
+        self.index_path = archive_path + ".index.json.gz"
+        self.index = None
+        self.member_names = None
+
+    def load(self) -> bool:
+        """
+        Load index from disk. Index of different (re-downloaded) archive is not loaded.
+        """
+        if not os.path.isfile(self.index_path):
+            return False
+        try:
+            with gzip.open(self.index_path, "rt") as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError) as e:
+            print("Could not load archive index %s: %s" % (self.index_path, str(e)))
+            return False
+        if index.get("version") != ArchiveIndex.INDEX_VERSION or index.get("source") != file_source_stat(self.archive_path):
+            return False
+        self.index = index
+        return True
+
+    def build(self):
+        print("Building index of %s ..." % self.archive_path)
+        decompress = None
+        if ("tbz2" in self.archive_path or "tar.bz2" in self.archive_path) and cmd_exist("lbzip2"):
+            decompress = subprocess.Popen(["lbzip2", "-dc", self.archive_path], stdout=subprocess.PIPE)
+            archive = tarfile.open(fileobj=decompress.stdout, mode="r|")
+        else:
+            archive = tarfile.open(self.archive_path, mode="r|*")
+        try:
+            self.read(archive)
+        finally:
+            archive.close()
+            if decompress is not None:
+                decompress.stdout.close()
+                decompress.wait()
+        self.save()
+
+    def read(self, archive:tarfile.TarFile):
+        """
+        Read members of archive opened as stream into the index.
+        """
+        members = []
+        total_size = 0
+        file_count = 0
+        stream_size = 0
+        for member in archive:
+            members.append([ArchiveIndex.normalize(member.name), member.size, member.mode,
+                            member.type.decode(), member.offset_data,
+                            ArchiveIndex.normalize(member.linkname) if member.islnk() else member.linkname])
+            if member.isfile():
+                total_size += member.size
+                file_count += 1
+            stream_size = member.offset_data + member.size
+
+        self.index = {
+            "version": ArchiveIndex.INDEX_VERSION,
+            "source": file_source_stat(self.archive_path),
+            "total_size": total_size,
+            "file_count": file_count,
+            "member_count": len(members),
+            "stream_size": stream_size,
+            "members": members,
+        }
+
+    def save(self):
+        # write atomically, index can be read by another dcs_deploy process
+        tmp_path = self.index_path + ".%d.tmp" % os.getpid()
+        with gzip.open(tmp_path, "wt") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(tmp_path, self.index_path)
+        print("Archive index: %d files, %s uncompressed" % (self.file_count, format_size(self.total_size)))
+
+    def extract_and_build(self, source_path:str, extract_command:str) -> int:
+        """
+        Run extract_command reading uncompressed tar from stdin and build the index from the same
+        stream, so the archive is decompressed only once. source_path is the archive or its transcoded
+        copy. Index is saved only when the whole archive was extracted. Returns exit code of the command.
+        """
+        print("Building index of %s while extracting ..." % self.archive_path)
+        decompress_command = ArchiveTranscoder.get_decompress_command(source_path)
+        decompress = None
+        if decompress_command is None:
+            source = open(source_path, "rb")
+        else:
+            decompress = subprocess.Popen(decompress_command + [source_path], stdout=subprocess.PIPE)
+            source = decompress.stdout
+        try:
+            extractor = subprocess.Popen(extract_command, shell=True, stdin=subprocess.PIPE)
+        except Exception as e:
+            source.close()
+            raise CommandError("Command %s execution failed!!. Error %s" % (extract_command, str(e)))
+
+        read_fd, write_fd = os.pipe()
+        errors = []
+        def read_index():
+            with open(read_fd, "rb") as index_stream:
+                try:
+                    self.read(tarfile.open(fileobj=index_stream, mode="r|", bufsize=ArchiveIndex.STREAM_CHUNK_SIZE))
+                except (OSError, tarfile.TarError, EOFError) as e:
+                    errors.append(e)
+                # zero blocks after the end of archive, or rest of the stream when reading failed
+                while index_stream.read(ArchiveIndex.STREAM_CHUNK_SIZE):
+                    pass
+        index_thread = Thread(target=read_index)
+        index_thread.start()
+
+        with open(write_fd, "wb") as index_pipe:
+            try:
+                for chunk in iter(lambda: source.read(ArchiveIndex.STREAM_CHUNK_SIZE), b""):
+                    extractor.stdin.write(chunk)
+                    index_pipe.write(chunk)
+            except BrokenPipeError as e:
+                # extracting command failed, its exit code is reported
+                errors.append(e)
+            finally:
+                source.close()
+                try:
+                    extractor.stdin.close()
+                except BrokenPipeError:
+                    pass
+        index_thread.join()
+        ret = extractor.wait()
+        if decompress is not None and decompress.wait() != 0:
+            errors.append(OSError("decompression of %s failed" % source_path))
+            ret = ret or 1
+        if ret == 0 and len(errors) == 0:
+            self.save()
+        else:
+            self.index = None
+            if len(errors) != 0:
+                print("Could not index archive %s: %s" % (self.archive_path, str(errors[0])))
+        return ret
+
+    def load_or_build(self):
+        if self.index is None and not self.load():
+            self.build()
+        return self
+
+    @staticmethod
+    def normalize(name:str) -> str:
+        while name.startswith("./"):
+            name = name[2:]
+        return name.strip("/")
+
+    @property
+    def total_size(self) -> int:
+        return self.index["total_size"]
+
+    @property
+    def file_count(self) -> int:
+        return self.index["file_count"]
+
+    @property
+    def stream_size(self) -> int:
+        return self.index["stream_size"]
+
+    def members(self):
+        return self.index["members"]
+
+    def contains(self, name:str) -> bool:
+        """
+        Check whether archive contains given path, eg. contains("/etc/nv_tegra_release")
+        """
+        if self.member_names is None:
+            self.member_names = set(member[ArchiveIndex.NAME] for member in self.members())
+        return ArchiveIndex.normalize(name) in self.member_names
+
+    def get_member(self, name:str):
+        name = ArchiveIndex.normalize(name)
+        for member in self.members():
+            if member[ArchiveIndex.NAME] == name:
+                return member
+        return None
+
+    def required_space(self, block_size = 4096, excluded:set = None) -> int:
+        """
+        Estimate space needed for extraction. Each member takes at least one filesystem block.
+        """
+        required = 0
+        for member in self.members():
+            if excluded and member[ArchiveIndex.NAME] in excluded:
+                continue
+            blocks = max(1, (member[ArchiveIndex.SIZE] + block_size - 1) // block_size)
+            required += blocks * block_size
+        # keep some reserve for filesystem metadata
+        return int(required * 1.05)
+
+class ArchiveTranscoder:
+    """
+    Copy of downloaded archive re-encoded into format which is fast to decompress (multi-threaded zstd
+    or uncompressed tar). bzip2 decompression is the slowest part of extraction, so the archive is
+    transcoded once, after its first use. Copies are stored in ~/.dcs_deploy/transcoded keyed by sha256
+    of the original file, hash is cached next to the archive (<archive>.sha256.json).
+    Decompressed stream of the copy is the same, so ArchiveIndex of the original archive stays valid.
+    """
+    FORMATS = {"zstd": ".tar.zst", "tar": ".tar"}
+    HASH_SUFFIX = ".sha256.json"
+
+    def __init__(self, archive_path:str, transcode_path:str):
+        self.archive_path = archive_path
+        self.hash_path = archive_path + ArchiveTranscoder.HASH_SUFFIX
+        self.transcode_path = transcode_path
+
+    def load_hash(self) -> str:
+        """
+        Get cached sha256 of the archive. Hash of different (re-downloaded) archive is not used.
+        """
+        try:
+            with open(self.hash_path) as hash_file:
+                cached = json.load(hash_file)
+            if cached.get("source") == file_source_stat(self.archive_path):
+                return cached.get("sha256")
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def compute_hash(self) -> str:
+        source = file_source_stat(self.archive_path)
+        sha256 = file_sha256(self.archive_path)
+        tmp_path = self.hash_path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as hash_file:
+            json.dump({"source": source, "sha256": sha256}, hash_file)
+        os.replace(tmp_path, self.hash_path)
+        return sha256
+
+    def get_path(self, sha256:str, format:str) -> str:
+        return os.path.join(self.transcode_path, sha256 + ArchiveTranscoder.FORMATS[format])
+
+    def find(self) -> str:
+        """
+        Get path of transcoded copy of the archive, None when there is none.
+        """
+        sha256 = self.load_hash()
+        if sha256 is None:
+            return None
+        for format in ArchiveTranscoder.FORMATS:
+            if os.path.isfile(self.get_path(sha256, format)):
+                return self.get_path(sha256, format)
+        return None
+
+    @staticmethod
+    def get_decompress_command(archive_path:str) -> list:
+        """
+        Command decompressing archive to stdout, None for uncompressed archives.
+        """
+        if "tbz2" in archive_path or "tar.bz2" in archive_path:
+            return ["lbzip2" if cmd_exist("lbzip2") else "bzip2", "-dc"]
+        if archive_path.endswith((".tgz", ".tar.gz")):
+            return ["pigz" if cmd_exist("pigz") else "gzip", "-dc"]
+        if archive_path.endswith((".txz", ".tar.xz")):
+            return ["xz", "-dc", "-T0"]
+        if archive_path.endswith(".zst"):
+            return ["zstd", "-dc"]
+        return None
+
+    def transcode(self, format:str) -> int:
+        decompress_command = ArchiveTranscoder.get_decompress_command(self.archive_path)
+        if decompress_command is None:
+            print("%s is not compressed, nothing to transcode." % self.archive_path)
+            return 0
+        if format == "zstd" and not cmd_exist("zstd"):
+            print("zstd is not installed, can not transcode %s!" % self.archive_path)
+            return 1
+
+        sha256 = self.load_hash()
+        if sha256 is None:
+            print("Computing sha256 of %s ..." % self.archive_path)
+            sha256 = self.compute_hash()
+        transcoded_path = self.get_path(sha256, format)
+        os.makedirs(self.transcode_path, exist_ok=True)
+        lock = FileLock(os.path.join(self.transcode_path, sha256 + ".lock"))
+        if not lock.acquire(blocking=False):
+            print("%s is transcoded by another process." % self.archive_path)
+            return 0
+        try:
+            if os.path.isfile(transcoded_path):
+                return 0
+            # zstd copy is usually a bit bigger than the bzip2 archive, tar copy has size of decompressed stream
+            index = ArchiveIndex(self.archive_path)
+            if format == "tar" and index.load():
+                required = index.stream_size
+            else:
+                required = 2 * os.path.getsize(self.archive_path)
+            free = shutil.disk_usage(self.transcode_path).free
+            if free < required:
+                print("Not enough space to transcode %s! Required: %s, free: %s" % (
+                    self.archive_path, format_size(required), format_size(free)))
+                return 13
+
+            print("Transcoding %s into %s ..." % (self.archive_path, transcoded_path))
+            start = time.monotonic()
+            tmp_path = transcoded_path + ".%d.tmp" % os.getpid()
+            with open(self.archive_path, "rb") as archive, open(tmp_path, "wb") as transcoded:
+                if format == "zstd":
+                    decompress = subprocess.Popen(decompress_command, stdin=archive, stdout=subprocess.PIPE)
+                    compress = subprocess.Popen(["zstd", "-T0", "-q", "-c"], stdin=decompress.stdout, stdout=transcoded)
+                    decompress.stdout.close()
+                    ret = compress.wait()
+                    ret = decompress.wait() or ret
+                else:
+                    ret = subprocess.call(decompress_command, stdin=archive, stdout=transcoded)
+            if ret != 0:
+                print("Transcoding of %s failed!" % self.archive_path)
+                os.remove(tmp_path)
+                return ret
+            os.replace(tmp_path, transcoded_path)
+            print("Transcoded %s -> %s in %.1f s" % (format_size(os.path.getsize(self.archive_path)),
+                  format_size(os.path.getsize(transcoded_path)), time.monotonic() - start))
+            return 0
+        finally:
+            lock.release()
+
+class ExtractProfile:
+    """
+    Named set of exclude/keep patterns (fnmatch) applied while extracting rootfs.
+    Profiles are defined in local/extract_profiles.json. Members matching "required" patterns
+    are never excluded, so apply_binaries.sh and l4t_create_default_user.sh find what they need.
+    """
+    PROFILES_FILE = os.path.join('local', 'extract_profiles.json')
+
+    def __init__(self, name:str, exclude:list, keep:list, description:str = ""):
+        self.name = name
+        self.exclude = exclude
+        self.keep = keep
+        self.description = description
+
+    @staticmethod
+    def load(name:str):
+        """
+        Load profile by name, None if profile does not exist.
+        """
+        with open(ExtractProfile.PROFILES_FILE) as profiles_file:
+            profiles = json.load(profiles_file)
+        if name not in profiles["profiles"]:
+            return None
+        profile = profiles["profiles"][name]
+        return ExtractProfile(name, profile["exclude"], profile.get("keep", []) + profiles.get("required", []),
+                              profile.get("description", ""))
+
+    @staticmethod
+    def list_names() -> list:
+        with open(ExtractProfile.PROFILES_FILE) as profiles_file:
+            return list(json.load(profiles_file)["profiles"].keys())
+
+    @staticmethod
+    def _matches(name:str, patterns:list) -> bool:
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    @staticmethod
+    def _ancestors(name:str):
+        parts = name.split("/")
+        for i in range(1, len(parts)):
+            yield "/".join(parts[:i])
+
+    def get_excluded(self, index:ArchiveIndex):
+        """
+        Get members excluded by the profile. Returns tuple of (all excluded member names,
+        excluded names which has to be passed to tar - their subtrees are excluded too).
+        """
+        members = index.members()
+        # hard link targets of extracted members have to be extracted too
+        keep = set()
+        for member in members:
+            name = member[ArchiveIndex.NAME]
+            if self._matches(name, self.keep) or (member[ArchiveIndex.TYPE] == tarfile.LNKTYPE.decode() and
+                                                   not self._matches(name, self.exclude)):
+                keep.add(name)
+                if member[ArchiveIndex.TYPE] == tarfile.LNKTYPE.decode():
+                    keep.add(member[ArchiveIndex.LINKNAME])
+        # directories with kept content are not excluded
+        kept_dirs = set()
+        for name in keep:
+            kept_dirs.update(self._ancestors(name))
+
+        excluded = set()
+        excluded_roots = []
+        for member in members:
+            name = member[ArchiveIndex.NAME]
+            if name in keep or name in kept_dirs:
+                continue
+            if any(ancestor in excluded for ancestor in self._ancestors(name)):
+                excluded.add(name)
+            elif self._matches(name, self.exclude):
+                excluded.add(name)
+                excluded_roots.append(name)
+        return excluded, excluded_roots
+
+    def write_exclude_file(self, excluded_roots:list, exclude_file_path:str):
+        """
+        Write exclude file for tar (--anchored --no-wildcards --exclude-from). Archives can
+        store members with or without "./" prefix, so both forms are written.
+        """
+        with open(exclude_file_path, "w") as exclude_file:
+            for name in excluded_roots:
+                exclude_file.write(name + "\n")
+                exclude_file.write("./" + name + "\n")
+
+class RootfsSource:
+    """
+    Custom root filesystem given by --rootfs: tar archive (extracted as downloaded rootfs),
+    unpacked directory, rsync source (rsync://host/module/path or host:path) or raw ext4 image
+    (eg. system.img.raw of flashed device) which is loop-mounted read-only.
+    Directories and images are copied into Linux_for_Tegra/rootfs by resources/parallel_copy.py
+    (metadata-preserving, reflinked where the filesystem supports it), rsync sources by rsync.
+    """
+    ARCHIVE = "archive"
+    DIRECTORY = "directory"
+    RSYNC = "rsync"
+    IMAGE = "image"
+
+    EXT4_MAGIC_OFFSET = 1080
+    EXT4_MAGIC = b"\x53\xef"
+    SPARSE_IMAGE_MAGIC = b"\x3a\xff\x26\xed"
+    # pseudo filesystems and mount points of a live system, their content is not part of the rootfs
+    RSYNC_EXCLUDES = ["/dev/*", "/proc/*", "/sys/*", "/tmp/*", "/run/*", "/mnt/*", "/media/*", "/lost+found"]
+
+    def __init__(self, spec:str):
+        self.kind = RootfsSource.get_kind(spec)
+        if self.kind is None:
+            raise ConfigError(f"Error: The specified rootfs path does not exist: {spec}", 1)
+        self.path = spec if self.kind == RootfsSource.RSYNC else os.path.abspath(spec)
+
+    @staticmethod
+    def get_kind(spec:str) -> str:
+        """
+        Get kind of rootfs source, None when there is no such source.
+        """
+        if os.path.isdir(spec):
+            return RootfsSource.DIRECTORY
+        if os.path.isfile(spec):
+            with open(spec, "rb") as source_file:
+                header = source_file.read(RootfsSource.EXT4_MAGIC_OFFSET + len(RootfsSource.EXT4_MAGIC))
+            if header.startswith(RootfsSource.SPARSE_IMAGE_MAGIC):
+                raise ConfigError(f"Error: {spec} is a sparse image, convert it to raw image first (simg2img {spec} {spec}.raw).", 1)
+            if header[RootfsSource.EXT4_MAGIC_OFFSET:] == RootfsSource.EXT4_MAGIC:
+                return RootfsSource.IMAGE
+            return RootfsSource.ARCHIVE
+        if os.path.exists(spec):
+            return None
+        if spec.startswith("rsync://") or re.match(r"^[^/:]+:", spec):
+            return RootfsSource.RSYNC
+        return None
+
+    def is_archive(self) -> bool:
+        return self.kind == RootfsSource.ARCHIVE
+
+    def populate(self, destination:str, jobs:int = None) -> int:
+        """
+        Copy the rootfs into destination directory. Returns exit code of the copy.
+        """
+        print("Copying rootfs %s (%s) into %s ..." % (self.path, self.kind, destination))
+        if self.kind == RootfsSource.DIRECTORY:
+            return self.copy_tree(self.path, destination, jobs)
+        if self.kind == RootfsSource.IMAGE:
+            return self.copy_image(destination, jobs)
+        if self.kind == RootfsSource.RSYNC:
+            return self.copy_rsync(destination)
+        raise ConfigError("Rootfs archive %s has to be extracted, not copied!" % self.path, 1)
+
+    @staticmethod
+    def copy_tree(source:str, destination:str, jobs:int = None) -> int:
+        command = "sudo python3 -B " + PARALLEL_COPY_PATH
+        if jobs:
+            command += " -j %d" % jobs
+        return cmd_exec(f"{command} {source} {destination}")
+
+    def copy_image(self, destination:str, jobs:int = None) -> int:
+        mount_point = tempfile.mkdtemp(prefix="dcs_deploy_rootfs_")
+        try:
+            # noload: journal is not replayed, the image stays untouched
+            ret = cmd_exec(f"sudo mount -o loop,ro,noload {self.path} {mount_point}", print_command=True)
+            if ret != 0:
+                print("Could not mount rootfs image %s!" % self.path)
+                return ret
+            try:
+                return self.copy_tree(mount_point, destination, jobs)
+            finally:
+                cmd_exec(f"sudo umount {mount_point}", print_command=True)
+        finally:
+            os.rmdir(mount_point)
+
+    def copy_rsync(self, destination:str) -> int:
+        # ssh sources are accessed with the agent of the user, not with keys of root
+        command = "sudo --preserve-env=SSH_AUTH_SOCK rsync -aHAXx --numeric-ids --info=progress2"
+        command += "".join(" --exclude='%s'" % pattern for pattern in RootfsSource.RSYNC_EXCLUDES)
+        return cmd_exec(f"{command} {self.path.rstrip('/')}/ {destination}/", print_command=True)
+
+class DeployCache:
+    """
+    Accounting of downloaded files and flash directories in ~/.dcs_deploy. Sizes, last use
+    and configs using each item are stored in cache_db.json. Items are evicted in LRU order
+    when their total size exceeds the quota. Items locked by running dcs_deploy process are
+    never evicted.
+    """
+    # files stored next to downloaded files, they are accounted and evicted together
+    SIDECAR_SUFFIXES = [".index.json.gz", ".meta.json", ArchiveTranscoder.HASH_SUFFIX]
+
+    def __init__(self, deploy):
+        self.deploy = deploy
+        self.root = deploy.dsc_deploy_root
+        self.download_path = deploy.download_path
+        self.flash_root = os.path.join(self.root, 'flash')
+        self.transcode_path = deploy.transcode_path
+        self.db_path = os.path.join(self.root, 'cache_db.json')
+
+    def _load(self) -> dict:
+        if not os.path.isfile(self.db_path):
+            return {"quota": None, "items": {}}
+        with open(self.db_path) as db_file:
+            return json.load(db_file)
+
+    def _save(self, db:dict):
+        tmp_path = self.db_path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as db_file:
+            json.dump(db, db_file, indent=4)
+        os.replace(tmp_path, self.db_path)
+
+    def _update(self, update):
+        os.makedirs(self.root, exist_ok=True)
+        with self.deploy.get_lock("cache_db"):
+            db = self._load()
+            update(db)
+            self._save(db)
+            return db
+
+    def _key(self, path:str) -> str:
+        return os.path.relpath(path, self.root)
+
+    def touch(self, paths:list, config_name:str = None):
+        """
+        Record use of cached items by config.
+        """
+        def update(db):
+            for path in paths:
+                if path == "" or not path.startswith(self.root):
+                    continue
+                item = db["items"].setdefault(self._key(path), {"last_used": 0, "configs": [], "size": None})
+                item["last_used"] = time.time()
+                if config_name is not None and config_name not in item["configs"]:
+                    item["configs"].append(config_name)
+        self._update(update)
+
+    def update_size(self, path:str):
+        size = self.get_size(path)
+        def update(db):
+            if self._key(path) in db["items"]:
+                db["items"][self._key(path)]["size"] = size
+        self._update(update)
+        return size
+
+    def set_quota(self, quota):
+        def update(db):
+            db["quota"] = quota
+        self._update(update)
+
+    def get_quota(self):
+        return self._load().get("quota")
+
+    def get_sidecars(self, path:str) -> list:
+        return [path + suffix for suffix in DeployCache.SIDECAR_SUFFIXES if os.path.exists(path + suffix)]
+
+    def get_size(self, path:str) -> int:
+        if os.path.isfile(path):
+            return sum(os.stat(p).st_size for p in [path] + self.get_sidecars(path))
+        try:
+            output = subprocess.run(["du", "-sx", "-B1", path], capture_output=True, text=True).stdout
+            return int(output.split()[0])
+        except (IndexError, ValueError):
+            return 0
+
+    def scan(self) -> list:
+        """
+        Get all cached items: downloaded files (without sidecar and temporary files), transcoded archives
+        and flash directories.
+        """
+        items = []
+        if os.path.isdir(self.download_path):
+            for dir_path, dir_names, file_names in os.walk(self.download_path):
+                for file_name in file_names:
+                    if file_name.endswith(".tmp") or any(file_name.endswith(s) for s in DeployCache.SIDECAR_SUFFIXES):
+                        continue
+                    items.append(("download", os.path.join(dir_path, file_name)))
+        if os.path.isdir(self.transcode_path):
+            for file_name in sorted(os.listdir(self.transcode_path)):
+                if file_name.endswith(tuple(ArchiveTranscoder.FORMATS.values())):
+                    items.append(("transcoded", os.path.join(self.transcode_path, file_name)))
+        if os.path.isdir(self.flash_root):
+            for name in sorted(os.listdir(self.flash_root)):
+                if os.path.isdir(os.path.join(self.flash_root, name)):
+                    items.append(("flash", os.path.join(self.flash_root, name)))
+        return items
+
+    def get_config_references(self) -> dict:
+        """
+        Map downloaded file paths to configs of config_db referencing them.
+        """
+        references = {}
+        for config in self.deploy.config_db:
+            for res_name in RESOURCE_KEYS:
+                url = self.deploy.config_db[config].get(res_name)
+                if url == None or url == "none" or url == "":
+                    continue
+                references.setdefault(self.deploy.get_download_file_path(url), []).append(config)
+        return references
+
+    def is_in_use(self, path:str) -> bool:
+        lock = self.deploy.get_lock(path)
+        if not lock.acquire(blocking=False):
+            return True
+        lock.release()
+        return False
+
+    def stats(self, compute_sizes = True) -> list:
+        db = self._load()
+        references = self.get_config_references()
+        stats = []
+        for kind, path in self.scan():
+            item = db["items"].get(self._key(path), {})
+            size = item.get("size")
+            if compute_sizes or size is None or kind == "download":
+                size = self.get_size(path)
+            last_used = item.get("last_used") or os.stat(path).st_mtime
+            stats.append({
+                "kind": kind,
+                "path": path,
+                "size": size,
+                "last_used": last_used,
+                "configs": sorted(set(item.get("configs", []) + references.get(path, []))),
+                "in_use": self.is_in_use(path),
+            })
+        return stats
+
+    def gc(self, quota:int, protect:list = None, dry_run = False, compute_sizes = True) -> list:
+        """
+        Evict least recently used items until total size fits into quota.
+        """
+        protect = protect if protect is not None else []
+        items = sorted(self.stats(compute_sizes), key=lambda item: item["last_used"])
+        total = sum(item["size"] for item in items)
+        evicted = []
+        for item in items:
+            if total <= quota:
+                break
+            if item["path"] in protect:
+                continue
+            lock = self.deploy.get_lock(item["path"])
+            if not lock.acquire(blocking=False):
+                print("Skipping %s, it is in use." % item["path"])
+                continue
+            print("%s %s (%s, last used %s)" % ("Would evict" if dry_run else "Evicting", item["path"],
+                  format_size(item["size"]), time.strftime("%Y-%m-%d %H:%M", time.localtime(item["last_used"]))))
+            if not dry_run:
+                if item["kind"] == "flash":
+                    self.deploy.move_to_trash(item["path"])
+                else:
+                    for path in [item["path"]] + self.get_sidecars(item["path"]):
+                        os.remove(path)
+            lock.release()
+            total -= item["size"]
+            evicted.append(item)
+
+        if not dry_run:
+            def update(db):
+                for item in evicted:
+                    db["items"].pop(self._key(item["path"]), None)
+            self._update(update)
+        return evicted
+
+
+def parse_size(size:str) -> int:
+    """
+    Parse size like 500M, 200G or 1T into bytes.
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper().rstrip("B")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class SystemImage:
+    """
+    Generated partition image, either raw or in Android sparse format (as produced by mksparse).
+    Offsets are logical (offsets within the partition), data of sparse image can be accessed
+    only where it is stored in RAW chunks.
+    """
+    SPARSE_MAGIC = 0xED26FF3A
+    SPARSE_HEADER_FORMAT = "<IHHHHIIII"
+    CHUNK_HEADER_FORMAT = "<HHII"
+    CHUNK_RAW = 0xCAC1
+    SEARCH_BLOCK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path:str):
+        self.path = path
+        # [logical offset, length, file offset] of data stored in the file
+        self.ranges = []
+        self.sparse = False
+        self._load_layout()
+
+    def _load_layout(self):
+        file_size = os.path.getsize(self.path)
+        with open(self.path, "rb") as image:
+            header = image.read(struct.calcsize(SystemImage.SPARSE_HEADER_FORMAT))
+            if len(header) < struct.calcsize(SystemImage.SPARSE_HEADER_FORMAT) or \
+                    struct.unpack_from("<I", header)[0] != SystemImage.SPARSE_MAGIC:
+                self.ranges = [[0, file_size, 0]]
+                return
+
+            self.sparse = True
+            _, _, _, file_hdr_sz, chunk_hdr_sz, blk_sz, _, total_chunks, _ = \
+                struct.unpack(SystemImage.SPARSE_HEADER_FORMAT, header)
+            file_offset = file_hdr_sz
+            logical_offset = 0
+            for _ in range(total_chunks):
+                image.seek(file_offset)
+                chunk_type, _, chunk_sz, total_sz = struct.unpack(
+                    SystemImage.CHUNK_HEADER_FORMAT, image.read(struct.calcsize(SystemImage.CHUNK_HEADER_FORMAT)))
+                if chunk_type == SystemImage.CHUNK_RAW:
+                    self.ranges.append([logical_offset, chunk_sz * blk_sz, file_offset + chunk_hdr_sz])
+                logical_offset += chunk_sz * blk_sz
+                file_offset += total_sz
+
+    def to_file_ranges(self, offset:int, length:int) -> list:
+        """
+        Map logical range to [(file offset, length)]. Raises ValueError when the range is not stored in the file.
+        """
+        file_ranges = []
+        end = offset + length
+        for range_start, range_length, file_offset in self.ranges:
+            range_end = range_start + range_length
+            if range_end <= offset or range_start >= end:
+                continue
+            start = max(offset, range_start)
+            stop = min(end, range_end)
+            file_ranges.append((file_offset + start - range_start, stop - start))
+        if sum(length for _, length in file_ranges) != length:
+            raise ValueError("Range %d+%d of %s is not stored in the image!" % (offset, length, self.path))
+        return file_ranges
+
+    def to_logical(self, file_position:int):
+        for range_start, range_length, file_offset in self.ranges:
+            if file_offset <= file_position < file_offset + range_length:
+                return range_start + file_position - file_offset
+        return None
+
+    def read(self, offset:int, length:int) -> bytes:
+        data = b""
+        with open(self.path, "rb") as image:
+            for file_offset, range_length in self.to_file_ranges(offset, length):
+                image.seek(file_offset)
+                data += image.read(range_length)
+        return data
+
+    def write(self, offset:int, data:bytes) -> int:
+        """
+        Write data in place. Images are owned by root, so they are written using sudo dd.
+        """
+        tmp_path = os.path.join(tempfile.gettempdir(), "dcs_deploy_image_patch.%d.tmp" % os.getpid())
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(data)
+        ret = 0
+        data_offset = 0
+        try:
+            for file_offset, range_length in self.to_file_ranges(offset, len(data)):
+                ret = cmd_exec(f"sudo dd if={tmp_path} of={self.path} bs=1M iflag=skip_bytes,count_bytes "
+                               f"oflag=seek_bytes conv=notrunc,fsync status=none "
+                               f"skip={data_offset} seek={file_offset} count={range_length}")
+                if ret != 0:
+                    break
+                data_offset += range_length
+        finally:
+            os.remove(tmp_path)
+        return ret
+
+    def find(self, pattern:bytes):
+        """
+        Returns logical offset of the first occurrence of pattern in stored data or None.
+        """
+        position = 0
+        tail = b""
+        with open(self.path, "rb") as image:
+            while True:
+                block = image.read(SystemImage.SEARCH_BLOCK_SIZE)
+                if not block:
+                    return None
+                data = tail + block
+                index = data.find(pattern)
+                while index != -1:
+                    logical = self.to_logical(position - len(tail) + index)
+                    if logical is not None:
+                        return logical
+                    index = data.find(pattern, index + 1)
+                tail = data[-(len(pattern) - 1):] if len(pattern) > 1 else b""
+                position += len(block)
+
+    def sha1(self) -> str:
+        digest = hashlib.sha1()
+        with open(self.path, "rb") as image:
+            for block in iter(lambda: image.read(SystemImage.SEARCH_BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+class UnitPayload:
+    """
+    Per-unit personalisation (hostname, SSH host keys, Wi-Fi credentials, serial number, ...)
+    written into already generated images at flash time.
+
+    During prepare a placeholder file of fixed size filled with pseudo random data is put into
+    the rootfs. At flash time the placeholder is found in the generated APP image and overwritten
+    by the payload of the flashed unit: header + tar.gz rendered from the unit template and
+    the row of the unit in CSV file. The payload is applied on the device by apply_unit_payload.py
+    at the first boot (see dcs_first_boot overlay, header format has to match).
+    """
+    PLACEHOLDER_PATH = os.path.join("var", "lib", "airvolute", "unit_payload.bin")
+    SIZE = 8 * 1024 * 1024
+    HEADER_SIZE = 4096
+    MAGIC = b"AVUNITPAYLOAD\x00\x00\x01"
+    # magic, kind, data length, data sha256
+    HEADER_FORMAT = ">16sBQ32s"
+    KIND_PLACEHOLDER = 0
+    KIND_PAYLOAD = 1
+    PARAMETER_PATTERN = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+    def __init__(self, template_dir:str, units_dir:str):
+        self.template_dir = template_dir
+        self.units_dir = units_dir
+
+    @staticmethod
+    def header(kind:int, data:bytes = b"") -> bytes:
+        header = struct.pack(UnitPayload.HEADER_FORMAT, UnitPayload.MAGIC, kind, len(data),
+                             hashlib.sha256(data).digest())
+        return header.ljust(UnitPayload.HEADER_SIZE, b"\0")
+
+    @staticmethod
+    def placeholder() -> bytes:
+        """
+        Placeholder content. Random data are not stored as holes by sparse images and the
+        content is reproducible, so the placeholder can be verified in the generated image.
+        """
+        seed = UnitPayload.MAGIC
+        data = bytearray(UnitPayload.header(UnitPayload.KIND_PLACEHOLDER))
+        counter = 0
+        while len(data) < UnitPayload.SIZE:
+            data += hashlib.sha256(seed + counter.to_bytes(8, "big")).digest()
+            counter += 1
+        return bytes(data[:UnitPayload.SIZE])
+
+    @staticmethod
+    def load_units(units_path:str) -> dict:
+        with open(units_path, newline="") as units_file:
+            reader = csv.DictReader(units_file)
+            if reader.fieldnames is None or "serial" not in reader.fieldnames:
+                raise ValueError("%s has to contain 'serial' column!" % units_path)
+            return {row["serial"]: row for row in reader}
+
+    def render(self, content:bytes, params:dict, path:str) -> bytes:
+        try:
+            text = content.decode()
+        except UnicodeDecodeError:
+            # binary files are copied as they are
+            return content
+
+        def substitute(match):
+            name = match.group(1)
+            if name not in params:
+                raise ValueError("Unknown unit parameter '%s' in %s!" % (name, path))
+            return params[name]
+
+        return UnitPayload.PARAMETER_PATTERN.sub(substitute, text).encode()
+
+    def get_ssh_host_keys(self, serial:str) -> str:
+        """
+        SSH host keys of unit are generated once and kept, so reflashed unit keeps its identity.
+        Returns root directory containing etc/ssh/ssh_host_* keys or None.
+        """
+        keys_root = os.path.join(self.units_dir, serial, "ssh")
+        if not cmd_exist("ssh-keygen"):
+            print("ssh-keygen not found, SSH host keys will be generated on the device.")
+            return None
+        os.makedirs(os.path.join(keys_root, "etc", "ssh"), mode=0o700, exist_ok=True)
+        ret = cmd_exec(f"ssh-keygen -A -f {shlex.quote(keys_root)} > /dev/null")
+        if ret != 0:
+            raise OSError("Generating SSH host keys of unit %s failed!" % serial)
+        return keys_root
+
+    def build(self, serial:str, row:dict, files_dir:str = None, ssh_keys:bool = True) -> bytes:
+        """
+        Build payload of unit. Files are taken from the template (rendered with unit parameters),
+        from files_dir/<serial> and SSH host keys of the unit.
+        """
+        params = {"serial": serial, "hostname": "dcs-" + serial}
+        params.update({key: value for key, value in row.items() if key is not None and value is not None})
+
+        sources = []
+        if os.path.isdir(self.template_dir):
+            sources.append((self.template_dir, True))
+        if files_dir is not None and os.path.isdir(os.path.join(files_dir, serial)):
+            sources.append((os.path.join(files_dir, serial), False))
+        if ssh_keys:
+            keys_root = self.get_ssh_host_keys(serial)
+            if keys_root is not None:
+                sources.append((keys_root, False))
+
+        files = {}
+        for source_dir, render in sources:
+            for dir_path, _, file_names in os.walk(source_dir):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    name = os.path.relpath(path, source_dir)
+                    with open(path, "rb") as source_file:
+                        content = source_file.read()
+                    if render:
+                        content = self.render(content, params, path)
+                    files[name] = (content, os.stat(path).st_mode & 0o7777)
+
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode="w:gz") as payload:
+            for name in sorted(files):
+                content, mode = files[name]
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                info.mode = mode
+                info.mtime = int(time.time())
+                payload.addfile(info, io.BytesIO(content))
+        data = data.getvalue()
+
+        payload = UnitPayload.header(UnitPayload.KIND_PAYLOAD, data) + data
+        if len(payload) > UnitPayload.SIZE:
+            raise ValueError("Payload of unit %s has %s, only %s fits!" %
+                             (serial, format_size(len(payload)), format_size(UnitPayload.SIZE)))
+        print("Payload of unit %s: %d files, %s" % (serial, len(files), format_size(len(payload))))
+        return payload
+
+    def _location_path(self, image_path:str) -> str:
+        name = hashlib.sha1(os.path.abspath(image_path).encode()).hexdigest()
+        return os.path.join(self.units_dir, "locations", name + ".json")
+
+    def locate(self, image:SystemImage):
+        """
+        Returns logical offset of the placeholder (or a previous payload) in image or None.
+        Raises ValueError when the placeholder is not stored contiguously. Location is remembered, so the image is searched only once after it was generated.
+        """
+        stat = os.stat(image.path)
+        location_path = self._location_path(image.path)
+        try:
+            with open(location_path) as location_file:
+                location = json.load(location_file)
+            if location["size"] == stat.st_size and location["mtime_ns"] == stat.st_mtime_ns and \
+                    image.read(location["offset"], len(UnitPayload.MAGIC)) == UnitPayload.MAGIC:
+                return location["offset"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        print("Searching unit payload placeholder in %s ..." % image.path)
+        placeholder = UnitPayload.placeholder()
+        offset = image.find(placeholder[:len(UnitPayload.MAGIC) + 1])
+        if offset is None:
+            return None
+        try:
+            contiguous = image.read(offset, UnitPayload.SIZE) == placeholder
+        except ValueError:
+            contiguous = False
+        if not contiguous:
+            # payload written over the start of the placeholder would overwrite other files
+            raise ValueError("Unit payload placeholder in %s is fragmented, payload can not be written into it!" % image.path)
+        return offset
+
+    def get_saved_kind(self, image:SystemImage):
+        """
+        Returns kind of payload at the remembered location of the image, None when no payload was
+        written into this image (location is not remembered or the image was generated again).
+        """
+        stat = os.stat(image.path)
+        try:
+            with open(self._location_path(image.path)) as location_file:
+                location = json.load(location_file)
+            if location["size"] != stat.st_size or location["mtime_ns"] != stat.st_mtime_ns:
+                return None
+            header = image.read(location["offset"], struct.calcsize(UnitPayload.HEADER_FORMAT))
+        except (OSError, ValueError, KeyError):
+            return None
+        magic, kind, _, _ = struct.unpack(UnitPayload.HEADER_FORMAT, header)
+        return kind if magic == UnitPayload.MAGIC else None
+
+    def save_location(self, image:SystemImage, offset:int):
+        stat = os.stat(image.path)
+        location_path = self._location_path(image.path)
+        os.makedirs(os.path.dirname(location_path), exist_ok=True)
+        with open(location_path, "w") as location_file:
+            json.dump({"offset": offset, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}, location_file)
+
+    @staticmethod
+    def update_checksums(image:SystemImage):
+        """
+        Update sha1 of patched image in flash.idx files and <image>.sha1sum used by initrd flash.
+        """
+        sha1 = image.sha1()
+        image_name = os.path.basename(image.path)
+        image_dir = os.path.dirname(image.path)
+        ret = 0
+
+        index_path = os.path.join(image_dir, "flash.idx")
+        if os.path.isfile(index_path):
+            with open(index_path) as index_file:
+                lines = index_file.read().splitlines(keepends=True)
+            changed = False
+            for i, line in enumerate(lines):
+                fields = line.rstrip("\n").split(",")
+                if len(fields) > 4 and fields[3].strip() == image_name and \
+                        re.fullmatch(r"[0-9a-f]{40}", fields[-1].strip()):
+                    fields[-1] = " " + sha1
+                    lines[i] = ",".join(fields) + ("\n" if line.endswith("\n") else "")
+                    changed = True
+            if changed:
+                ret += UnitPayload._sudo_write(index_path, "".join(lines))
+
+        sha1_path = image.path + ".sha1sum"
+        if os.path.isfile(sha1_path):
+            ret += UnitPayload._sudo_write(sha1_path, sha1 + "\n")
+        return ret
+
+    @staticmethod
+    def _sudo_write(path:str, content:str) -> int:
+        tmp_path = os.path.join(tempfile.gettempdir(), "dcs_deploy_%s.%d.tmp" % (os.path.basename(path), os.getpid()))
+        with open(tmp_path, "w") as tmp_file:
+            tmp_file.write(content)
+        try:
+            return cmd_exec(f"sudo cp {tmp_path} {path}")
+        finally:
+            os.remove(tmp_path)
+
+
+class DeployMetrics:
+    """
+    Prometheus metrics of a run in node_exporter textfile collector format. The file is rewritten
+    atomically after each processing step, so a running deploy can be watched. Counters are kept
+    between runs in a state file. Without metrics_dir the metrics are only collected.
+    """
+    PREFIX = "dcs_deploy_"
+    METRICS = {
+        "run_info": ("gauge", "Labels of the run, value is always 1."),
+        "run_running": ("gauge", "1 while the run is in progress."),
+        "run_start_timestamp_seconds": ("gauge", "Start of the last run."),
+        "run_end_timestamp_seconds": ("gauge", "End of the last run."),
+        "run_exit_code": ("gauge", "Exit code of the last run."),
+        "runs_total": ("counter", "Finished runs by result."),
+        "step_duration_seconds": ("gauge", "Duration of processing step in the last run."),
+        "step_exit_code": ("gauge", "Exit code of processing step in the last run, -1 while the step runs."),
+        "cache_hits_total": ("counter", "Downloaded files, prepared flash trees and generated images which were reused."),
+        "cache_misses_total": ("counter", "Downloaded files, prepared flash trees and generated images which were created again."),
+        "downloaded_bytes_total": ("counter", "Downloaded bytes by resource."),
+        "download_throughput_bytes_per_second": ("gauge", "Download throughput of the last download of the resource."),
+        "extracted_bytes_total": ("counter", "Extracted bytes by resource."),
+        "extract_throughput_bytes_per_second": ("gauge", "Extraction throughput of the last extraction of the resource."),
+        "generate_images_duration_seconds": ("gauge", "Duration of the last image generation."),
+        "flash_duration_seconds": ("gauge", "Duration of the last flash."),
+        "flash_throughput_bytes_per_second": ("gauge", "Size of flashed images divided by the flash duration."),
+        "flash_total": ("counter", "Flashed devices by result."),
+    }
+    STEP_DURATIONS = {
+        "generate_images": "generate_images_duration_seconds",
+        "flash_only": "flash_duration_seconds",
+    }
+
+    def __init__(self, metrics_dir:str, name:str, labels:dict, state_dir:str):
+        self.metrics_dir = metrics_dir
+        self.name = name
+        self.labels = labels
+        self.state_dir = state_dir
+        self.path = None
+        if metrics_dir is not None:
+            self.path = os.path.join(metrics_dir, self.PREFIX + name + ".prom")
+        self.state_path = os.path.join(state_dir, name + ".json")
+        self.samples = {}
+        self.step_starts = {}
+        self.write_failed = False
+        self.load_counters()
+
+    def load_counters(self):
+        if self.path is None or not os.path.isfile(self.state_path):
+            return
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            for metric in state:
+                for sample in state[metric]:
+                    self.samples.setdefault(metric, {})[tuple(sorted(sample["labels"].items()))] = sample["value"]
+        except (OSError, ValueError, KeyError) as e:
+            print("Could not load metrics state %s: %s" % (self.state_path, str(e)))
+
+    def set(self, metric:str, value, **labels):
+        self.samples.setdefault(metric, {})[tuple(sorted(labels.items()))] = value
+
+    def inc(self, metric:str, value = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        samples = self.samples.setdefault(metric, {})
+        samples[key] = samples.get(key, 0) + value
+
+    def run_started(self):
+        self.set("run_info", 1)
+        self.set("run_running", 1)
+        self.set("run_start_timestamp_seconds", round(time.time(), 3))
+        self.write()
+
+    def run_finished(self, exit_code:int):
+        self.set("run_running", 0)
+        self.set("run_end_timestamp_seconds", round(time.time(), 3))
+        self.set("run_exit_code", exit_code)
+        self.inc("runs_total", result="success" if exit_code == 0 else "failure")
+        self.write()
+
+    def step_started(self, group:str, step:str):
+        self.step_starts[(group, step)] = time.monotonic()
+        self.set("step_exit_code", -1, group=group, step=step)
+        self.write()
+
+    def step_finished(self, group:str, step:str, status:int):
+        self.set("step_exit_code", status, group=group, step=step)
+        started = self.step_starts.pop((group, step), None)
+        if started is not None:
+            duration = round(time.monotonic() - started, 3)
+            self.set("step_duration_seconds", duration, group=group, step=step)
+            if step in self.STEP_DURATIONS:
+                self.set(self.STEP_DURATIONS[step], duration)
+        self.write()
+
+    def cache_access(self, cache:str, hit:bool, **labels):
+        self.inc("cache_hits_total" if hit else "cache_misses_total", cache=cache, **labels)
+        self.write()
+
+    def transfer(self, kind:str, resource:str, size:int, duration:float):
+        """
+        Account bytes of download or extract of resource.
+        """
+        self.inc(kind + "ed_bytes_total", size, resource=resource)
+        if duration > 0:
+            self.set(kind + "_throughput_bytes_per_second", round(size / duration), resource=resource)
+        self.write()
+
+    def flash_finished(self, status:int, size:int, duration:float):
+        self.inc("flash_total", result="success" if status == 0 else "failure")
+        if status == 0 and duration > 0:
+            self.set("flash_throughput_bytes_per_second", round(size / duration))
+        self.write()
+
+    @staticmethod
+    def format_labels(labels:dict) -> str:
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        return ",".join('%s="%s"' % (key, escape(labels[key])) for key in sorted(labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.METRICS:
+            if metric not in self.samples:
+                continue
+            metric_type, metric_help = self.METRICS[metric]
+            lines.append("# HELP %s%s %s" % (self.PREFIX, metric, metric_help))
+            lines.append("# TYPE %s%s %s" % (self.PREFIX, metric, metric_type))
+            for key, value in sorted(self.samples[metric].items()):
+                labels = dict(self.labels)
+                labels.update(key)
+                lines.append("%s%s{%s} %s" % (self.PREFIX, metric, self.format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Write metrics and counters. Failure is reported once and does not stop the run.
+        """
+        if self.path is None:
+            return
+        counters = {}
+        for metric in self.samples:
+            if self.METRICS[metric][0] == "counter":
+                counters[metric] = [{"labels": dict(key), "value": value} for key, value in self.samples[metric].items()]
+        try:
+            for path, content in [(self.state_path, json.dumps(counters, indent=4)), (self.path, self.render())]:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # textfile collector reads only *.prom files, so it never sees partially written file
+                tmp_path = "%s.%d.tmp" % (path, os.getpid())
+                with open(tmp_path, "w") as tmp_file:
+                    tmp_file.write(content)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            if not self.write_failed:
+                print("Could not write metrics %s: %s" % (self.path, str(e)))
+            self.write_failed = True
+
+
+class ChrootSession:
+    """
+    aarch64 chroot of the rootfs set up once for all steps running rootfs binaries: qemu-user-static,
+    /proc, /sys, /dev and /dev/pts mounts and resolv.conf of the host. Commands run one after another
+    in one long-lived emulated shell. Scripts running on the host queue their rootfs commands into
+    queue_path (DCS_CHROOT_QUEUE), the queue is run by run_queue(). Everything is torn down when the
+    session is closed, also when a step fails or the run is terminated.
+    """
+    QEMU_PATH = "/usr/bin/qemu-aarch64-static"
+    BINFMT_PATH = "/proc/sys/fs/binfmt_misc/qemu-aarch64"
+    MOUNTS = [
+        ("proc", "-t proc proc"),
+        ("sys", "-t sysfs sysfs"),
+        ("dev", "--bind /dev"),
+        ("dev/pts", "--bind /dev/pts"),
+    ]
+    DONE_MARKER = "__dcs_deploy_chroot_done__"
+
+    def __init__(self, rootfs:str, queue_path:str):
+        self.rootfs = rootfs
+        self.queue_path = queue_path
+        self.mounted = []
+        self.qemu_installed = False
+        self.resolv_conf_copied = False
+        self.resolv_conf_backup = None
+        self.shell = None
+        self.previous_handlers = {}
+
+    def is_open(self) -> bool:
+        return self.shell is not None
+
+    def check_binfmt(self) -> bool:
+        if platform.machine() == "aarch64":
+            return True
+        if not os.path.exists(self.BINFMT_PATH):
+            cmd_exec("sudo update-binfmts --enable qemu-aarch64 > /dev/null 2>&1")
+        if not os.path.exists(self.BINFMT_PATH):
+            print("aarch64 binaries can not be run, binfmt of qemu-aarch64 is not registered!")
+            return False
+        return True
+
+    def open(self) -> bool:
+        """
+        Set up the chroot. Partially set up chroot is torn down when any part fails.
+        """
+        if not self.check_binfmt():
+            return False
+        self.catch_signals()
+        ready = False
+        try:
+            rootfs_qemu = self.rootfs + self.QEMU_PATH
+            if platform.machine() != "aarch64" and not os.path.exists(rootfs_qemu):
+                if cmd_exec(f"sudo cp {self.QEMU_PATH} {rootfs_qemu}") != 0:
+                    return False
+                self.qemu_installed = True
+
+            for mount_point, mount_args in self.MOUNTS:
+                path = os.path.join(self.rootfs, mount_point)
+                if os.path.ismount(path):
+                    continue
+                if cmd_exec(f"sudo mkdir -p {path} && sudo mount {mount_args} {path}") != 0:
+                    print("Could not mount %s!" % path)
+                    return False
+                self.mounted.append(path)
+
+            resolv_conf = os.path.join(self.rootfs, "etc", "resolv.conf")
+            if os.path.lexists(resolv_conf):
+                self.resolv_conf_backup = resolv_conf + ".dcs_deploy"
+                if cmd_exec(f"sudo mv {resolv_conf} {self.resolv_conf_backup}") != 0:
+                    self.resolv_conf_backup = None
+                    return False
+            self.resolv_conf_copied = True
+            if cmd_exec(f"sudo cp -L /etc/resolv.conf {resolv_conf}") != 0:
+                return False
+
+            self.shell = subprocess.Popen(["sudo", "chroot", self.rootfs, "/bin/sh"], stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+            self.shell.stdin.write("exec 2>&1\n")
+            if self.run("true") != 0:
+                print("Shell in chroot %s did not start!" % self.rootfs)
+                return False
+            with open(self.queue_path, "w"):
+                pass
+            ready = True
+        except OSError as e:
+            print("Could not set up chroot %s: %s" % (self.rootfs, str(e)))
+            return False
+        finally:
+            if not ready:
+                self.close()
+        return True
+
+    def run(self, command:str) -> int:
+        """
+        Run command in the chroot shell, output is printed. Returns exit code, -1 when the shell died.
+        """
+        if self.shell is None:
+            return -1
+        try:
+            self.shell.stdin.write("( %s ) < /dev/null\necho %s $?\n" % (command, self.DONE_MARKER))
+            self.shell.stdin.flush()
+        except (OSError, ValueError):
+            return -1
+        for line in self.shell.stdout:
+            if self.DONE_MARKER in line:
+                output, _, status = line.partition(self.DONE_MARKER)
+                if output != "":
+                    print(output)
+                return int(status.strip())
+            print(line, end="")
+        return -1
+
+    def run_queue(self) -> int:
+        """
+        Run commands queued by host scripts, stop at first failure.
+        """
+        if not os.path.isfile(self.queue_path):
+            return 0
+        with open(self.queue_path) as queue_file:
+            commands = [line.strip() for line in queue_file if line.strip() != ""]
+        os.remove(self.queue_path)
+        for i, command in enumerate(commands, start=1):
+            print("[%d/%d] chroot: %s" % (i, len(commands), command))
+            ret = self.run(command)
+            if ret != 0:
+                print("Command failed in chroot! ret = %d" % ret)
+                return ret
+        return 0
+
+    def catch_signals(self):
+        """
+        Terminating the run has to tear the chroot down too. Signals are turned into SystemExit.
+        """
+        if current_thread() is not main_thread():
+            return
+        def terminate(signum, frame):
+            raise SystemExit(128 + signum)
+        for signum in [signal.SIGTERM, signal.SIGHUP]:
+            self.previous_handlers[signum] = signal.signal(signum, terminate)
+
+    def close(self):
+        if self.shell is not None:
+            try:
+                self.shell.stdin.close()
+            except OSError:
+                pass
+            self.shell.wait()
+            self.shell = None
+        for path in reversed(self.mounted):
+            if cmd_exec(f"sudo umount {path}") != 0:
+                # something still uses the mount, detach it so the rootfs does not keep host /dev mounted
+                cmd_exec(f"sudo umount -l {path}")
+        self.mounted = []
+        resolv_conf = os.path.join(self.rootfs, "etc", "resolv.conf")
+        if self.resolv_conf_copied:
+            cmd_exec(f"sudo rm -f {resolv_conf}")
+            self.resolv_conf_copied = False
+        if self.resolv_conf_backup is not None:
+            cmd_exec(f"sudo mv {self.resolv_conf_backup} {resolv_conf}")
+            self.resolv_conf_backup = None
+        if self.qemu_installed:
+            cmd_exec(f"sudo rm -f {self.rootfs + self.QEMU_PATH}")
+            self.qemu_installed = False
+        if os.path.isfile(self.queue_path):
+            os.remove(self.queue_path)
+        for signum, handler in self.previous_handlers.items():
+            signal.signal(signum, handler)
+        self.previous_handlers = {}
+
+    def __enter__(self):
+        if not self.open():
+            print("Chroot session of %s is not available, rootfs commands run in their own chroot." % self.rootfs)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class ProcessingStatus:
-    def __init__(self, status_file_name:str, initial_group:str = "general", default_identifier:list = None):
+    def __init__(self, status_file_name:str, initial_group:str = "general", default_identifier:list = None,
+                 metrics:DeployMetrics = None):
         self.group = initial_group
+        self.metrics = metrics
         self.status_file_name = status_file_name
         self.current_identifier = default_identifier
         self.load()
@@ -106,7 +1985,7 @@ class ProcessingStatus:
             self.prev_identifier = []
         
         if self.current_identifier == None:
-            self.status["identifier"] = _sys.argv[1:]
+            self.status["identifier"] = []
         else:
             self.status["identifier"] = self.current_identifier
         print("identifier: %s" % str(self.status["identifier"]))
@@ -169,6 +2048,8 @@ class ProcessingStatus:
         self.status[self.group]["states"][processing_step_name] = -1
         self.status[self.group]["status"] = False
         self.save()
+        if self.metrics is not None:
+            self.metrics.step_started(self.group, processing_step_name)
 
     def set_status(self, status:int, processing_step_name:str = None, last_step = False):
         if processing_step_name == None:
@@ -179,6 +2060,8 @@ class ProcessingStatus:
             # check all status codes
             self.check_status()
         self.save()
+        if self.metrics is not None:
+            self.metrics.step_finished(self.group, processing_step_name, status)
     
     def check_status(self, group = None):
         if group == None:
@@ -200,19 +2083,42 @@ class ProcessingStatus:
         return self.status[group]["status"]
    
 class DcsDeploy:
-    def __init__(self):
-        self.check_dependencies()
+    def __init__(self, argv:list = None, config_db:dict = None, check_dependencies = True):
+        """
+        argv - command line arguments (without program name). sys.argv[1:] is used when None.
+        config_db - already loaded config database (used by serve mode to keep db loaded).
+        check_dependencies - dependencies can be skipped when they were already checked (serve mode).
+        """
+        if check_dependencies:
+            self.check_dependencies()
+        self.argv = _sys.argv[1:] if argv is None else list(argv)
         self.parser = self.create_parser()
-        self.args = self.parser.parse_args()
+        self.args = self.parser.parse_args(self.argv)
         self.process_optional_args()
         self.sanitize_args()
         self.selected_config_name = None
-        self.load_db()
+        self.config_db = self.load_db() if config_db is None else config_db
         self.local_overlay_dir = os.path.join('.', 'local', 'overlays')
-        if self.args.command != 'list':
+        self.unit_template_dir = os.path.abspath(os.path.join('.', 'local', 'unit_template'))
+        self.chroot_env = ""
+        self.chroot_queue = None
+        self.init_root_paths()
+        if self.args.command not in ['list', 'serve', 'prepare', 'cache', 'prefetch', 'make-delta']:
             self.load_selected_config()
-            self.init_filesystem()
-            self.check_optional_arguments()
+            try:
+                self.init_filesystem()
+                self.check_optional_arguments()
+            except DcsDeployError:
+                self.close()
+                raise
+
+    def close(self):
+        """
+        Release the flash directory. The command line leaves it to the process exit,
+        library runs (DeployEngine) release it when the run ends.
+        """
+        if getattr(self, "flash_lock", None) is not None:
+            self.flash_lock.release()
 
 
     def add_common_parser(self, subparser):
@@ -234,27 +2140,71 @@ class DcsDeploy:
         rootfs_type_help = 'REQUIRED. Which rootfs type are we going to use. Options: [minimal, full, airvolute].'
         subparser.add_argument('rootfs_type', help=rootfs_type_help)
         
-        force_help = 'Files will be deleted, downloaded and extracted again.'
+        force_help = 'Files will be extracted again. Downloaded files are downloaded again only when they changed upstream.'
         subparser.add_argument('--force', action='store_true', help=force_help)
 
         regen_help = 'Regenerate files. Extract resources and apply them again'
         subparser.add_argument('--regen', action='store_true', help=regen_help)
 
+        refresh_help = 'Check whether downloaded files changed upstream and download only changed files again.'
+        subparser.add_argument('--refresh', action='store_true', help=refresh_help)
+
         ab_partition_help = 'Prepare ab partion for system update. Only available for nvme devices'
         subparser.add_argument('--ab_partition', action='store_true', help=ab_partition_help)
 
         opt_app_size_help = 'Set APP partition size in GB. Use when you get "No space left on device" error while flashing custom rootfs'
-        subparser.add_argument('--app_size', help=opt_app_size_help)
+        subparser.add_argument('--app_size', type=app_size_arg, help=opt_app_size_help)
 
-        rootfs_help = 'Path to customized root filesystem. Keep in mind that this needs to be a valid tbz2 archive.' 
+        rootfs_help = ('Customized root filesystem: tar archive (eg. tbz2), unpacked directory, rsync source ' +
+                       '(rsync://host/module/path or host:/path) or raw ext4 image (loop-mounted read-only).')
         subparser.add_argument('--rootfs', help=rootfs_help)
 
+        extract_profile_help = 'Extraction profile skipping unneeded rootfs content (see local/extract_profiles.json). Overrides extract_profile of config.'
+        subparser.add_argument('--extract_profile', help=extract_profile_help)
+
+        extract_jobs_help = ('Extract archives with given number of parallel writer threads (resources/parallel_extract.py) instead of tar. ' +
+                             'Helps on fast storage, compare with: python3 resources/parallel_extract.py --benchmark 200000 -j <jobs>')
+        subparser.add_argument('--extract_jobs', type=int, help=extract_jobs_help)
+
+        transcode_help = ('After the first use, re-encode downloaded archives in background into format which is faster to extract ' +
+                          '(zstd - multi-threaded zstd, tar - uncompressed tar) in ~/.dcs_deploy/transcoded. Transcoded copies are used when they exist.')
+        subparser.add_argument('--transcode', choices=sorted(ArchiveTranscoder.FORMATS), help=transcode_help)
+
+        tmpfs_staging_help = 'Build flash tree in memory (tmpfs). Disk is used when there is not enough memory.'
+        subparser.add_argument('--tmpfs_staging', action='store_true', help=tmpfs_staging_help)
+
+        staging_writeback_help = ('What is written to disk at the end of --tmpfs_staging run. ' +
+                                  'tree - whole flash tree, images - flash tree without rootfs (enough for flashing), none - nothing. Default: tree')
+        subparser.add_argument('--staging_writeback', choices=['tree', 'images', 'none'], default='tree', help=staging_writeback_help)
+
+        usb_instance_help = 'USB instance (port path, eg. 1-4) of the device to flash. Use when more devices are connected in recovery mode.'
+        subparser.add_argument('--usb_instance', type=usb_instance_arg, help=usb_instance_help)
+
+        unit_help = 'Serial number of the flashed unit. Per-unit payload (hostname, SSH host keys, ...) is written into generated images.'
+        subparser.add_argument('--unit', type=unit_serial_arg, help=unit_help)
+
+        unit_placeholder_help = 'Add space for the per-unit payload into prepared rootfs, so units can be flashed with --unit. Implied by --unit.'
+        subparser.add_argument('--unit_placeholder', action='store_true', help=unit_placeholder_help)
+
+        unit_params_help = 'CSV file with unit parameters (one row per unit, "serial" column is required) used in --unit_template.'
+        subparser.add_argument('--unit_params', type=os.path.abspath, help=unit_params_help)
+
+        unit_template_help = 'Directory with files of the unit payload, {{parameter}} is replaced by unit parameter. Default: local/unit_template'
+        subparser.add_argument('--unit_template', type=os.path.abspath, help=unit_template_help)
+
+        unit_files_help = 'Directory with additional files of each unit in <dir>/<serial>/ (eg. output of wifi_generator.py --batch).'
+        subparser.add_argument('--unit_files', type=os.path.abspath, help=unit_files_help)
+
+        metrics_dir_help = ('Write Prometheus metrics of the run into node_exporter textfile collector directory, ' +
+                            'eg. /var/lib/node_exporter/textfile_collector. Default: $DCS_DEPLOY_METRICS_DIR')
+        subparser.add_argument('--metrics_dir', type=os.path.abspath, default=os.environ.get('DCS_DEPLOY_METRICS_DIR'), help=metrics_dir_help)
+
     def create_parser(self):
         """
         Create an ArgumentParser and all its options
         """
-        parser = argparse.ArgumentParser()
-        subparsers = parser.add_subparsers(dest='command', help='Command')
+        parser = DeployArgumentParser()
+        subparsers = parser.add_subparsers(dest='command', help='Command', parser_class=DeployArgumentParser)
 
         list = subparsers.add_parser(
             'list', help='list available versions')
@@ -268,15 +2218,121 @@ class DcsDeploy:
         
         self.add_common_parser(flash)
 
+        flash_target_help = 'Flash images of target generated by images command (eg. nvme:ab). Images are generated when missing.'
+        flash.add_argument('--target', help=flash_target_help)
+
+        images = subparsers.add_parser(
+            'images', help='Prepare rootfs once and generate images of several storage targets in parallel')
+
+        self.add_common_parser(images)
+
+        images_targets_help = ('REQUIRED. Comma separated targets: storage with optional :ab (AB partitions) ' +
+                               'and :app_size=<GB>, eg. emmc,nvme,nvme:ab,nvme:app_size=16')
+        images.add_argument('--targets', required=True, help=images_targets_help)
+
+        images_jobs_help = 'Number of targets generated in parallel. Default: 2'
+        images.add_argument('-j', '--jobs', type=int, default=2, help=images_jobs_help)
+
+        prepare = subparsers.add_parser(
+            'prepare', help='Prepare flash directories and images for several configurations at once')
+
+        prepare_selections_help = ('Configurations to prepare. Either config name from config_db (all its variants are prepared) ' +
+                                   'or target_device:jetpack:hwrev:board_expansion:storage:rootfs_type')
+        prepare.add_argument('selections', nargs='*', help=prepare_selections_help)
+
+        prepare_all_help = 'Prepare all variants of all configurations from config_db'
+        prepare.add_argument('--all', action='store_true', help=prepare_all_help)
+
+        prepare_jobs_help = 'Number of configurations prepared in parallel. Default: 2'
+        prepare.add_argument('-j', '--jobs', type=int, default=2, help=prepare_jobs_help)
+
+        prepare.add_argument('--force', action='store_true', help='Files will be extracted again, changed files downloaded again.')
+        prepare.add_argument('--regen', action='store_true', help='Regenerate files. Extract resources and apply them again')
+        prepare.add_argument('--refresh', action='store_true', help='Download again files which changed upstream.')
+        prepare.add_argument('--ab_partition', action='store_true', help='Prepare ab partion for system update. Applied only to nvme variants')
+        prepare.add_argument('--app_size', type=app_size_arg, help='Set APP partition size in GB.')
+        prepare.add_argument('--extract_profile', help='Extraction profile skipping unneeded rootfs content.')
+        prepare.add_argument('--extract_jobs', type=int, help='Extract archives with given number of parallel writer threads instead of tar.')
+        prepare.add_argument('--transcode', choices=sorted(ArchiveTranscoder.FORMATS), help='Transcode downloaded archives into format faster to extract.')
+        prepare.add_argument('--unit_placeholder', action='store_true', help='Add space for the per-unit payload, units can be flashed with --unit.')
+
+        prefetch = subparsers.add_parser(
+            'prefetch', help='Download resources of selected configurations ahead of time')
+
+        prefetch.add_argument('selections', nargs='*', help=prepare_selections_help)
+        prefetch.add_argument('--all', action='store_true', help='Prefetch resources of all configurations from config_db')
+
+        prefetch_rate_help = 'Bandwidth cap, eg. 5M (bytes per second)'
+        prefetch.add_argument('--rate-limit', help=prefetch_rate_help)
+
+        prefetch_window_help = 'Download only in time window, eg. 22:00-06:00. Download is paused outside of the window.'
+        prefetch.add_argument('--window', help=prefetch_window_help)
+
+        prefetch_background_help = 'Run in background, output is written to ~/.dcs_deploy/prefetch.log'
+        prefetch.add_argument('--background', action='store_true', help=prefetch_background_help)
+
+        prefetch.add_argument('--refresh', action='store_true', help='Download again already downloaded files which changed upstream')
+
+        prefetch_index_help = 'Build archive index of prefetched files, so the first extraction does not have to'
+        prefetch.add_argument('--index', action='store_true', help=prefetch_index_help)
+
+        cache = subparsers.add_parser(
+            'cache', help='Show and clean cached downloads and flash directories')
+
+        cache_action_help = 'stats - show cached items, gc - evict least recently used items over quota, quota - show or set quota'
+        cache.add_argument('action', choices=['stats', 'gc', 'quota'], help=cache_action_help)
+
+        cache_size_help = 'Quota for gc and quota actions, eg. 200G. Use "none" to disable quota.'
+        cache.add_argument('size', nargs='?', help=cache_size_help)
+
+        cache.add_argument('--dry-run', action='store_true', help='Only print what gc would evict')
+
+        make_delta = subparsers.add_parser(
+            'make-delta', help='Write delta bundle updating devices with one prepared rootfs to another one')
+
+        make_delta_old_help = ('Rootfs the bundle is applied to. Flash directory name (see ~/.dcs_deploy/flash), ' +
+                               'path of flash directory or path of rootfs')
+        make_delta.add_argument('old', help=make_delta_old_help)
+        make_delta.add_argument('new', help='Updated rootfs, given the same way as old')
+        make_delta.add_argument('-o', '--output', required=True, help='Path of the bundle, eg. update.dcsdelta')
+
+        make_delta_diff_help = 'Changed files of at least this size are stored as block diff when it is smaller than the file. Default: 1M'
+        make_delta.add_argument('--diff-min-size', default='1M', help=make_delta_diff_help)
+
+        make_delta_checksum_help = 'Compare content of all files, not only of files with different size or modification time'
+        make_delta.add_argument('--checksum', action='store_true', help=make_delta_checksum_help)
+
+        serve = subparsers.add_parser(
+            'serve', help='Run as a service accepting prepare and flash jobs over local HTTP API')
+
+        serve_listen_help = 'Address to listen on. Default: 127.0.0.1'
+        serve.add_argument('--listen', default='127.0.0.1', help=serve_listen_help)
+
+        serve_allow_remote_help = 'Allow listening on non-loopback address. Jobs can be submitted by anyone reaching the port!'
+        serve.add_argument('--allow-remote', action='store_true', help=serve_allow_remote_help)
+
+        serve_port_help = 'TCP port to listen on. Default: 8642'
+        serve.add_argument('--port', type=int, default=8642, help=serve_port_help)
+
+        serve_socket_help = 'Listen on unix socket path instead of TCP port'
+        serve.add_argument('--socket', help=serve_socket_help)
+
+        serve_max_jobs_help = 'Maximum number of jobs running at once. Default: 4'
+        serve.add_argument('--max-jobs', type=int, default=4, help=serve_max_jobs_help)
+
+        serve_config_limit_help = 'Maximum number of jobs running at once for the same configuration. Default: 1'
+        serve.add_argument('--per-config', type=int, default=1, help=serve_config_limit_help)
+
+        serve_device_limit_help = 'Maximum number of jobs running at once for the same flashed device. Default: 1'
+        serve.add_argument('--per-device', type=int, default=1, help=serve_device_limit_help)
+
         parser.add_argument('--version', action='store_true',  default='', help="Show version")
         
         return parser
 
     def check_optional_arguments(self):
         if self.args.ab_partition == True and self.config['storage'] != 'nvme':
-            print("AB partition is allowed only for nvme devices! (%s)" % self.config['storage'])
-            print("Exitting!")
-            exit(6)
+            raise ConfigError("AB partition is allowed only for nvme devices! (%s)" % self.config['storage'], 6)
 
         if self.args.rootfs is not None and self.args.app_size is None:
             print('''
@@ -284,10 +2340,20 @@ class DcsDeploy:
                   You may get 'No space left on device' error while flashing custom rootfs.
                   ''')
 
+        if self.args.unit is None and (self.args.unit_params is not None or self.args.unit_files is not None):
+            raise ConfigError("--unit_params and --unit_files need --unit!", 15)
+
+        if self.args.unit is not None and self.args.unit_params is not None:
+            try:
+                units = UnitPayload.load_units(self.args.unit_params)
+            except (OSError, ValueError) as e:
+                raise ConfigError("Could not load unit parameters: %s" % str(e), 15)
+            if self.args.unit not in units:
+                raise ConfigError("Unit %s is not listed in %s!" % (self.args.unit, self.args.unit_params), 15)
+
     def process_optional_args(self):
         if self.args.version == True:
-            print("dcs_deploy version: " + dcs_deploy_version)
-            exit(0)
+            raise UsageError("dcs_deploy version: " + dcs_deploy_version, 0)
     
     def sanitize_args(self):
         """
@@ -296,9 +2362,10 @@ class DcsDeploy:
         if self.args.command is None:
             print("No command specified!")
             self.parser.print_usage()
-            quit()
+            raise UsageError("", 0)
 
-    def load_db(self):
+    @staticmethod
+    def load_db() -> dict:
         """ 
         Load db from server. 
         Warning! currently it is local file!
@@ -306,17 +2373,56 @@ class DcsDeploy:
         try:
             db_file = open('local/config_db.json')
         except Exception as e:
-            print("could not open local/config_db.json!" + str(e))
-            print("exitting!")
-            exit(2)
+            raise ConfigError("could not open local/config_db.json!" + str(e), 2)
 
-        self.config_db = json.load(db_file)
+        with db_file:
+            config_db = json.load(db_file)
         # unify specific parameters into list
         update_to_list_fields = ['device', 'board', 'board_expansion', 'storage']
-        for config in self.config_db:
+        for config in config_db:
             for update_field in update_to_list_fields:
-                if (type(self.config_db[config][update_field]) is not list):
-                    self.config_db[config][update_field] = [self.config_db[config][update_field]]
+                if (type(config_db[config][update_field]) is not list):
+                    config_db[config][update_field] = [config_db[config][update_field]]
+        # resources with mirrors are given as list of URLs or {"urls": [...], "sha256": ...},
+        # the first URL stays in place of the resource (it gives the download path)
+        for config in config_db:
+            for res_name in RESOURCE_KEYS:
+                resource = config_db[config].get(res_name)
+                if type(resource) is list:
+                    resource = {"urls": resource}
+                if type(resource) is dict:
+                    config_db[config][res_name] = resource["urls"][0]
+                    config_db[config].setdefault("resource_sources", {})[res_name] = {
+                        "urls": resource["urls"], "sha256": resource.get("sha256")}
+        return config_db
+
+    def load_site_mirrors(self) -> dict:
+        """
+        Load mirrors of this site from ~/.dcs_deploy/mirrors.json: {"<URL prefix>": ["<mirror URL prefix>", ...]}.
+        """
+        if not hasattr(self, "site_mirrors"):
+            self.site_mirrors = {}
+            mirrors_path = os.path.join(self.dsc_deploy_root, 'mirrors.json')
+            if os.path.isfile(mirrors_path):
+                try:
+                    with open(mirrors_path) as mirrors_file:
+                        self.site_mirrors = json.load(mirrors_file)
+                except (OSError, ValueError) as e:
+                    print("Could not load %s: %s" % (mirrors_path, str(e)))
+        return self.site_mirrors
+
+    def get_download_sources(self, config:dict, res_name:str, url:str):
+        """
+        Get mirrors of resource url (from config_db and site mirrors) and expected sha256 of the file.
+        """
+        sources = config.get("resource_sources", {}).get(res_name, {})
+        urls = sources.get("urls", [url])
+        for prefix, mirror_prefixes in self.load_site_mirrors().items():
+            for source_url in list(urls):
+                if source_url.startswith(prefix):
+                    urls = urls + [mirror_prefix + source_url[len(prefix):] for mirror_prefix in mirror_prefixes]
+        mirrors = [mirror for mirror in dict.fromkeys(urls) if mirror != url]
+        return mirrors, sources.get("sha256")
                 
     def loading_animation(self, event):
         """Just animate rotating line - | / — \
@@ -361,12 +2467,37 @@ class DcsDeploy:
 
     def cleanup_old_download_dir(self):
         old_download_dir = self.config['device'] + '_' + self.config['storage'] + '_' + self.config['board'] + '_' + self.config['board_expansion'] + '_'
-        
-        for dir in [f for f in os.listdir(self.download_path) if not os.path.isfile(f)]:
+
+        # cleanup is done only by one process, others can skip it
+        cleanup_lock = self.get_lock("download_cleanup", shared=False)
+        if not cleanup_lock.acquire(blocking=False):
+            return
+        for dir in [f for f in os.listdir(self.download_path) if not os.path.isfile(os.path.join(self.download_path, f))]:
             if old_download_dir in dir:
                 del_dir = self.download_path + "/" + dir
                 print("download dir to delete: " + del_dir)
                 cmd_exec("rm -rf " + del_dir)
+        cleanup_lock.release()
+
+    def get_lock(self, name:str, shared = False, description:str = None) -> FileLock:
+        """
+        Get lock for named resource. Paths are hashed, so locks for downloaded files
+        and flash directories do not clash with the files themselves.
+        """
+        if os.path.isabs(name):
+            lock_name = hashlib.sha1(name.encode()).hexdigest()[:16] + "_" + os.path.basename(name)
+        else:
+            lock_name = name
+        return FileLock(os.path.join(self.dsc_deploy_root, 'locks', lock_name + ".lock"), shared, description)
+
+    def get_resource_lock(self, resource_path:str, shared = False) -> FileLock:
+        return self.get_lock(resource_path, shared, "downloaded file " + resource_path)
+
+    def init_root_paths(self):
+        self.home = os.path.expanduser('~')
+        self.dsc_deploy_root = os.path.join(self.home, '.dcs_deploy')
+        self.download_path = os.path.join(self.dsc_deploy_root, 'download')
+        self.transcode_path = os.path.join(self.dsc_deploy_root, 'transcoded')
 
     def init_filesystem(self):
         config_relative_path = (
@@ -378,9 +2509,6 @@ class DcsDeploy:
             self.config['rootfs_type']
         )
 
-        self.home = os.path.expanduser('~')
-        self.dsc_deploy_root = os.path.join(self.home, '.dcs_deploy')
-        self.download_path = os.path.join(self.dsc_deploy_root, 'download')
         self.flash_path = os.path.join(self.dsc_deploy_root, 'flash', config_relative_path)
         self.rootfs_extract_dir = os.path.realpath(os.path.join(self.flash_path, 'Linux_for_Tegra', 'rootfs'))
         self.l4t_root_dir = os.path.realpath(os.path.join(self.flash_path, 'Linux_for_Tegra'))
@@ -388,23 +2516,17 @@ class DcsDeploy:
         self.create_user_script_path = os.path.join(self.l4t_root_dir, 'tools', 'l4t_create_default_user.sh')
 
         # generate download resource paths
-        resource_keys = ["rootfs", "l4t", "nvidia_overlay", "airvolute_overlay", "nv_ota_tools"]
         self.resource_paths = {}
 
-        for res_name in resource_keys:
+        for res_name in RESOURCE_KEYS:
             #print(" %s key: %s" % (res_name, self.config[res_name]))
             if res_name == "rootfs" and self.args.rootfs is not None:
-                if os.path.exists(self.args.rootfs):
-                    self.resource_paths[res_name] = self.args.rootfs
-                else:
-                    print(f"Error: The specified rootfs path does not exist: {self.args.rootfs}")
-                    exit(1)
-                self.resource_paths[res_name] = self.args.rootfs
+                self.rootfs_source = RootfsSource(self.args.rootfs)
+                self.resource_paths[res_name] = self.rootfs_source.path
                 continue
             self.resource_paths[res_name] = self.get_download_file_path(self.get_resource_url(res_name))
 
-        if not os.path.isdir(self.download_path):
-            os.makedirs(self.download_path)
+        os.makedirs(self.download_path, exist_ok=True)
 
         # remove old download directories
         self.cleanup_old_download_dir()
@@ -413,16 +2535,22 @@ class DcsDeploy:
             self.device_type = 't194'
 
         # Handle dcs-deploy root dir
-        if not os.path.isdir(self.dsc_deploy_root):
-            os.mkdir(self.dsc_deploy_root)
+        os.makedirs(self.dsc_deploy_root, exist_ok=True)
+
+        # collect trash of interrupted runs
+        self.empty_trash()
 
         # create dcs-deploy download dir
         for key in self.resource_paths:
-            if self.resource_paths[key] == "":
+            if self.resource_paths[key] == "" or (key == "rootfs" and self.args.rootfs is not None):
                 continue
             if not os.path.isdir(os.path.dirname(self.resource_paths[key])):
                 print("Creating directory: ",self.resource_paths[key])
-                os.makedirs(os.path.dirname(self.resource_paths[key]))
+                os.makedirs(os.path.dirname(self.resource_paths[key]), exist_ok=True)
+
+        # flash dir is used exclusively till the end of the process
+        self.flash_lock = self.get_lock(self.flash_path, description="flash directory " + self.flash_path)
+        self.flash_lock.acquire()
 
         # Handle dcs-deploy flash dir
         if not os.path.isdir(self.flash_path):
@@ -431,15 +2559,246 @@ class DcsDeploy:
             print('Removing previous L4T folder ...')
             self.cleanup_flash_dir()
 
-        self.prepare_status = ProcessingStatus(os.path.join(self.flash_path, "prepare_status.json"), initial_group="prepare")
+        device = self.args.usb_instance if self.args.usb_instance is not None else ""
+        metrics_name = "_".join(filter(None, [self.args.command, config_relative_path, device]))
+        self.metrics = DeployMetrics(self.args.metrics_dir, metrics_name, {
+            "config": self.selected_config_name,
+            "variant": config_relative_path,
+            "command": self.args.command,
+            "device": device,
+            "host": socket.gethostname(),
+            "version": dcs_deploy_version,
+        }, os.path.join(self.dsc_deploy_root, 'metrics'))
+
+        self.prepare_status = ProcessingStatus(os.path.join(self.flash_path, "prepare_status.json"), initial_group="prepare",
+                                               default_identifier=self.get_status_identifier(), metrics=self.metrics)
+
+        # account use of cached files and keep cache in quota
+        self.cache = DeployCache(self)
+        used_paths = [self.flash_path] + [self.resource_paths[key] for key in self.resource_paths]
+        used_paths += [path for path in map(self.get_transcoded_path, self.resource_paths) if path is not None]
+        self.cache.touch(used_paths, self.selected_config_name)
+        quota = self.cache.get_quota()
+        if quota is not None:
+            self.cache.gc(quota, protect=used_paths, compute_sizes=False)
+
+    def get_status_identifier(self):
+        """
+        Identifier of prepared files is built from command line arguments.
+        Options which do not change prepared files (eg. which usb device is flashed) are left out.
+        """
+        runtime_only_options = ['--usb_instance', '--staging_writeback', '--unit', '--unit_params', '--unit_template', '--unit_files',
+                                '--target', '--targets', '--jobs', '-j', '--metrics_dir',
+                                '--extract_jobs', '--transcode']
+        runtime_only_flags = ['--tmpfs_staging', '--refresh']
+        identifier = []
+        skip_value = False
+        for arg in self.argv:
+            if skip_value:
+                skip_value = False
+                continue
+            if arg in runtime_only_flags:
+                continue
+            if arg in runtime_only_options:
+                skip_value = True
+                continue
+            if arg.split('=')[0] in runtime_only_options:
+                continue
+            identifier.append(arg)
+        if self.uses_unit_placeholder() and '--unit_placeholder' not in identifier:
+            identifier.append('--unit_placeholder')
+        # images command prepares the same flash tree as flash command
+        if len(identifier) > 0 and identifier[0] == 'images':
+            identifier[0] = 'flash'
+        return identifier
     
     def cleanup_flash_dir(self):
             print("cleanup_flash_dir...")
-            cmd_exec(f"sudo rm -rf {self.flash_path} && sync")
+            self.unmount_targets()
+            if os.path.ismount(self.flash_path):
+                # flash dir staged in memory can not be moved, deleting in memory is fast
+                if self.unmount_tree(self.flash_path, include_root=False) != 0:
+                    raise StepError("Could not unmount filesystems mounted in %s!" % self.flash_path)
+                cmd_exec(f"sudo find {self.flash_path} -xdev -mindepth 1 -delete")
+            elif self.move_to_trash(self.flash_path) != 0:
+                raise StepError("Could not remove previous flash directory %s!" % self.flash_path)
             print("creating: " + self.flash_path)
-            os.makedirs(self.flash_path)
+            os.makedirs(self.flash_path, exist_ok=True)
+
+    def move_to_trash(self, path:str):
+        """
+        Atomically move directory into trash on the same filesystem and delete it in background.
+        Deleting big flash tree takes long time, so the run does not wait for it.
+        Filesystems mounted in the tree (eg. /dev, /proc of chroot left by killed run) are unmounted
+        first, the tree is not touched when they can not be unmounted.
+        """
+        if not os.path.lexists(path):
+            return 0
+        if self.unmount_tree(path) != 0:
+            print("Could not unmount filesystems mounted in %s, it is not deleted!" % path)
+            return 1
+        trash_path = os.path.join(self.dsc_deploy_root, 'trash')
+        os.makedirs(trash_path, exist_ok=True)
+        trash_item = os.path.join(trash_path, "%s.%d.%d" % (os.path.basename(path), time.time(), os.getpid()))
+        try:
+            os.rename(path, trash_item)
+        except PermissionError:
+            if cmd_exec(f"sudo mv {path} {trash_item}") != 0:
+                return cmd_exec(f"sudo rm -rf --one-file-system {path}")
+        except OSError as e:
+            # eg. path is on another filesystem
+            print("Could not move %s to trash (%s), deleting it." % (path, str(e)))
+            return cmd_exec(f"sudo rm -rf --one-file-system {path}")
+        self.empty_trash()
+        return 0
 
-    def check_dependencies(self):
+    @staticmethod
+    def get_mounts(path:str, include_root:bool = True) -> list:
+        """
+        Get mount points in directory tree, deepest first. Mount point stacked several times is listed several times.
+        """
+        root = os.path.realpath(path)
+        mounts = []
+        with open("/proc/self/mounts") as mounts_file:
+            for line in mounts_file:
+                # spaces and other special characters are octal escaped
+                mount_point = re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), line.split()[1])
+                if (mount_point == root and include_root) or mount_point.startswith(root + "/"):
+                    mounts.append(mount_point)
+        return sorted(mounts, reverse=True)
+
+    def unmount_tree(self, path:str, include_root:bool = True) -> int:
+        """
+        Unmount everything mounted in directory tree. Returns non-zero when something stays mounted.
+        """
+        mounts = self.get_mounts(path, include_root)
+        if len(mounts) == 0:
+            return 0
+        print("Unmounting filesystems mounted in %s: %s" % (path, " ".join(sorted(set(mounts)))))
+        while len(mounts) > 0:
+            for mount_point in mounts:
+                cmd_exec(f"sudo umount \"{mount_point}\"", print_command=True)
+            remaining = self.get_mounts(path, include_root)
+            if len(remaining) >= len(mounts):
+                return 1
+            mounts = remaining
+        return 0
+
+    def empty_trash(self):
+        """
+        Start background worker deleting trash with low CPU and I/O priority. The worker outlives
+        the run. Only one worker runs at once (it holds flock on the trash directory), it deletes
+        everything moved to trash until the trash is empty. The worker stops when something can not
+        be deleted (mountpoint, busy or immutable file), it is tried again by the worker of the next run.
+        """
+        trash_path = os.path.join(self.dsc_deploy_root, 'trash')
+        if not os.path.isdir(trash_path) or len(os.listdir(trash_path)) == 0:
+            return
+        # make sure sudo does not ask for password in background
+        cmd_exec("/usr/bin/sudo /usr/bin/id > /dev/null")
+        # trash never crosses into mounted filesystem (eg. host /dev bound into rootfs),
+        # find also deletes entries starting with a dot
+        trash = shlex.quote(trash_path)
+        worker = (f'while [ -n "$(ls -A {trash})" ]; do '
+                  f'find {trash} -mindepth 1 -maxdepth 1 -exec rm -rf --one-file-system -- {{}} + || exit 1; done')
+        try:
+            # own process group, so Ctrl+C of the run does not stop the worker
+            subprocess.Popen(["sudo", "-n", "flock", "-n", trash_path, "ionice", "-c3", "nice", "-n19", "sh", "-c", worker],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             preexec_fn=os.setpgrp)
+        except OSError as e:
+            print("Could not start trash worker: %s" % str(e))
+
+    def get_available_memory(self) -> int:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def get_staging_size(self):
+        """
+        Estimate size of flash tree: extracted resources and generated images (APP partition image
+        is roughly as big as the rootfs and it is created twice - raw and sparse). Only existing
+        archive indexes are used, the size is not known before the first extraction of the archives.
+        """
+        if self.args.rootfs is not None and not self.rootfs_source.is_archive():
+            return None
+        extracted = 0
+        rootfs = 0
+        for resource in self.resource_paths:
+            if self.resource_paths[resource] == "" or not os.path.isfile(self.resource_paths[resource]):
+                continue
+            index = self.get_archive_index(resource, build=False)
+            if index is None:
+                return None
+            extracted += index.required_space()
+            if resource == "rootfs":
+                rootfs = index.required_space()
+        return extracted + 2 * rootfs
+
+    def setup_staging(self):
+        """
+        Build flash tree in RAM. tmpfs is mounted over flash directory, so all paths stay the same.
+        Falls back to disk when there is not enough memory.
+        """
+        self.staging = False
+        if os.path.ismount(self.flash_path):
+            print("Flash directory is already staged in memory: " + self.flash_path)
+            self.staging = True
+            return True
+
+        reserve = 4 * 1024 ** 3
+        required = self.get_staging_size()
+        available = self.get_available_memory()
+        if required is None:
+            print("Size of flash tree is not known (archives are indexed on the first extraction), staging in memory is not used.")
+            return False
+        if required + reserve > available:
+            print("Not enough memory to stage flash tree in memory (required: %s, available: %s). Using disk." % (
+                format_size(required + reserve), format_size(available)))
+            return False
+
+        print("Staging flash tree in memory (%s of %s available) ..." % (format_size(required), format_size(available)))
+        ret = cmd_exec(f"sudo mount -t tmpfs -o size={available - reserve},mode=0755 dcs_deploy_staging {self.flash_path}", print_command=True)
+        if ret != 0:
+            print("Could not mount tmpfs, using disk.")
+            return False
+        cmd_exec(f"sudo chown {os.getuid()}:{os.getgid()} {self.flash_path}")
+        self.staging = True
+        return True
+
+    def finish_staging(self):
+        """
+        Write staged flash tree (or only generated images without rootfs) back to disk and release memory.
+        """
+        if not getattr(self, "staging", False):
+            return 0
+        self.staging = False
+        writeback = self.args.staging_writeback
+        ret = 0
+        if writeback == "none":
+            print("Discarding flash tree staged in memory.")
+            return cmd_exec(f"sudo umount {self.flash_path}", print_command=True)
+
+        writeback_path = self.flash_path + ".writeback"
+        exclude = ""
+        if writeback == "images":
+            exclude = "--exclude=./Linux_for_Tegra/rootfs"
+        print("Writing flash tree staged in memory to disk (%s) ..." % writeback)
+        self.move_to_trash(writeback_path)
+        os.makedirs(writeback_path)
+        ret = cmd_exec(f"sudo tar -C {self.flash_path} {exclude} -cf - . | sudo tar -C {writeback_path} -xpf -", print_command=True)
+        ret += cmd_exec(f"sudo umount {self.flash_path}", print_command=True)
+        if ret != 0:
+            print("Writing staged flash tree to disk failed! ret = %d" % ret)
+            return ret
+        self.move_to_trash(self.flash_path)
+        os.rename(writeback_path, self.flash_path)
+        return 0
+
+    @staticmethod
+    def check_dependencies():
         l4t_tool = ["abootimg", "binfmt-support", "binutils", "cpp", "device-tree-compiler", "dosfstools", "lbzip2",
                      "libxml2-utils", "nfs-kernel-server", "python3", "python3-yaml", "qemu-user-static", "sshpass",
                      "udev", "uuid-runtime", "whois", "openssl", "cpio", "lz4"]
@@ -458,9 +2817,7 @@ class DcsDeploy:
                 to_install.append(dependency)
 
         if len(to_install) != 0:
-            print("please install %s tools. eg: sudo apt-get install -y %s" % (to_install, " ".join(to_install)))
-            print("exitting!")
-            exit(1)
+            raise DependencyError("please install %s tools. eg: sudo apt-get install -y %s" % (to_install, " ".join(to_install)))
         return 0
 
 
@@ -475,16 +2832,25 @@ class DcsDeploy:
         return res
 
     def download_resources(self):
-        for missing_resource in self.get_missing_resources(force_all_missing = self.args.force):
+        missing_resources = self.get_missing_resources(force_all_missing = self.args.force or self.args.refresh)
+        for resource in self.resource_paths:
+            if resource not in missing_resources and self.get_resource_url(resource) != None:
+                self.metrics.cache_access("download", True, resource=resource)
+        for missing_resource in missing_resources:
             if missing_resource == "rootfs" and self.args.rootfs is not None:
                 print("rootfs will not be downloaded, because you want to use custom rootfs.")
                 continue
             print("missing resource '%s'. Going to download it!" % missing_resource)
+            download_start = time.monotonic()
             ret = self.download_resource(missing_resource, self.resource_paths[missing_resource])
             if ret < 0:
-                print("can't download resource '" + missing_resource + "'!.")
-                print("exitting!")
-                exit(4)
+                raise DownloadError("can't download resource '" + missing_resource + "'!.")
+            self.metrics.cache_access("download", ret == 3, resource=missing_resource)
+            if ret == 3:
+                # downloaded file did not change
+                continue
+            self.metrics.transfer("download", missing_resource, os.path.getsize(self.resource_paths[missing_resource]),
+                                  time.monotonic() - download_start)
             # regenerate
             self.cleanup_flash_dir()
         print('Resources for your config are already downloaded!')
@@ -496,67 +2862,243 @@ class DcsDeploy:
             return None
         return url
 
-    def download_resource(self, resource_name, dst_path):
-        if resource_name  not in self.config:
-            return 1
-        if self.get_resource_url(resource_name) == None:
+    def download_resource(self, resource_name, dst_path, url = None, config:dict = None):
+        if config is None:
+            config = self.config
+        if url is None:
+            if resource_name  not in self.config:
+                return 1
+            url = self.get_resource_url(resource_name)
+        if url == None:
             print("Skipping downloading resource" + resource_name)
             return 2
-        print("Downloading %s:" % resource_name)
-        # remove any existing temporary files
-        cmd_exec("rm -f " + dst_path + "*.tmp")
+        existed = os.path.isfile(dst_path)
+        with self.get_resource_lock(dst_path):
+            if not existed and os.path.isfile(dst_path):
+                print("Resource %s was downloaded by another dcs_deploy process." % resource_name)
+                return 0
+            return self._download_resource_locked(resource_name, dst_path, url, config)
+
+    def _download_resource_locked(self, resource_name, dst_path, url, config):
+        """
+        Returns 0 when the file was downloaded, 3 when already downloaded file is up to date, -1 on error.
+        """
+        mirrors, sha256 = self.get_download_sources(config, resource_name, url)
+        # remove partial file of interrupted download
+        remove_partial_download(dst_path)
 
         #check if file already exist
-        if os.path.isfile(dst_path) and self.args.force == False:
-            yes = yes_no_question("Downloaded file %s already exist! Would you like to download it again? " % dst_path)
-            if yes == False:
-                return 0
         if os.path.isfile(dst_path):
-            print("removing existing file! " + dst_path)
-            cmd_exec(f"rm '{dst_path}'", print_command=True)
-        try:
-            wget.download(
-                self.config[resource_name],
-                dst_path
-            )
-        except Exception as e:
-            print("Got error while downloading resource", resource_name, "Error: ", str(e))
-            print("download params: %s, %s" %(self.config[resource_name], dst_path))
+            if self.args.force == False and self.args.refresh == False:
+                print("Downloaded file %s already exist, using it." % dst_path)
+                return 3
+            try:
+                changed = is_download_changed(url, dst_path, sha256)
+            except Exception as e:
+                print("Could not check whether %s changed (%s), using downloaded file." % (url, str(e)))
+                return 3
+            if not changed:
+                print("Downloaded file %s is up to date." % dst_path)
+                return 3
+            print("Upstream file changed, downloading it again! " + dst_path)
+
+        print("Downloading %s:" % resource_name)
+        if download_file(url, dst_path, mirrors=mirrors, sha256=sha256) != 0:
+            print("Got error while downloading resource", resource_name)
+            print("download params: %s, %s" %(url, dst_path))
             return -1
-        print()
         return 0
 
-    def extract_resource(self, resource, extract_path = None, need_sudo = False):
-        if extract_path == None:
-            extract_path = self.flash_path
-        stop_event = Event()
-        print('Extracting ' + resource + " ... (" + self.resource_paths[resource] + ")" )
-        self.prepare_status.set_processing_step("extract_" + resource)
-        if need_sudo:
-            print('This part needs sudo privilegies:')
-            # Run sudo identification
-            cmd_exec("/usr/bin/sudo /usr/bin/id > /dev/null")
-        stop_event.clear()
-        l4t_animation_thread = self.run_loading_animation(stop_event)
-        ret = extract(self.resource_paths[resource], extract_path)
-        self.prepare_status.set_status(ret)
-        stop_event.set()
-        l4t_animation_thread.join()
-        return ret
-        
+    def extract_resource(self, resource, extract_path = None, need_sudo = False):
+        if extract_path == None:
+            extract_path = self.flash_path
+        stop_event = Event()
+        print('Extracting ' + resource + " ... (" + self.resource_paths[resource] + ")" )
+        self.prepare_status.set_processing_step("extract_" + resource)
+        if need_sudo:
+            print('This part needs sudo privilegies:')
+            # Run sudo identification
+            cmd_exec("/usr/bin/sudo /usr/bin/id > /dev/null")
+        extract_start = time.monotonic()
+        extracted_size = None
+        # downloaded file must not be replaced by another process while extracting
+        with self.get_resource_lock(self.resource_paths[resource], shared=True):
+            source_path = self.get_transcoded_path(resource)
+            self.metrics.cache_access("transcoded", source_path is not None, resource=resource)
+            if source_path is None:
+                source_path = self.resource_paths[resource]
+            else:
+                print("Using transcoded archive " + source_path)
+            # transcoded copy must not be evicted from cache while extracting
+            with self.get_resource_lock(source_path, shared=True):
+                # extraction profile needs members of the archive before extracting
+                needs_index = resource == "rootfs" and self.get_extract_profile() is not None
+                index = self.get_archive_index(resource, build=needs_index)
+                if index is None:
+                    building = None
+                    if resource not in self.archive_indexes:
+                        building = ArchiveIndex(self.resource_paths[resource])
+                    stop_event.clear()
+                    l4t_animation_thread = self.run_loading_animation(stop_event)
+                    ret = extract(source_path, extract_path, jobs=self.args.extract_jobs, index=building)
+                    stop_event.set()
+                    l4t_animation_thread.join()
+                    if building is not None and building.index is not None:
+                        self.archive_indexes[resource] = building
+                        extracted_size = building.total_size
+                else:
+                    excluded, exclude_file = self.apply_extract_profile(resource, index)
+                    if not self.check_extract_space(index, extract_path, excluded):
+                        self.prepare_status.set_status(-1)
+                        raise DiskSpaceError("Not enough space to extract %s!" % resource)
+                    ret = extract(source_path, extract_path, index.stream_size, exclude_file, self.args.extract_jobs)
+                    extracted_size = index.total_size
+        if ret == 0 and extracted_size is not None:
+            self.metrics.transfer("extract", resource, extracted_size, time.monotonic() - extract_start)
+        if ret == 0 and source_path == self.resource_paths[resource] and self.args.transcode is not None:
+            self.start_transcode(resource)
+        self.prepare_status.set_status(ret)
+        return ret
+
+    def get_transcoded_path(self, resource:str) -> str:
+        """
+        Get path of transcoded copy of resource archive, None when it was not transcoded (yet).
+        """
+        return ArchiveTranscoder(self.resource_paths[resource], self.transcode_path).find()
+
+    def start_transcode(self, resource:str):
+        """
+        Start background worker transcoding resource archive (see ArchiveTranscoder). The worker
+        outlives the run and runs with low CPU and I/O priority.
+        """
+        archive_path = self.resource_paths[resource]
+        if ArchiveTranscoder.get_decompress_command(archive_path) is None:
+            return
+        log_path = os.path.join(self.transcode_path, 'transcode.log')
+        os.makedirs(self.transcode_path, exist_ok=True)
+        _sys.stdout.flush()
+        pid = os.fork()
+        if pid != 0:
+            # worker forks again, so it is not left as zombie of this process
+            os.waitpid(pid, 0)
+            print("Transcoding %s in background, log: %s" % (archive_path, log_path))
+            return
+        ret = 1
+        try:
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0)
+            # do not keep flock of inherited descriptors (eg. flash directory lock) while transcoding
+            os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+            log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            null_fd = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null_fd, 0)
+            os.dup2(log_fd, 1)
+            os.dup2(log_fd, 2)
+            os.close(null_fd)
+            os.close(log_fd)
+            _sys.stdout.reconfigure(line_buffering=True)
+            os.nice(19)
+            cmd_exec("ionice -c3 -p %d > /dev/null 2>&1" % os.getpid(), print_command=False)
+            print(time.strftime("%Y-%m-%d %H:%M:%S"), end=" ")
+            with self.get_resource_lock(archive_path, shared=True):
+                ret = ArchiveTranscoder(archive_path, self.transcode_path).transcode(self.args.transcode)
+        except BaseException as e:
+            print("Transcoding of %s failed: %s" % (archive_path, str(e)))
+        finally:
+            os._exit(ret)
+
+    def get_archive_index(self, resource:str, build = True) -> ArchiveIndex:
+        """
+        Get index of resource archive cached next to the archive. Missing index is built when build
+        is set, otherwise None is returned and the index is built while extracting the archive.
+        """
+        if not hasattr(self, "archive_indexes"):
+            self.archive_indexes = {}
+        if resource not in self.archive_indexes:
+            index = ArchiveIndex(self.resource_paths[resource])
+            try:
+                if not index.load():
+                    if not build:
+                        return None
+                    index.build()
+                self.archive_indexes[resource] = index
+            except (OSError, tarfile.TarError) as e:
+                print("Could not index archive %s: %s" % (self.resource_paths[resource], str(e)))
+                self.archive_indexes[resource] = None
+        return self.archive_indexes[resource]
+
+    def resource_contains(self, resource:str, path:str) -> bool:
+        """
+        Check whether resource archive contains path (eg. "/etc/nv_tegra_release") without extracting it.
+        """
+        index = self.get_archive_index(resource)
+        return index is not None and index.contains(path)
+
+    def get_extract_profile(self):
+        """
+        Extraction profile is selected by --extract_profile or by "extract_profile" of config entry.
+        """
+        name = self.args.extract_profile
+        if name is None:
+            name = self.config.get("extract_profile")
+        if name is None or name == "none" or name == "":
+            return None
+        profile = ExtractProfile.load(name)
+        if profile is None:
+            raise ConfigError("Unknown extraction profile '%s'! Available profiles: %s" % (name, ExtractProfile.list_names()), 14)
+        return profile
+
+    def apply_extract_profile(self, resource:str, index:ArchiveIndex):
+        """
+        Get members excluded from extraction of resource and tar exclude file. Profiles apply only to rootfs.
+        """
+        profile = self.get_extract_profile()
+        if resource != "rootfs" or profile is None:
+            return set(), None
+        excluded, excluded_roots = profile.get_excluded(index)
+        exclude_file = os.path.join(self.flash_path, "extract_excludes_%s.txt" % resource)
+        profile.write_exclude_file(excluded_roots, exclude_file)
+        saved_size = sum(member[ArchiveIndex.SIZE] for member in index.members() if member[ArchiveIndex.NAME] in excluded)
+        print("Extraction profile '%s' (%s) skips %d members, %s of %s" % (
+            profile.name, profile.description, len(excluded), format_size(saved_size), format_size(index.total_size)))
+        return excluded, exclude_file
+
+    def check_extract_space(self, index:ArchiveIndex, extract_path:str, excluded:set = None) -> bool:
+        existing_path = extract_path
+        while not os.path.isdir(existing_path):
+            existing_path = os.path.dirname(existing_path)
+        free = shutil.disk_usage(existing_path).free
+        required = index.required_space(excluded=excluded)
+        print("Extracting %d files, %s (free space: %s)" % (index.file_count, format_size(required), format_size(free)))
+        if free < required:
+            print("Not enough space on disk to extract %s into %s! Required: %s, free: %s" % (
+                index.archive_path, extract_path, format_size(required), format_size(free)))
+            return False
+        return True
+
 
     def prepare_sources_production(self):
         if self.prepare_status.get_status() == True and self.prepare_status.is_identifier_same_as_prev(["--regen", "--force"]):
             print("Binaries already prepared!. Skipping!")
+            self.metrics.cache_access("flash_tree", True)
             return 0
         else:
+            self.metrics.cache_access("flash_tree", False)
             self.cleanup_flash_dir()
+            if self.args.tmpfs_staging:
+                self.setup_staging()
             self.prepare_status.load()
 
         # Extract Linux For Tegra
         self.extract_resource("l4t")
         # Extract Root Filesystem
-        self.extract_resource("rootfs", self.rootfs_extract_dir, need_sudo=True)
+        if self.args.rootfs is not None and not self.rootfs_source.is_archive():
+            self.populate_custom_rootfs()
+        else:
+            self.extract_resource("rootfs", self.rootfs_extract_dir, need_sudo=True)
+            if self.args.rootfs is not None:
+                self.check_custom_rootfs()
         # Extract Nvidia overlay if needed
         if self.get_resource_url('nvidia_overlay') != None:
             print('Applying Nvidia overlay ...')
@@ -595,8 +3137,82 @@ class DcsDeploy:
                  os.path.join(self.rootfs_extract_dir, 'home', 'dcs_user','.ssh'))
 
 
-        print('Installing overlays ...')
-        ret = self.install_overlays(is_last_install_step = True)
+        # rootfs commands of overlays and provisioning run in one chroot session
+        with ChrootSession(self.rootfs_extract_dir, os.path.join(self.flash_path, 'chroot_queue.sh')) as session:
+            self.chroot_env = ""
+            if session.is_open():
+                self.chroot_env = "DCS_CHROOT_QUEUE=" + session.queue_path + " "
+                self.chroot_queue = session.queue_path
+
+            print('Installing overlays ...')
+            ret = self.install_overlays()
+
+            # Setup normally done at the first boot of the device
+            print('Provisioning rootfs ...')
+            self.prepare_status.set_processing_step("provision_rootfs")
+            ret = cmd_exec("sudo " + self.chroot_env + "resources/provision_rootfs.sh " + self.rootfs_extract_dir)
+            self.prepare_status.set_status(ret)
+
+            if session.is_open():
+                print('Running queued rootfs commands in chroot ...')
+                self.prepare_status.set_processing_step("chroot_commands")
+                ret = session.run_queue()
+                self.prepare_status.set_status(ret)
+            self.chroot_env = ""
+            self.chroot_queue = None
+
+        # Space for per-unit payload written into generated images at flash time
+        if self.uses_unit_placeholder():
+            self.prepare_status.set_processing_step("unit_payload_placeholder")
+            ret = self.create_unit_placeholder()
+            self.prepare_status.set_status(ret)
+        self.prepare_status.check_status()
+        self.prepare_status.save()
+
+    def uses_unit_placeholder(self) -> bool:
+        """
+        Placeholder of the unit payload is put into rootfs only for configurations prepared for
+        personalised units, flashing with --unit implies it.
+        """
+        return self.args.unit_placeholder or self.args.unit is not None
+
+    def create_unit_placeholder(self) -> int:
+        tmp_path = os.path.join(tempfile.gettempdir(), "dcs_deploy_unit_payload.%d.tmp" % os.getpid())
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(UnitPayload.placeholder())
+        try:
+            placeholder_path = os.path.join(self.rootfs_extract_dir, UnitPayload.PLACEHOLDER_PATH)
+            return cmd_exec(f"sudo install -D -m 600 -o root -g root {tmp_path} {placeholder_path}")
+        finally:
+            os.remove(tmp_path)
+
+    def populate_custom_rootfs(self):
+        """
+        Copy custom rootfs given as directory, rsync source or ext4 image into the flash tree.
+        """
+        print('This part needs sudo privilegies:')
+        # Run sudo identification
+        cmd_exec("/usr/bin/sudo /usr/bin/id > /dev/null")
+        self.prepare_status.set_processing_step("copy_rootfs")
+        copy_start = time.monotonic()
+        ret = self.rootfs_source.populate(self.rootfs_extract_dir, self.args.extract_jobs)
+        if ret == 0:
+            self.metrics.transfer("extract", "rootfs", self.cache.get_size(self.rootfs_extract_dir), time.monotonic() - copy_start)
+        self.prepare_status.set_status(ret)
+        if not os.path.isfile(os.path.join(self.rootfs_extract_dir, 'etc', 'nv_tegra_release')):
+            print("WARNING! Custom rootfs does not contain /etc/nv_tegra_release. Is it rootfs from Jetson device?")
+        return ret
+
+    def check_custom_rootfs(self):
+        index = self.get_archive_index("rootfs", build=False)
+        if index is None:
+            return
+        if not index.contains("/etc/nv_tegra_release"):
+            print("WARNING! Custom rootfs does not contain /etc/nv_tegra_release. Is it rootfs from Jetson device?")
+        if self.args.app_size is None:
+            # APP partition has to fit the rootfs with some reserve
+            app_size = -(-index.required_space() * 12 // 10 // (1024 ** 3))
+            print("Custom rootfs needs %s. Consider using --app_size %d" % (format_size(index.required_space()), app_size))
 
     def prepare_airvolute_overlay(self):
         return self.extract_resource('airvolute_overlay')
@@ -612,13 +3228,17 @@ class DcsDeploy:
         if self.selected_config_name != None:
             return self.selected_config_name
         
+        return self.find_config(self.args.target_device, self.args.jetpack, self.args.hwrev,
+                                self.args.board_expansion, self.args.storage, self.args.rootfs_type)
+
+    def find_config(self, target_device, jetpack, hwrev, board_expansion, storage, rootfs_type):
         for config in self.config_db:
-            if (self.args.target_device in self.config_db[config]['device'] and
-                self.args.jetpack == self.config_db[config]['l4t_version'] and
-                self.args.hwrev in self.config_db[config]['board'] and
-                self.args.board_expansion in self.config_db[config]['board_expansion'] and
-                self.args.storage in self.config_db[config]['storage'] and
-                self.args.rootfs_type == self.config_db[config]['rootfs_type']):
+            if (target_device in self.config_db[config]['device'] and
+                jetpack == self.config_db[config]['l4t_version'] and
+                hwrev in self.config_db[config]['board'] and
+                board_expansion in self.config_db[config]['board_expansion'] and
+                storage in self.config_db[config]['storage'] and
+                rootfs_type == self.config_db[config]['rootfs_type']):
                 return config
                 
         return None
@@ -647,8 +3267,7 @@ class DcsDeploy:
             overlay_path = os.path.join(self.local_overlay_dir, overlay_name)
 
             if not os.path.exists(overlay_path):
-                print(f"Overlay {overlay_name} does not exist! Quitting!")
-                quit()
+                raise ConfigError(f"Overlay {overlay_name} does not exist!", 1)
 
             if os.path.isdir(overlay_path):
                 dirs.append(item)
@@ -684,7 +3303,7 @@ class DcsDeploy:
             print(f"installing overlay {overlay} finished{with_error} ret:({ret})")
 
             if ret:
-                exit(10)
+                raise StepError(f"Overlay {overlay} failed!", 10)
 
         files = overlays["files"]
         cnt = len(files)
@@ -703,18 +3322,20 @@ class DcsDeploy:
             with_error = "." if not ret else " with error!"
             print(f"installing overlay {overlay} finished{with_error} ret:({ret})")
             if ret:
-                exit(11)
+                raise StepError(f"Overlay {overlay} failed!", 11)
 
     def install_overlay_file(self, overlay_name, custom_args=None):
         if custom_args is None:
             custom_args = {}
 
         overlay_script_name = os.path.join(self.local_overlay_dir, overlay_name)
+        if overlay_name.endswith(".py"):
+            return self.install_python_overlay(overlay_script_name, custom_args)
 
         custom_args_str = " ".join(f"{k}={v}" for k, v in custom_args.items())
 
         cmd = (
-            f"sudo {overlay_script_name} {self.rootfs_extract_dir} "
+            f"sudo {self.chroot_env}{overlay_script_name} {self.rootfs_extract_dir} "
             f"{self.args.target_device} {self.args.jetpack} {self.args.hwrev} {self.args.board_expansion} "
             f"{self.args.storage} {self.args.rootfs_type} {custom_args_str}"
         )
@@ -725,18 +3346,47 @@ class DcsDeploy:
         if custom_args is None:
             custom_args = {}
 
+        overlay_module_name = os.path.join(self.local_overlay_dir, overlay_name, "apply_" + overlay_name + ".py")
+        if os.path.isfile(overlay_module_name):
+            return self.install_python_overlay(overlay_module_name, custom_args)
+
         overlay_script_name = os.path.join(self.local_overlay_dir, overlay_name, "apply_" + overlay_name + ".sh")
 
         custom_args_str = " ".join(f"{k}={v}" for k, v in custom_args.items())
 
         cmd = (
-            f"sudo {overlay_script_name} {self.rootfs_extract_dir} "
+            f"sudo {self.chroot_env}{overlay_script_name} {self.rootfs_extract_dir} "
             f"{self.args.target_device} {self.args.jetpack} {self.args.hwrev} {self.args.board_expansion} "
             f"{self.args.storage} {self.args.rootfs_type} {custom_args_str}"
         )
         ret = cmd_exec(cmd, print_command=True)
         return ret
 
+    def install_python_overlay(self, overlay_path, custom_args):
+        """
+        Apply LocalOverlay class of overlay_path (see local/overlays/lib/dcs_overlay.py). All file
+        operations of the overlay run in one process: in this one when running as root, otherwise
+        in dcs_overlay.py started by sudo.
+        """
+        if os.geteuid() != 0:
+            custom_args_str = " ".join(f"{k}={v}" for k, v in custom_args.items())
+            cmd = (
+                f"sudo {self.chroot_env}python3 -B {os.path.join(OVERLAY_LIB_PATH, 'dcs_overlay.py')} {overlay_path} "
+                f"{self.rootfs_extract_dir} {self.args.target_device} {self.args.jetpack} {self.args.hwrev} "
+                f"{self.args.board_expansion} {self.args.storage} {self.args.rootfs_type} {custom_args_str}"
+            )
+            return cmd_exec(cmd, print_command=True)
+
+        if OVERLAY_LIB_PATH not in _sys.path:
+            _sys.path.insert(0, OVERLAY_LIB_PATH)
+        import dcs_overlay
+
+        print("applying overlay %s in-process" % overlay_path)
+        config = dcs_overlay.OverlayConfig(self.args.target_device, self.args.jetpack, self.args.hwrev,
+                                           self.args.board_expansion, self.args.storage, self.args.rootfs_type,
+                                           chroot_queue=self.chroot_queue)
+        return dcs_overlay.apply_overlay(overlay_path, self.rootfs_extract_dir, config, custom_args)
+
     def print_config(self, config, items):
         for item in items:
             print("%s: %s" % (item, config[item]))
@@ -762,10 +3412,11 @@ class DcsDeploy:
             print()
             print("Please use one configuration from list:")
             self.list_all_versions()
-            print("Exitting!")
-            exit(3)
+            raise ConfigError("Unsupported configuration!")
        
-        self.config_db = self.config_db[config]
+        # config_db may be shared by several runs (DeployEngine), selected config is updated below
+        self.config_db = copy.deepcopy(self.config_db[config])
+        self.config_storages = list(self.config_db['storage'])
         
         # update selected config according user enterred parameters
         self.config = self.config_db
@@ -800,8 +3451,7 @@ class DcsDeploy:
                 self.board_name = 'airvolute-dcs' + self.config['board'] + "+p3767-0004"
                 self.orin_options = '--network usb0 -p "-c bootloader/t186ref/cfg/flash_t234_qspi.xml --no-systemimg"'
             else:
-                print("Unknown device! [%s] exitting" % self.config['device'])
-                exit(8)
+                raise ConfigError("Unknown device! [%s]" % self.config['device'], 8)
 
             if self.config['storage'] == 'emmc':
                 self.rootdev = "mmcblk0p1"
@@ -816,8 +3466,7 @@ class DcsDeploy:
                     # setup no multiple app partitions
                     self.ext_partition_layout = os.path.relpath('tools/kernel_flash/flash_l4t_external_custom.xml')
             else:
-                print("Unknown storage [%s]! exitting" % self.config['storage'])
-                exit(9)
+                raise ConfigError("Unknown storage [%s]!" % self.config['storage'], 9)
 
         # setup for JP 62
         else:
@@ -831,8 +3480,7 @@ class DcsDeploy:
                 self.board_name = 'airvolute-dcs' + self.config['board'] + "+p3767-0000-super-maxn"
                 self.orin_options = '--network usb0 -p "-c bootloader/generic/cfg/flash_t234_qspi.xml --no-systemimg"'
             else:
-                print("Unknown device! [%s] exitting" % self.config['device'])
-                exit(8)
+                raise ConfigError("Unknown device! [%s]" % self.config['device'], 8)
 
             if self.config['storage'] == 'nvme':
                 self.rootdev = "external"
@@ -845,8 +3493,7 @@ class DcsDeploy:
                     # setup no multiple app partitions
                     self.ext_partition_layout = os.path.relpath('tools/kernel_flash/flash_l4t_t234_nvme.xml')
             else:
-                print("Unknown storage [%s]! exitting" % self.config['storage'])
-                exit(9)
+                raise ConfigError("Unknown storage [%s]!" % self.config['storage'], 9)
 
         # fix default rootdev to external  (or internal) for orin. There is NFS used to flash
         if self.config['device'] in ['orin_nx', 'orin_nx_super', 'orin_nx_super_maxn', 'orin_nx_8gb', 'orin_nx_8gb_super', 'orin_nx_8gb_super_maxn', 'orin_nano_8gb', 'orin_nano_8gb_super', 'orin_nano_4gb', 'orin_nano_4gb_super']:
@@ -857,7 +3504,9 @@ class DcsDeploy:
         # check commandline parameter if they are same as previous and images are already generated skip generation
         if self.prepare_status.is_identifier_same_as_prev(["--regen", "--force"]) and self.prepare_status.get_status() == True:
             print("Images already generated! Skipping generating images!")
+            self.metrics.cache_access("images", True)
             return 0
+        self.metrics.cache_access("images", False)
 
         self.prepare_status.set_processing_step("generate_images")
         print("-"*80)
@@ -886,7 +3535,7 @@ class DcsDeploy:
                 #self.rootdev = "external" # set UUID device in kernel commandline: rootfs=PARTUUID=<external-uuid>
 
             if self.args.app_size is not None:
-                opt_app_size_arg = f"-S {self.args.app_size}GiB"
+                opt_app_size_arg = f"-S {shlex.quote(self.args.app_size + 'GiB')}"
 
             if self.config['device'] in ['orin_nx', 'orin_nx_super', 'orin_nx_super_maxn', 'orin_nx_8gb', 'orin_nx_8gb_super', 'orin_nx_8gb_super_maxn', 'orin_nano_8gb', 'orin_nano_8gb_super', 'orin_nano_4gb', 'orin_nano_4gb_super']:
                 external_only = "" # don't flash only external device
@@ -895,53 +3544,1193 @@ class DcsDeploy:
             ret = cmd_exec(f"sudo {env_vars} ./{self.flash_script_path} {opt_app_size_arg} --no-flash {external_only} {self.external_device} " +
                            f"-c {self.ext_partition_layout} {self.orin_options} --showlogs {self.board_name} {self.rootdev}", print_command=True)
         self.prepare_status.set_status(ret, last_step= True)
+        if ret == 0:
+            # flash dir does not grow anymore, remember its size for cache quota
+            self.cache.update_size(self.flash_path)
         return ret
 
+    def get_unit_images(self) -> list:
+        """
+        APP images generated for initrd flash, which can contain the unit payload placeholder.
+        """
+        images_dir = os.path.join(self.l4t_root_dir, 'tools', 'kernel_flash', 'images')
+        images = []
+        for dir_path, _, file_names in os.walk(images_dir):
+            for file_name in file_names:
+                if file_name.startswith("system") and ".img" in file_name and not file_name.endswith(".sha1sum"):
+                    images.append(os.path.join(dir_path, file_name))
+        return sorted(images)
+
+    def get_images_size(self) -> int:
+        """
+        Size of images generated for initrd flash.
+        """
+        size = 0
+        for dir_path, _, file_names in os.walk(os.path.join(self.l4t_root_dir, 'tools', 'kernel_flash', 'images')):
+            for file_name in file_names:
+                try:
+                    size += os.path.getsize(os.path.join(dir_path, file_name))
+                except OSError:
+                    pass
+        return size
+
+    def personalise_images(self) -> int:
+        """
+        Write payload of the flashed unit into generated images. Images are generated only once
+        for the configuration, each unit costs only building its payload and patching it in place.
+        """
+        serial = self.args.unit
+        unit_payload = self.get_unit_payload()
+        try:
+            row = {}
+            if self.args.unit_params is not None:
+                row = UnitPayload.load_units(self.args.unit_params)[serial]
+            payload = unit_payload.build(serial, row, self.args.unit_files)
+        except (OSError, ValueError, KeyError) as e:
+            print("Building payload of unit %s failed: %s" % (serial, str(e)))
+            return 1
+
+        patched = self.write_unit_payload(unit_payload, payload, "payload of unit %s" % serial)
+        if patched == 0:
+            print("Unit payload placeholder not found in generated images! Prepare the configuration again (--regen --unit_placeholder).")
+        return 0 if patched > 0 else 1
+
+    def get_unit_payload(self) -> UnitPayload:
+        template_dir = self.args.unit_template if self.args.unit_template is not None else self.unit_template_dir
+        return UnitPayload(template_dir, os.path.join(self.dsc_deploy_root, 'units'))
+
+    def write_unit_payload(self, unit_payload:UnitPayload, payload:bytes, description:str, skip_kind:int = None) -> int:
+        """
+        Write payload into all unit images, except images known to contain payload of skip_kind.
+        Returns number of patched images, -1 on error.
+        """
+        patched = 0
+        for image_path in self.get_unit_images():
+            image = SystemImage(image_path)
+            if skip_kind is not None and unit_payload.get_saved_kind(image) == skip_kind:
+                continue
+            try:
+                offset = unit_payload.locate(image)
+            except ValueError as e:
+                print(str(e))
+                return -1
+            if offset is None:
+                continue
+            if image.write(offset, payload) != 0 or UnitPayload.update_checksums(image) != 0:
+                print("Writing %s into %s failed!" % (description, image_path))
+                return -1
+            unit_payload.save_location(image, offset)
+            print("%s written into %s" % (description.capitalize(), image_path))
+            patched += 1
+        return patched
+
+    def restore_unit_placeholder(self) -> int:
+        """
+        Put the placeholder back after flashing, so identity of the unit (hostname, serial, SSH host keys)
+        is never flashed to another device.
+        """
+        print("Restoring unit payload placeholder in generated images ...")
+        if self.write_unit_payload(self.get_unit_payload(), UnitPayload.placeholder(), "placeholder",
+                                   skip_kind=UnitPayload.KIND_PLACEHOLDER) < 0:
+            return 1
+        return 0
+
+    def check_unit_images(self):
+        """
+        Refuse to flash images still containing payload of a unit (placeholder was not restored, eg. the
+        run personalising them was killed).
+        """
+        unit_payload = self.get_unit_payload()
+        for image_path in self.get_unit_images():
+            if unit_payload.get_saved_kind(SystemImage(image_path)) == UnitPayload.KIND_PAYLOAD:
+                raise StepError("Image %s contains payload of another unit! Flash with --unit to replace it "
+                                "or prepare the configuration again (--regen)." % image_path, 15)
+
     def flash(self):
-        # setup flashing
-        self.setup_initrd_flashing()
-        
-        # generate images
-        ret = self.generate_images()
+        if self.args.target is not None:
+            # setup flashing and generate images in work tree of the target
+            ret = self.generate_target_images(self.parse_target(self.args.target))
+        else:
+            # setup flashing
+            self.setup_initrd_flashing()
+
+            # generate images
+            ret = self.generate_images()
+        if ret != 0:
+            raise StepError("Generating images was not sucessfull! ret = %d" % (ret), 7)
+
+        if self.args.unit is None:
+            self.check_unit_images()
+        try:
+            if self.args.unit is not None:
+                print("-"*80)
+                print("Personalising images for unit %s ..." % self.args.unit)
+                if self.personalise_images() != 0:
+                    raise StepError("Personalising images for unit %s failed!" % self.args.unit, 15)
+            # flash device
+            print("-"*80)
+            print("Flash images! ...")
+            self.prepare_status.change_group("flash")
+            self.prepare_status.set_processing_step("flash_only")
+            # Run sudo identification if not enterred
+            cmd_exec("/usr/bin/sudo /usr/bin/id > /dev/null")
+            usb_instance = ""
+            if self.args.usb_instance is not None:
+                usb_instance = f"--usb-instance {shlex.quote(self.args.usb_instance)}"
+            flash_start = time.monotonic()
+            ret = cmd_exec(f"sudo {self.flash_script_path} --flash-only {usb_instance} {self.external_device} {self.orin_options} {self.board_name} {self.rootdev}", print_command=True)
+            self.prepare_status.set_status(ret, last_step= True)
+            self.metrics.flash_finished(ret, self.get_images_size(), time.monotonic() - flash_start)
+            if ret != 0:
+                raise StepError("Flashing images failed! Flash script exited with %d." % ret, 1)
+        finally:
+            if self.args.unit is not None and self.restore_unit_placeholder() != 0:
+                print("WARNING! Placeholder could not be restored, images contain payload of unit %s. "
+                      "They will not be flashed without --unit." % self.args.unit)
+
+
+    def parse_target(self, spec:str) -> dict:
+        """
+        Parse image target, eg. emmc, nvme, nvme:ab, nvme:app_size=16 or nvme:ab:app_size=16.
+        """
+        parts = spec.strip().split(':')
+        target = {"storage": parts[0], "ab_partition": False, "app_size": None}
+        for option in parts[1:]:
+            if option == 'ab':
+                target['ab_partition'] = True
+            elif option.startswith('app_size=') and option[len('app_size='):].isdigit():
+                target['app_size'] = option[len('app_size='):]
+            else:
+                raise ConfigError("Unknown option '%s' of target %s! Use :ab and :app_size=<GB>." % (option, spec), 16)
+
+        if target['storage'] not in self.config_storages:
+            raise ConfigError("Storage of target %s is not supported by configuration %s! Options: %s" % (
+                spec, self.selected_config_name, ", ".join(self.config_storages)), 16)
+        if target['ab_partition'] and target['storage'] != 'nvme':
+            raise ConfigError("AB partition is allowed only for nvme devices! (%s)" % spec, 16)
+
+        target['name'] = target['storage']
+        if target['ab_partition']:
+            target['name'] += '_ab'
+        if target['app_size'] is not None:
+            target['name'] += '_app' + target['app_size']
+        return target
+
+    def use_target(self, target:dict):
+        """
+        Switch flashing setup and image status to the work tree of the target.
+        """
+        self.target_path = os.path.join(self.flash_path, 'targets', target['name'])
+        self.l4t_root_dir = os.path.join(self.target_path, 'Linux_for_Tegra')
+        self.config = dict(self.config, storage=target['storage'])
+        self.args.ab_partition = target['ab_partition']
+        if target['app_size'] is not None:
+            self.args.app_size = target['app_size']
+        os.makedirs(self.target_path, exist_ok=True)
+        self.prepare_status = ProcessingStatus(os.path.join(self.target_path, "status.json"), initial_group="images",
+                                               default_identifier=self.get_status_identifier() + ["target=" + target['name']],
+                                               metrics=self.metrics)
+
+    def create_target_tree(self) -> int:
+        """
+        Create copy-on-write work tree of the target from the prepared flash tree. Files are reflinked
+        where the filesystem supports it. Rootfs is mounted as overlay over the prepared rootfs, so files
+        changed by flash.sh (boot files, extlinux.conf) stay in the target.
+        """
+        self.release_target_rootfs()
+        self.move_to_trash(self.l4t_root_dir)
+        prepared_l4t_dir = os.path.join(self.flash_path, 'Linux_for_Tegra')
+        os.makedirs(self.l4t_root_dir)
+        ret = 0
+        for entry in sorted(os.listdir(prepared_l4t_dir)):
+            if entry == 'rootfs':
+                continue
+            ret += cmd_exec(f"sudo cp -a --reflink=auto {os.path.join(prepared_l4t_dir, entry)} {self.l4t_root_dir}/")
         if ret != 0:
-            print("Generating images was not sucessfull! ret = %d" % (ret))
-            print("Exitting!")
-            exit(7)
-        # flash device
+            print("Copying flash tree into %s failed!" % self.l4t_root_dir)
+            return ret
+
+        rootfs = os.path.join(self.l4t_root_dir, 'rootfs')
+        upper = os.path.join(self.target_path, 'rootfs_upper')
+        work = os.path.join(self.target_path, 'rootfs_work')
+        for path in [rootfs, upper, work]:
+            os.makedirs(path, exist_ok=True)
+        ret = cmd_exec(f"sudo mount -t overlay dcs_deploy_target -o lowerdir={self.rootfs_extract_dir},upperdir={upper},workdir={work} {rootfs}",
+                       print_command=True)
+        if ret != 0:
+            print("Could not mount rootfs overlay, copying rootfs.")
+            ret = cmd_exec(f"sudo cp -a --reflink=auto {self.rootfs_extract_dir}/. {rootfs}/")
+        return ret
+
+    def release_target_rootfs(self):
+        """
+        Rootfs of the target is needed only to generate images. Unmount it and drop changed files,
+        generated images stay in the work tree for flashing.
+        """
+        rootfs = os.path.join(self.l4t_root_dir, 'rootfs')
+        if os.path.ismount(rootfs):
+            ret = cmd_exec(f"sudo umount {rootfs}", print_command=True)
+            if ret != 0:
+                return ret
+        for path in [rootfs, os.path.join(self.target_path, 'rootfs_upper'), os.path.join(self.target_path, 'rootfs_work')]:
+            self.move_to_trash(path)
+        if os.path.isdir(self.l4t_root_dir):
+            os.makedirs(rootfs, exist_ok=True)
+        return 0
+
+    def unmount_targets(self):
+        """
+        Unmount rootfs overlays left by interrupted image generation of targets.
+        """
+        targets_path = os.path.join(self.flash_path, 'targets')
+        if not os.path.isdir(targets_path):
+            return
+        for name in os.listdir(targets_path):
+            rootfs = os.path.join(targets_path, name, 'Linux_for_Tegra', 'rootfs')
+            if os.path.ismount(rootfs):
+                cmd_exec(f"sudo umount {rootfs}", print_command=True)
+
+    def generate_target_images(self, target:dict) -> int:
+        """
+        Generate images of the target in its own work tree. Already generated images are reused.
+        """
+        self.use_target(target)
+        if not (self.prepare_status.is_identifier_same_as_prev(["--regen", "--force"]) and self.prepare_status.get_status() == True):
+            print("Creating work tree of target %s ..." % target['name'])
+            ret = self.create_target_tree()
+            if ret != 0:
+                return ret
+        self.setup_initrd_flashing()
+        try:
+            return self.generate_images()
+        finally:
+            self.release_target_rootfs()
+
+    def generate_targets(self, targets:list) -> int:
+        """
+        Generate images of several targets from one prepared rootfs. Each target is generated by its
+        own process in its own work tree, so flash.sh runs of targets do not see each other's files.
+        """
+        mp_context = multiprocessing.get_context("fork")
+        pending = list(targets)
+        running = []
+        results = []
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < max(1, self.args.jobs):
+                target = pending.pop(0)
+                log_path = os.path.join(self.flash_path, 'targets', target['name'] + '.log')
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+                process = mp_context.Process(target=run_target_job, args=(self, target, log_path))
+                process.start()
+                print("Generating images of target %s, log: %s" % (target['name'], log_path))
+                running.append((target, process, log_path))
+
+            multiprocessing.connection.wait([process.sentinel for _, process, _ in running])
+            for target, process, log_path in list(running):
+                if process.is_alive():
+                    continue
+                process.join()
+                running.remove((target, process, log_path))
+                results.append((target, process.exitcode, log_path))
+                print("Target %s finished (%s)" % (target['name'], process.exitcode))
+
         print("-"*80)
-        print("Flash images! ...")
-        self.prepare_status.change_group("flash")
-        self.prepare_status.set_processing_step("flash_only")
-        # Run sudo identification if not enterred
-        cmd_exec("/usr/bin/sudo /usr/bin/id > /dev/null")
-        ret = cmd_exec(f"sudo {self.flash_script_path} --flash-only {self.external_device} {self.orin_options} {self.board_name} {self.rootdev}", print_command=True)
-        self.prepare_status.set_status(ret, last_step= True)
+        failed = 0
+        for target, exit_code, log_path in results:
+            state = "succeeded" if exit_code == 0 else "failed"
+            print("%-20s %-10s images: %s" % (target['name'], state,
+                  os.path.join(self.flash_path, 'targets', target['name'], 'Linux_for_Tegra', 'tools', 'kernel_flash', 'images')))
+            if exit_code != 0:
+                failed += 1
+                print("%-20s %-10s log: %s" % ("", "", log_path))
+        return failed
+
+    def get_config_variants(self, config_name:str) -> list:
+        """
+        Get all combinations of device, board, board expansion and storage of config as flash arguments.
+        """
+        config = self.config_db[config_name]
+        variants = []
+        for device, board, board_expansion, storage in itertools.product(
+                config['device'], config['board'], config['board_expansion'], config['storage']):
+            variants.append([device, config['l4t_version'], board, board_expansion, storage, config['rootfs_type']])
+        return variants
+
+    def get_selected_variants(self) -> list:
+        if self.args.all:
+            selections = list(self.config_db.keys())
+        else:
+            selections = self.args.selections
+
+        variants = []
+        for selection in selections:
+            if selection in self.config_db:
+                selected = self.get_config_variants(selection)
+            else:
+                selected = [ConfigSelection.parse(selection).to_args()]
+            for variant in selected:
+                if variant not in variants:
+                    variants.append(variant)
+        return variants
+
+    def download_variant_resources(self, variants:list) -> set:
+        """
+        Download resources shared by variants only once. Returns configs with newly downloaded files.
+        """
+        changed_configs = set()
+        for res_name, url, dst_path, configs in self.get_variant_downloads(variants):
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            ret = self.download_resource(res_name, dst_path, url, self.config_db[configs[0]])
+            if ret < 0:
+                raise DownloadError("can't download resource '" + res_name + "'!.")
+            if ret == 0:
+                changed_configs.update(configs)
+        return changed_configs
+
+    def prepare_configs(self):
+        """
+        Prepare several configurations at once. Each variant is prepared in its own process,
+        downloaded files are shared through download locks, so they are downloaded only once.
+        """
+        variants = self.get_selected_variants()
+        if len(variants) == 0:
+            print("No configuration selected!")
+            self.parser.print_usage()
+            return 0
+
+        common_args = []
+        changed_configs = set()
+        if self.args.force or self.args.refresh:
+            # check and download everything once here, variants only extract again
+            changed_configs = self.download_variant_resources(variants)
+        if self.args.app_size is not None:
+            common_args += ['--app_size', self.args.app_size]
+        if self.args.extract_profile is not None:
+            common_args += ['--extract_profile', self.args.extract_profile]
+        if self.args.extract_jobs is not None:
+            common_args += ['--extract_jobs', str(self.args.extract_jobs)]
+        if self.args.transcode is not None:
+            common_args += ['--transcode', self.args.transcode]
+        if self.args.unit_placeholder:
+            common_args.append('--unit_placeholder')
+
+        jobs_dir = os.path.join(self.dsc_deploy_root, 'prepare', 'logs')
+        scheduler = DeployScheduler(self.config_db, jobs_dir, max_jobs=self.args.jobs)
+        jobs = []
+        for variant in variants:
+            args = variant + common_args
+            if self.args.force or self.args.regen or self.find_config(*variant) in changed_configs:
+                args.append('--regen')
+            if self.args.ab_partition and variant[4] == 'nvme':
+                args.append('--ab_partition')
+            job = scheduler.submit('prepare', args, '_'.join(
+                [variant[0], variant[4], variant[2], variant[3], variant[1], variant[5]]))
+            jobs.append(job)
+
+        scheduler.wait_all()
+
+        print("-"*80)
+        failed = 0
+        for job in jobs:
+            print("%-60s %-10s log: %s" % (job.config_key, job.state, job.log_path))
+            if job.state != DeployJob.SUCCEEDED:
+                failed += 1
+        if failed != 0:
+            raise StepError("%d of %d configurations were not prepared!" % (failed, len(jobs)))
+        return 0
+
+    def airvolute_prepare(self):
+        """
+        Download resources, prepare sources and generate images without flashing the device.
+        """
+        try:
+            self.download_resources()
+            self.prepare_sources_production()
+            self.setup_initrd_flashing()
+            return self.generate_images()
+        finally:
+            self.finish_staging()
+
+    def airvolute_images(self):
+        """
+        Prepare rootfs once and generate images of all targets from it without flashing.
+        """
+        targets = []
+        for spec in self.args.targets.split(','):
+            target = self.parse_target(spec)
+            if target['name'] not in [t['name'] for t in targets]:
+                targets.append(target)
 
+        try:
+            self.download_resources()
+            self.prepare_sources_production()
+            if not self.prepare_status.get_status("prepare"):
+                raise StepError("Preparing flash tree failed! Images are not generated.")
+            failed = self.generate_targets(targets)
+        finally:
+            self.finish_staging()
+
+        if failed != 0:
+            raise StepError("Images of %d of %d targets were not generated!" % (failed, len(targets)))
+        return 0
 
     def airvolute_flash(self):
-        if self.match_selected_config() == None:
-            print('Unsupported configuration!')
-            return
         print("matched configuration: " + self.selected_config_name)
 
-        self.download_resources()
-        self.prepare_sources_production()
-        self.flash()
-        quit() 
+        try:
+            self.download_resources()
+            self.prepare_sources_production()
+            self.flash()
+        finally:
+            self.finish_staging()
+        return 0
+
+    def get_variant_downloads(self, variants:list) -> list:
+        """
+        Get unique (resource name, url, download path, config names) of variants.
+        """
+        downloads = {}
+        for variant in variants:
+            config = self.find_config(*variant)
+            if config is None:
+                print("Unsupported configuration %s, skipping!" % ":".join(variant))
+                continue
+            for res_name in RESOURCE_KEYS:
+                url = self.config_db[config][res_name]
+                if url == None or url == "none" or url == "":
+                    continue
+                if url not in downloads:
+                    downloads[url] = (res_name, url, self.get_download_file_path(url), [])
+                if config not in downloads[url][3]:
+                    downloads[url][3].append(config)
+        return list(downloads.values())
+
+    def in_time_window(self) -> bool:
+        if self.args.window is None:
+            return True
+        start, end = [time.strptime(t, "%H:%M") for t in self.args.window.split("-")]
+        start = start.tm_hour * 60 + start.tm_min
+        end = end.tm_hour * 60 + end.tm_min
+        now = time.localtime()
+        now = now.tm_hour * 60 + now.tm_min
+        if start <= end:
+            return start <= now < end
+        return now >= start or now < end
+
+    def wait_for_time_window(self) -> bool:
+        """
+        Wait until current time is inside of --window. Returns True when it waited.
+        Must not be called with a resource lock held, flashing would wait for the window too.
+        """
+        if self.in_time_window():
+            return False
+        print("Outside of download window %s, waiting ..." % self.args.window)
+        while not self.in_time_window():
+            time.sleep(30)
+        print("Download window %s started." % self.args.window)
+        return True
+
+    def check_time_window(self):
+        """
+        before_chunk callback of prefetch downloads: download is paused outside of --window, so the
+        resource lock is released while waiting for the next window.
+        """
+        if not self.in_time_window():
+            raise DownloadPaused()
+        return False
+
+    def is_prefetch_changed(self, url:str, dst_path:str, sha256:str = None) -> bool:
+        try:
+            return is_download_changed(url, dst_path, sha256)
+        except Exception as e:
+            print("Could not check whether %s changed (%s), keeping downloaded file." % (url, str(e)))
+            return False
+
+    def prefetch(self):
+        """
+        Download resources of selected configurations, so the first flash does not wait for downloads.
+        Download locks are used, so it is safe to run it together with flashing.
+        """
+        variants = self.get_selected_variants()
+        downloads = self.get_variant_downloads(variants)
+        rate_limit = parse_size(self.args.rate_limit) if self.args.rate_limit is not None else None
+
+        if self.args.background:
+            log_path = os.path.join(self.dsc_deploy_root, 'prefetch.log')
+            os.makedirs(self.dsc_deploy_root, exist_ok=True)
+            pid = os.fork()
+            if pid != 0:
+                print("Prefetching %d files in background (pid %d), log: %s" % (len(downloads), pid, log_path))
+                return 0
+            os.setsid()
+            log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.dup2(log_fd, 1)
+            os.dup2(log_fd, 2)
+            os.close(log_fd)
+            _sys.stdout.reconfigure(line_buffering=True)
+
+        cache = DeployCache(self)
+        failed = 0
+        for i, (res_name, url, dst_path, configs) in enumerate(downloads, start=1):
+            print("[%d/%d] %s (%s)" % (i, len(downloads), dst_path, ", ".join(configs)))
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            mirrors, sha256 = self.get_download_sources(self.config_db[configs[0]], res_name, url)
+            download = MirrorDownload([url] + (mirrors or []), dst_path, sha256, rate_limit, self.check_time_window)
+            ret = MirrorDownload.PAUSED
+            while ret == MirrorDownload.PAUSED:
+                # resource lock is not held while waiting, flashing can use (or download) the file meanwhile
+                self.wait_for_time_window()
+                with self.get_resource_lock(dst_path):
+                    if os.path.isfile(dst_path) and not self.args.refresh:
+                        print("Already downloaded.")
+                        ret = 0
+                    elif os.path.isfile(dst_path) and not self.is_prefetch_changed(url, dst_path, sha256):
+                        print("Already downloaded, up to date.")
+                        ret = 0
+                    else:
+                        if download.done == 0:
+                            remove_partial_download(dst_path)
+                        ret = download.run(resume=True)
+            if ret != 0:
+                failed += 1
+                continue
+            for config in configs:
+                cache.touch([dst_path], config)
+            if self.args.index:
+                with self.get_resource_lock(dst_path, shared=True):
+                    try:
+                        ArchiveIndex(dst_path).load_or_build()
+                    except (OSError, tarfile.TarError) as e:
+                        print("Could not index archive %s: %s" % (dst_path, str(e)))
+
+        print("Prefetch finished, %d of %d files are ready." % (len(downloads) - failed, len(downloads)))
+        if failed != 0:
+            raise DownloadError("%d files were not downloaded!" % failed)
+        return 0
+
+    def run_cache_command(self):
+        cache = DeployCache(self)
+        if self.args.action == 'quota':
+            if self.args.size is None:
+                quota = cache.get_quota()
+                print("cache quota: " + ("none" if quota is None else format_size(quota)))
+            elif self.args.size == "none":
+                cache.set_quota(None)
+            else:
+                cache.set_quota(parse_size(self.args.size))
+            return 0
+
+        if self.args.action == 'gc':
+            quota = cache.get_quota() if self.args.size is None else parse_size(self.args.size)
+            if quota is None:
+                print("No cache quota set! Use: cache gc <size> or cache quota <size>")
+                return 1
+            evicted = cache.gc(quota, dry_run=self.args.dry_run)
+            print("%s %d items, %s" % ("Would evict" if self.args.dry_run else "Evicted", len(evicted),
+                  format_size(sum(item["size"] for item in evicted))))
+            return 0
+
+        stats = cache.stats()
+        for item in sorted(stats, key=lambda item: item["last_used"], reverse=True):
+            print("%-10s %10s  %s %-6s %s" % (item["kind"], format_size(item["size"]),
+                  time.strftime("%Y-%m-%d %H:%M", time.localtime(item["last_used"])),
+                  "in use" if item["in_use"] else "", item["path"]))
+            if len(item["configs"]) != 0:
+                print("%30s configs: %s" % ("", ", ".join(item["configs"])))
+        quota = cache.get_quota()
+        print("-"*80)
+        print("total: %s, downloads: %s, transcoded: %s, flash: %s, quota: %s" % (
+            format_size(sum(item["size"] for item in stats)),
+            format_size(sum(item["size"] for item in stats if item["kind"] == "download")),
+            format_size(sum(item["size"] for item in stats if item["kind"] == "transcoded")),
+            format_size(sum(item["size"] for item in stats if item["kind"] == "flash")),
+            "none" if quota is None else format_size(quota)))
+        return 0
+
+    def get_delta_rootfs(self, name:str):
+        """
+        Get (rootfs path, flash directory or None) of make-delta argument.
+        """
+        for flash_dir in [os.path.join(self.dsc_deploy_root, 'flash', name), name]:
+            rootfs = os.path.join(flash_dir, 'Linux_for_Tegra', 'rootfs')
+            if os.path.isdir(os.path.join(rootfs, 'etc')):
+                return os.path.realpath(rootfs), os.path.realpath(flash_dir)
+        if os.path.isdir(os.path.join(name, 'etc')):
+            return os.path.realpath(name), None
+        raise ConfigError("%s is neither prepared flash directory nor rootfs!" % name)
+
+    def make_delta(self):
+        """
+        Write delta bundle updating old rootfs to new one (see local/overlays/hardware_support_layer/resources/libs/dcs_delta).
+        The bundle is applied on the device by dcs_delta.py shipped by hardware_support_layer overlay.
+        """
+        old_rootfs, old_flash_dir = self.get_delta_rootfs(self.args.old)
+        new_rootfs, new_flash_dir = self.get_delta_rootfs(self.args.new)
+        # flash directories must not be regenerated while they are compared
+        locks = [self.get_lock(path, description="flash directory " + path)
+                 for path in [old_flash_dir, new_flash_dir] if path is not None]
+        for lock in locks:
+            lock.acquire()
+        try:
+            print('Comparing %s and %s, this part needs sudo privilegies:' % (old_rootfs, new_rootfs))
+            output = os.path.abspath(self.args.output)
+            command = f"sudo python3 {DELTA_TOOL_PATH} make {old_rootfs} {new_rootfs} -o {output} --diff-min-size {self.args.diff_min_size}"
+            if self.args.checksum:
+                command += " --checksum"
+            ret = cmd_exec(command)
+        finally:
+            for lock in locks:
+                lock.release()
+        if ret != 0:
+            raise StepError("Could not create delta bundle!")
+        cmd_exec(f"sudo chown {os.getuid()}:{os.getgid()} {output}")
+        return 0
 
-    def run(self):
+    def run(self) -> int:
+        """
+        Run the command. Returns its exit code, errors are raised as DcsDeployError.
+        """
         if self.args.command == 'list':
             if self.args.local_overlays == True:
                 self.list_local_overlays()
-                quit()
+                return 0
             self.list_all_versions()
-            quit()
+            return 0
+
+        if self.args.command == 'prepare':
+            return self.prepare_configs()
+
+        if self.args.command == 'prefetch':
+            return self.prefetch()
+
+        if self.args.command == 'cache':
+            return self.run_cache_command()
+
+        if self.args.command == 'make-delta':
+            return self.make_delta()
+
+        if self.args.command == 'serve':
+            server = DeployServer(self)
+            server.serve_forever()
+            return 0
 
         if self.args.command == 'flash':
-            self.airvolute_flash()
-            quit()
+            return self.run_measured(self.airvolute_flash)
+
+        if self.args.command == 'images':
+            return self.run_measured(self.airvolute_images)
+        return 0
+
+    def run_measured(self, command):
+        """
+        Run command and record its result in metrics, also when it fails or exits early.
+        Returns result of the command.
+        """
+        self.metrics.run_started()
+        exit_code = 1
+        try:
+            ret = command()
+            exit_code = ret if isinstance(ret, int) else 0
+            return ret
+        except DcsDeployError as e:
+            exit_code = e.exit_code
+            raise
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            raise
+        finally:
+            self.metrics.run_finished(exit_code)
+
+
+class DeployJob:
+    """
+    Single prepare/flash job submitted to the serve mode.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, job_id:str, command:str, args:list, config_key:str, device:str, log_path:str):
+        self.id = job_id
+        self.command = command
+        self.args = args
+        self.config_key = config_key
+        self.device = device
+        self.log_path = log_path
+        self.state = DeployJob.QUEUED
+        self.exit_code = None
+        self.process = None
+        self.cancel_requested = False
+        # time when process group of the job was asked to terminate, None while it runs normally
+        self.terminating = None
+        self.killed = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def is_done(self):
+        return self.state in [DeployJob.SUCCEEDED, DeployJob.FAILED, DeployJob.CANCELLED]
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "command": self.command,
+            "args": self.args,
+            "config": self.config_key,
+            "device": self.device,
+            "state": self.state,
+            "exit_code": self.exit_code,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "log": self.log_path,
+        }
+
+
+def redirect_output(log_path:str):
+    """
+    Redirect output of forked process into log. Forked jobs are not interactive, stdin is /dev/null.
+    """
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(log_fd)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.close(null_fd)
+    _sys.stdout.reconfigure(line_buffering=True)
+    _sys.stderr.reconfigure(line_buffering=True)
+
+
+def run_deploy_job(job_argv:list, command:str, config_db:dict, log_path:str, work_dir:str):
+    """
+    Entry point of forked job process. Output is redirected into job log.
+    Job runs in its own session, so the job can be cancelled together with commands it started.
+    """
+    os.setsid()
+    os.chdir(work_dir)
+    redirect_output(log_path)
+
+    def run_job():
+        if command == 'prepare':
+            print("matched configuration: " + deploy.selected_config_name)
+            ret = deploy.airvolute_prepare()
+        else:
+            ret = deploy.airvolute_flash()
+        return 0 if ret == 0 else 1
+
+    try:
+        deploy = DcsDeploy(job_argv, config_db=config_db, check_dependencies=False)
+        ret = deploy.run_measured(run_job)
+    except DcsDeployError as e:
+        e.report()
+        ret = e.exit_code
+    _sys.exit(ret)
+
+
+def run_target_job(deploy:DcsDeploy, target:dict, log_path:str):
+    """
+    Entry point of forked process generating images of one target. Output is redirected into target log.
+    """
+    redirect_output(log_path)
+
+    print("Generating images of target %s (%s)" % (target['name'], deploy.selected_config_name))
+    # each target process writes its own metrics
+    metrics = deploy.metrics
+    deploy.metrics = DeployMetrics(metrics.metrics_dir, metrics.name + "_" + target['name'],
+                                   dict(metrics.labels, target=target['name']), metrics.state_dir)
+
+    def run_job():
+        ret = deploy.generate_target_images(target)
+        return 0 if ret == 0 else 1
+
+    try:
+        ret = deploy.run_measured(run_job)
+    except DcsDeployError as e:
+        e.report()
+        ret = e.exit_code
+    _sys.exit(ret)
+
+
+class DeployScheduler:
+    """
+    Job queue of the serve mode. Jobs are started in submission order as long as global,
+    per-config and per-device limits allow it. Each job runs in forked process, so it
+    inherits already loaded config database and does not pay dcs_deploy startup again.
+    Job is finished when its whole process group is gone - commands started by the job
+    (sudo tar, flash.sh) must not use flash directory or device of the next job.
+    """
+    # seconds to wait for process group of cancelled job before it is killed
+    CANCEL_TIMEOUT = 30
+    # seconds between checks of running jobs, their processes do not notify the scheduler
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, config_db:dict, jobs_dir:str, max_jobs = 4, per_config = 1, per_device = 1,
+                 job_runner = run_deploy_job):
+        """
+        job_runner - entry point of job process, called with arguments of run_deploy_job. It has to
+                     start its own session, the process group of the job is the job.
+        """
+        self.config_db = config_db
+        self.job_runner = job_runner
+        self.jobs_dir = jobs_dir
+        self.max_jobs = max_jobs
+        self.per_config = per_config
+        self.per_device = per_device
+        self.work_dir = os.getcwd()
+        self.jobs = {}
+        self.job_counter = 0
+        self.lock = Condition()
+        self.mp_context = multiprocessing.get_context("fork")
+        if not os.path.isdir(self.jobs_dir):
+            os.makedirs(self.jobs_dir)
+        self.thread = Thread(target=self._schedule_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, command:str, args:list, config_key:str, device:str = None):
+        with self.lock:
+            self.job_counter += 1
+            job_id = "%s-%d" % (time.strftime("%Y%m%d%H%M%S"), self.job_counter)
+            log_path = os.path.join(self.jobs_dir, job_id + ".log")
+            job = DeployJob(job_id, command, args, config_key, device, log_path)
+            open(log_path, "w").close()
+            self.jobs[job_id] = job
+            self.lock.notify_all()
+        return job
+
+    def get(self, job_id:str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def cancel(self, job_id:str):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.is_done():
+                return job
+            if job.state == DeployJob.QUEUED:
+                job.state = DeployJob.CANCELLED
+                job.finished = time.time()
+            elif job.process is not None and not job.cancel_requested:
+                # job is finished by scheduler loop after its process group terminates
+                job.cancel_requested = True
+                self._terminate(job)
+            self.lock.notify_all()
+            return job
+
+    def wait_all(self):
+        with self.lock:
+            while not all(job.is_done() for job in self.jobs.values()):
+                self.lock.wait(timeout=self.POLL_INTERVAL)
+
+    @staticmethod
+    def _group_alive(job:DeployJob) -> bool:
+        try:
+            os.killpg(job.process.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # only processes started by sudo are left
+            return True
+        return True
+
+    def _terminate(self, job:DeployJob):
+        job.terminating = time.time()
+        try:
+            os.killpg(job.process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            # job process did not start its session yet
+            job.process.terminate()
+        except PermissionError:
+            pass
+
+    def _kill(self, job:DeployJob):
+        print("job %s did not terminate in %d s, killing it" % (job.id, self.CANCEL_TIMEOUT))
+        job.killed = True
+        try:
+            os.killpg(job.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        if self._group_alive(job):
+            # commands run by sudo can not be killed by user running the service
+            cmd_exec("sudo -n kill -KILL -- -%d > /dev/null 2>&1" % job.process.pid)
+
+    def _finish(self, job:DeployJob):
+        job.exit_code = job.process.exitcode
+        job.finished = time.time()
+        if job.cancel_requested or (job.exit_code is not None and job.exit_code < 0):
+            job.state = DeployJob.CANCELLED
+        elif job.exit_code == 0:
+            job.state = DeployJob.SUCCEEDED
+        else:
+            job.state = DeployJob.FAILED
+        print("job %s finished: %s (%s)" % (job.id, job.state, job.exit_code))
+
+    def _running(self):
+        return [job for job in self.jobs.values() if job.state == DeployJob.RUNNING]
+
+    def _can_start(self, job:DeployJob, running:list) -> bool:
+        if len(running) >= self.max_jobs:
+            return False
+        if len([r for r in running if r.config_key == job.config_key]) >= self.per_config:
+            return False
+        # only flash jobs occupy connected device
+        if job.command == 'flash':
+            flashing = [r for r in running if r.command == 'flash' and r.device == job.device]
+            if len(flashing) >= self.per_device:
+                return False
+        return True
+
+    def _start(self, job:DeployJob):
+        job_argv = ['flash'] + job.args
+        if job.device is not None:
+            job_argv += ['--usb_instance', job.device]
+        job.process = self.mp_context.Process(
+            target=self.job_runner,
+            args=(job_argv, job.command, copy.deepcopy(self.config_db), job.log_path, self.work_dir))
+        job.process.start()
+        job.state = DeployJob.RUNNING
+        job.started = time.time()
+        print("job %s started (%s %s)" % (job.id, job.command, " ".join(job.args)))
+
+    def _schedule_loop(self):
+        while True:
+            with self.lock:
+                for job in self._running():
+                    process_alive = job.process.is_alive()
+                    if not process_alive and not self._group_alive(job):
+                        job.process.join()
+                        self._finish(job)
+                        self.lock.notify_all()
+                    elif job.terminating is None and not process_alive:
+                        print("job %s left running processes, terminating them" % job.id)
+                        self._terminate(job)
+                    elif (job.terminating is not None and not job.killed and
+                          time.time() - job.terminating > self.CANCEL_TIMEOUT):
+                        self._kill(job)
+
+                for job in self.jobs.values():
+                    if job.state == DeployJob.QUEUED and self._can_start(job, self._running()):
+                        self._start(job)
+                self.lock.wait(timeout=self.POLL_INTERVAL)
+
+
+class DeployRequestHandler(BaseHTTPRequestHandler):
+    """
+    Local HTTP API of the serve mode:
+        POST   /jobs                 {"command": "prepare"|"flash", "args": [...], "device": "1-4"}
+        GET    /jobs                 list of jobs
+        GET    /jobs/<id>            job status
+        GET    /jobs/<id>/log        job log, ?offset=<bytes> to continue, ?follow=1 to stream until job ends
+        DELETE /jobs/<id>            cancel job
+    """
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # unix socket clients do not have address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def send_json(self, code:int, data):
+        body = json.dumps(data, indent=4).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_job_or_404(self, job_id:str):
+        job = self.server.scheduler.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": "unknown job %s" % job_id})
+        return job
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p != ""]
+        if parts == ["jobs"]:
+            return self.send_json(200, self.server.scheduler.list())
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self.get_job_or_404(parts[1])
+            if job is not None:
+                self.send_json(200, job.to_dict())
+            return
+        if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "log":
+            job = self.get_job_or_404(parts[1])
+            if job is not None:
+                self.send_log(job, parse_qs(url.query))
+            return
+        self.send_json(404, {"error": "unknown path %s" % url.path})
+
+    def send_log(self, job:DeployJob, query:dict):
+        offset = int(query.get("offset", ["0"])[0])
+        follow = query.get("follow", ["0"])[0] in ["1", "true", "yes"]
+        with open(job.log_path, "rb") as log_file:
+            log_file.seek(offset)
+            if not follow:
+                body = log_file.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            while True:
+                # read state before data, so nothing written at the end of job is lost
+                done = job.is_done()
+                chunk = log_file.read(64 * 1024)
+                if chunk:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    self.wfile.flush()
+                    continue
+                if done:
+                    break
+                time.sleep(0.5)
+            self.wfile.write(b"0\r\n\r\n")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "unknown path %s" % url.path})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            return self.send_json(400, {"error": "invalid json: %s" % str(e)})
+
+        command = request.get("command", "flash")
+        args = [str(arg) for arg in request.get("args", [])]
+        device = request.get("device")
+        if command not in ["prepare", "flash"]:
+            return self.send_json(400, {"error": "unknown command %s" % command})
+        if device is not None and (not isinstance(device, str) or USB_INSTANCE_PATTERN.match(device) is None):
+            return self.send_json(400, {"error": "invalid device %s, expected USB port path like 1-4" % device})
+        error = self.server.check_job_args(args)
+        if error is not None:
+            return self.send_json(400, {"error": error})
+        config_key = self.server.get_config_key(args)
+        if config_key is None:
+            return self.send_json(400, {"error": "invalid arguments %s" % args})
+        job = self.server.scheduler.submit(command, args, config_key, device)
+        self.send_json(201, job.to_dict())
+
+    def do_DELETE(self):
+        parts = [p for p in urlparse(self.path).path.split("/") if p != ""]
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self.send_json(404, {"error": "unknown path %s" % self.path})
+        job = self.server.scheduler.cancel(parts[1])
+        if job is None:
+            return self.send_json(404, {"error": "unknown job %s" % parts[1]})
+        self.send_json(200, job.to_dict())
+
+
+class DeployServer:
+    """
+    Long running dcs_deploy service. Dependencies are checked and config database is loaded
+    only once, jobs are scheduled by DeployScheduler.
+    """
+    # options of flash command accepted in jobs, their values are checked by the parser
+    JOB_OPTIONS = {'--force', '--regen', '--refresh', '--ab_partition', '--app_size', '--extract_profile',
+                   '--extract_jobs', '--transcode', '--tmpfs_staging', '--staging_writeback', '--unit_placeholder', '--unit', '--target'}
+
+    def __init__(self, deploy:DcsDeploy):
+        self.deploy = deploy
+        args = deploy.args
+        if args.socket is None and not args.allow_remote and not self.is_loopback(args.listen):
+            raise UsageError("Jobs run with sudo and the API has no authentication, refusing to listen on %s! "
+                             "Use --allow-remote to listen on non-loopback address anyway." % args.listen)
+        jobs_dir = os.path.join(os.path.expanduser('~'), '.dcs_deploy', 'serve', 'jobs')
+        self.scheduler = DeployScheduler(deploy.config_db, jobs_dir, args.max_jobs, args.per_config, args.per_device)
+
+        if args.socket is not None:
+            if os.path.exists(args.socket):
+                os.remove(args.socket)
+            self.httpd = UnixHTTPServer(args.socket, DeployRequestHandler)
+            self.address = args.socket
+        else:
+            self.httpd = ThreadingHTTPServer((args.listen, args.port), DeployRequestHandler)
+            self.address = "http://%s:%d" % (args.listen, args.port)
+        self.httpd.scheduler = self.scheduler
+        self.httpd.check_job_args = self.check_job_args
+        self.httpd.get_config_key = self.get_config_key
+
+    @staticmethod
+    def is_loopback(host:str) -> bool:
+        try:
+            addresses = socket.getaddrinfo(host, None)
+        except (socket.gaierror, UnicodeError):
+            return False
+        return all(ipaddress.ip_address(address[4][0]).is_loopback for address in addresses)
+
+    def check_job_args(self, args:list):
+        """
+        Jobs run as the service user with sudo, so only options from JOB_OPTIONS are accepted.
+        Options taking host paths (--rootfs, --unit_params, ...) are left to the command line
+        of the service host. Returns error message or None.
+        """
+        for arg in args:
+            if arg.startswith("-") and arg.split("=", 1)[0] not in self.JOB_OPTIONS:
+                return "option %s is not allowed in jobs, allowed: %s" % (arg, ", ".join(sorted(self.JOB_OPTIONS)))
+        return None
+
+    def get_config_key(self, args:list):
+        """
+        Get key of flash directory used by job with given arguments, None if arguments are invalid.
+        """
+        try:
+            job_args = self.deploy.parser.parse_args(['flash'] + args)
+        except UsageError:
+            return None
+        return '_'.join([job_args.target_device, job_args.storage, job_args.hwrev,
+                         job_args.board_expansion, job_args.jetpack, job_args.rootfs_type])
+
+    def serve_forever(self):
+        print("dcs_deploy %s serving on %s" % (dcs_deploy_version, self.address))
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopping dcs_deploy service!")
+        finally:
+            self.httpd.server_close()
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # only the service user may submit jobs, socket is not accessible to others even for a moment
+        umask = os.umask(0o177)
+        try:
+            # HTTPServer.server_bind expects (host, port) address
+            socketserver.TCPServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def main(argv:list = None) -> int:
+    """
+    Command line interface. Errors are printed and returned as exit code.
+    """
+    try:
+        return DcsDeploy(argv).run()
+    except DcsDeployError as e:
+        e.report()
+        return e.exit_code
 
 
 if __name__ == "__main__":
-    dcs_deploy = DcsDeploy()
-    dcs_deploy.run()
+    _sys.exit(main())
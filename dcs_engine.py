@@ -0,0 +1,269 @@
+# dcs_engine.py - library API of dcs_deploy
+#
+# Runs prepare, images and flash of many configurations in one Python process,
+# eg. from an orchestration service:
+#
+#   engine = DeployEngine()
+#   result = engine.prepare(ConfigSelection.parse("orin_nx:62:2.0:none:nvme:minimal"),
+#                           DeployOptions(extract_jobs=8))
+#
+# Errors of dcs_deploy are defined here, dcs_deploy.py (the command line) imports
+# them together with the API, the engine imports dcs_deploy when it is created.
+
+import copy
+import os
+import sys
+import time
+
+
+class DcsDeployError(Exception):
+    """
+    Error stopping a dcs_deploy run. exit_code is the exit code of the command line interface.
+    """
+    exit_code = 1
+
+    def __init__(self, message:str = "", exit_code:int = None):
+        super().__init__(message)
+        if exit_code is not None:
+            self.exit_code = exit_code
+
+    def report(self):
+        if str(self) != "":
+            print(str(self))
+        if self.exit_code != 0:
+            print("Exitting!")
+
+
+class UsageError(DcsDeployError):
+    """
+    Invalid command line, or command line handled without running anything (--help, --version).
+    """
+    exit_code = 2
+
+    def report(self):
+        if str(self) != "":
+            print(str(self), file=sys.stderr if self.exit_code != 0 else sys.stdout)
+
+
+class ConfigError(DcsDeployError):
+    """
+    Unsupported configuration or invalid options of the selected one.
+    """
+    exit_code = 3
+
+
+class DependencyError(DcsDeployError):
+    exit_code = 1
+
+
+class DownloadError(DcsDeployError):
+    exit_code = 4
+
+
+class CommandError(DcsDeployError):
+    exit_code = 5
+
+
+class DiskSpaceError(DcsDeployError):
+    exit_code = 13
+
+
+class StepError(DcsDeployError):
+    """
+    Step of prepare, images or flash failed (overlay, image generation, personalisation, flashing, ...).
+    """
+    exit_code = 12
+
+
+class ConfigSelection:
+    """
+    Selected configuration, the positional arguments of flash and images commands.
+    """
+    FIELDS = ['target_device', 'jetpack', 'hwrev', 'board_expansion', 'storage', 'rootfs_type']
+
+    def __init__(self, target_device:str, jetpack:str, hwrev:str, board_expansion:str, storage:str, rootfs_type:str):
+        self.target_device = target_device
+        self.jetpack = jetpack
+        self.hwrev = hwrev
+        self.board_expansion = board_expansion
+        self.storage = storage
+        self.rootfs_type = rootfs_type
+
+    @classmethod
+    def parse(cls, spec:str):
+        """
+        Parse target_device:jetpack:hwrev:board_expansion:storage:rootfs_type.
+        """
+        fields = spec.split(':')
+        if len(fields) != len(cls.FIELDS):
+            raise ConfigError("Unknown configuration selection: %s! Please use config name or "
+                              "target_device:jetpack:hwrev:board_expansion:storage:rootfs_type" % spec)
+        return cls(*fields)
+
+    def to_args(self) -> list:
+        return [getattr(self, field) for field in self.FIELDS]
+
+    def key(self) -> str:
+        """
+        Name of the flash directory of the selection (see ~/.dcs_deploy/flash).
+        """
+        return '_'.join([self.target_device, self.storage, self.hwrev, self.board_expansion, self.jetpack, self.rootfs_type])
+
+    def __str__(self):
+        return ':'.join(self.to_args())
+
+
+class DeployOptions:
+    """
+    Options of the prepared flash tree, shared by prepare, images and flash. They are the command
+    line options of the same name, runtime options of flashing are parameters of DeployEngine.flash.
+    """
+    FLAGS = ['force', 'regen', 'refresh', 'ab_partition', 'tmpfs_staging', 'unit_placeholder']
+    VALUES = ['app_size', 'rootfs', 'extract_profile', 'extract_jobs', 'transcode', 'staging_writeback', 'metrics_dir']
+
+    def __init__(self, force:bool = False, regen:bool = False, refresh:bool = False, ab_partition:bool = False,
+                 app_size:int = None, rootfs:str = None, extract_profile:str = None, extract_jobs:int = None,
+                 transcode:str = None, tmpfs_staging:bool = False, staging_writeback:str = None,
+                 unit_placeholder:bool = False, metrics_dir:str = None):
+        self.force = force
+        self.regen = regen
+        self.refresh = refresh
+        self.ab_partition = ab_partition
+        self.app_size = app_size
+        self.rootfs = rootfs
+        self.extract_profile = extract_profile
+        self.extract_jobs = extract_jobs
+        self.transcode = transcode
+        self.tmpfs_staging = tmpfs_staging
+        self.staging_writeback = staging_writeback
+        self.unit_placeholder = unit_placeholder
+        self.metrics_dir = metrics_dir
+
+    def to_args(self) -> list:
+        args = ['--' + name for name in self.FLAGS if getattr(self, name)]
+        for name in self.VALUES:
+            value = getattr(self, name)
+            if value is not None:
+                args += ['--' + name, str(value)]
+        return args
+
+
+class DeployResult:
+    """
+    Result of one run of DeployEngine.
+    """
+    def __init__(self, command:str, selection:ConfigSelection):
+        self.command = command
+        self.selection = selection
+        self.config_name = None
+        self.exit_code = None
+        self.error = None
+        self.status = None
+        self.duration = None
+
+    @property
+    def success(self) -> bool:
+        return self.exit_code == 0
+
+    def to_dict(self):
+        return {
+            "command": self.command,
+            "selection": str(self.selection),
+            "config": self.config_name,
+            "exit_code": self.exit_code,
+            "error": None if self.error is None else str(self.error),
+            "error_type": None if self.error is None else type(self.error).__name__,
+            "status": self.status,
+            "duration": self.duration,
+        }
+
+
+class DeployEngine:
+    """
+    Runs prepare, images and flash of many configurations in one process. Dependencies are
+    checked and config database is loaded only once. Errors of a run are returned in its
+    DeployResult (DcsDeployError of the run in error), so one failing configuration does not
+    stop the others.
+    """
+    COMMANDS = ['prepare', 'images', 'flash']
+
+    def __init__(self, config_db:dict = None, check_dependencies = True):
+        # dcs_deploy imports this module
+        from dcs_deploy import DcsDeploy
+        self.deploy_class = DcsDeploy
+        if check_dependencies:
+            DcsDeploy.check_dependencies()
+        self.config_db = DcsDeploy.load_db() if config_db is None else config_db
+
+    @staticmethod
+    def get_argv(command:str, selection:ConfigSelection, options:DeployOptions = None, args:list = None) -> list:
+        # single configuration is prepared by flash command without flashing (as prepare jobs do)
+        argv = ['flash' if command == 'prepare' else command] + selection.to_args()
+        if options is not None:
+            argv += options.to_args()
+        return argv + list(args or [])
+
+    def create(self, command:str, selection:ConfigSelection, options:DeployOptions = None, args:list = None):
+        """
+        Create DcsDeploy of the selection sharing loaded config database.
+        args - runtime options of the command in command line form
+        """
+        if command not in self.COMMANDS:
+            raise UsageError("Unknown command %s! Options: %s" % (command, ", ".join(self.COMMANDS)))
+        return self.deploy_class(self.get_argv(command, selection, options, args), config_db=self.config_db,
+                                 check_dependencies=False)
+
+    def run(self, command:str, selection:ConfigSelection, options:DeployOptions = None, args:list = None) -> DeployResult:
+        result = DeployResult(command, selection)
+        start = time.monotonic()
+        # setup of flashing changes working directory
+        work_dir = os.getcwd()
+        deploy = None
+        try:
+            deploy = self.create(command, selection, options, args)
+            result.config_name = deploy.selected_config_name
+            actions = {
+                'prepare': deploy.airvolute_prepare,
+                'images': deploy.airvolute_images,
+                'flash': deploy.airvolute_flash,
+            }
+            ret = deploy.run_measured(actions[command])
+            result.exit_code = 0 if ret == 0 else 1
+        except DcsDeployError as e:
+            result.error = e
+            result.exit_code = e.exit_code
+        finally:
+            if deploy is not None:
+                deploy.close()
+            os.chdir(work_dir)
+        if deploy is not None and hasattr(deploy, "prepare_status"):
+            result.status = copy.deepcopy(deploy.prepare_status.status)
+        result.duration = time.monotonic() - start
+        return result
+
+    def prepare(self, selection:ConfigSelection, options:DeployOptions = None) -> DeployResult:
+        """
+        Prepare flash tree and images of the selection without flashing.
+        """
+        return self.run('prepare', selection, options)
+
+    def images(self, selection:ConfigSelection, targets:list, jobs:int = 2, options:DeployOptions = None) -> DeployResult:
+        """
+        Generate images of several storage targets (eg. ["emmc", "nvme:ab"]) from one prepared rootfs.
+        """
+        return self.run('images', selection, options, ['--targets', ','.join(targets), '--jobs', str(jobs)])
+
+    def flash(self, selection:ConfigSelection, target:str = None, usb_instance:str = None, unit:str = None,
+              unit_params:str = None, unit_template:str = None, unit_files:str = None,
+              options:DeployOptions = None) -> DeployResult:
+        """
+        Flash the selection, images are prepared when missing. Parameters are the runtime options
+        of flash command (eg. usb_instance="1-4", unit="A001").
+        """
+        args = []
+        for name, value in [('--target', target), ('--usb_instance', usb_instance), ('--unit', unit),
+                            ('--unit_params', unit_params), ('--unit_template', unit_template),
+                            ('--unit_files', unit_files)]:
+            if value is not None:
+                args += [name, value]
+        return self.run('flash', selection, options, args)
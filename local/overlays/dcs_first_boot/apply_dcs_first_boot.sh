@@ -64,6 +64,8 @@ bin_destination=${L4T_rootfs_path}/usr/local/bin
 sudo cp ${resources_path}/dcs_first_boot.service ${service_destination}/
 sudo cp ${resources_path}/dcs_first_boot.sh ${bin_destination}/
 sudo chmod +x ${bin_destination}/dcs_first_boot.sh
+sudo cp ${resources_path}/apply_unit_payload.py ${bin_destination}/
+sudo chmod +x ${bin_destination}/apply_unit_payload.py
 
 sudo ln -sf /etc/systemd/system/dcs_first_boot.service ${service_destination}/multi-user.target.wants/dcs_first_boot.service
 
@@ -79,3 +81,4 @@ fi
 
 add_service_to_json "/etc/systemd/system/dcs_first_boot.service"
 add_binary_to_json "/usr/local/bin/dcs_first_boot.sh"
+add_binary_to_json "/usr/local/bin/apply_unit_payload.py"
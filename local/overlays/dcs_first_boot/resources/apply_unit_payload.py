@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Airvolute s.r.o.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Apply per-unit payload written into the image by dcs_deploy.py flash --unit.
+
+The payload file starts with a header (has to match UnitPayload in dcs_deploy.py)
+followed by tar.gz with files of the unit, which are extracted into /.
+The payload file is removed afterwards, it contains private keys.
+'''
+
+import hashlib
+import io
+import os
+import struct
+import subprocess
+import sys
+import tarfile
+
+PAYLOAD_PATH = "/var/lib/airvolute/unit_payload.bin"
+MAGIC = b"AVUNITPAYLOAD\x00\x00\x01"
+HEADER_SIZE = 4096
+HEADER_FORMAT = ">16sBQ32s"
+KIND_PAYLOAD = 1
+
+
+def read_payload(payload_path):
+    '''
+    Returns tar.gz data of payload or None when there is no payload (only placeholder).
+    '''
+    with open(payload_path, "rb") as payload_file:
+        header = payload_file.read(HEADER_SIZE)
+        magic, kind, length, sha256 = struct.unpack_from(HEADER_FORMAT, header)
+        if magic != MAGIC:
+            raise ValueError("Invalid payload header!")
+        if kind != KIND_PAYLOAD:
+            return None
+
+        data = payload_file.read(length)
+        if len(data) != length or hashlib.sha256(data).digest() != sha256:
+            raise ValueError("Payload is corrupted!")
+        return data
+
+
+def set_hostname(hostname):
+    # keep 127.0.1.1 entry in line with the new hostname
+    with open("/etc/hosts") as hosts_file:
+        lines = hosts_file.read().splitlines()
+    lines = [line for line in lines if not line.startswith("127.0.1.1")]
+    lines.append("127.0.1.1\t" + hostname)
+    with open("/etc/hosts", "w") as hosts_file:
+        hosts_file.write("\n".join(lines) + "\n")
+
+    subprocess.call(["hostname", hostname])
+
+
+def main():
+    if not os.path.isfile(PAYLOAD_PATH):
+        print("No unit payload.")
+        return 0
+
+    try:
+        data = read_payload(PAYLOAD_PATH)
+    except (OSError, ValueError, struct.error) as e:
+        print("Could not read unit payload: %s" % str(e))
+        return 1
+
+    if data is None:
+        print("Image was not personalised.")
+    else:
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as payload:
+            names = payload.getnames()
+            payload.extractall("/")
+        for name in names:
+            print("Applied /" + name)
+
+        if "etc/hostname" in names:
+            with open("/etc/hostname") as hostname_file:
+                set_hostname(hostname_file.read().strip())
+
+    os.remove(PAYLOAD_PATH)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
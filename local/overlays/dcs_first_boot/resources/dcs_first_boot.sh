@@ -2,29 +2,20 @@
 
 source /etc/profile
 
-# Re-generate SSH keys and access
+# Group membership, enabling hardware services, module dependencies and
+# ownership of /home/dcs_user/Airvolute are set up in the rootfs by
+# resources/provision_rootfs.sh during dcs_deploy, only per-device
+# setup is left here.
+
+# Apply per-unit payload (hostname, SSH host keys, ...) written at flash time
+if [ -f "/usr/local/bin/apply_unit_payload.py" ]; then
+    sudo python3 /usr/local/bin/apply_unit_payload.py
+fi
+
+# Re-generate SSH keys and access, keys from unit payload are kept
 sudo ssh-keygen -A
 sudo systemctl restart sshd
 echo "SSH configuration completed"
 
-sudo usermod -a -G i2c dcs_user
-sudo usermod -a -G gpio dcs_user
-sudo usermod -a -G dialout dcs_user
-sudo usermod -a -G spi dcs_user
-sudo udevadm control --reload-rules && udevadm trigger
-
-if [ -f "/usr/local/bin/handle_hardware_services.sh" ]; then
-    if ! sudo /usr/local/bin/handle_hardware_services.sh; then
-        echo "Error: handle_hardware_services.sh execution failed."
-        exit 1
-    fi
-else
-    echo "Error: handle_hardware_services.sh not found."
-fi
-
-# Add dcs_user to the /home/dcs_user/Airvolute folder recursively
-sudo chown -R dcs_user:dcs_user /home/dcs_user/Airvolute
-sudo depmod -a
 # rm first boot check file, so this setup runs only once
 sudo rm /etc/first_boot
-sudo reboot
\ No newline at end of file
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Installs services, udev rules, debs, libraries, utilities and docs from resources
+# compatible with the flashed configuration. Everything installed is listed in
+# dcs_deploy_data.json of the rootfs. Services to enable are listed in
+# handle_hardware_services.sh, provision_rootfs.sh enables them offline by
+# systemctl --root.
+#
+# apply_hardware_support_layer.sh is the shell version of this overlay producing the
+# same rootfs, install_overlay_dir runs this file when both exist.
+
+import glob
+import os
+
+from dcs_overlay import LocalOverlay, OverlayError, load_compatible, is_compatible
+
+SERVICES_SCRIPT = "handle_hardware_services.sh"
+UTIL_DEVICE_FOLDER = "/home/dcs_user/Airvolute/resources"
+DOCS_DEVICE_FOLDER = "/home/dcs_user/Airvolute/docs"
+DEB_CACHE = "/var/cache/dcs_deploy/debs"
+
+
+class HardwareSupportLayer(LocalOverlay):
+    def apply(self, rootfs, config):
+        self.rootfs = rootfs
+        self.config = config
+        self.manifest = self.get_manifest(rootfs)
+        self.enabled_services = []
+        os.makedirs(self.device_path(DOCS_DEVICE_FOLDER), exist_ok=True)
+
+        resources_path = os.path.join(self.overlay_dir, "resources")
+        installers = {
+            "services": self.add_service,
+            "udevs": self.add_udev,
+            "debs": self.add_deb,
+            "libs": self.add_lib,
+            "utilities": self.add_utility,
+            "apply": self.apply_patch,
+            "docs": self.add_docs,
+        }
+
+        for patch_type in sorted(os.listdir(resources_path)):
+            if patch_type not in installers:
+                continue
+            type_path = os.path.join(resources_path, patch_type)
+            for patch in sorted(os.listdir(type_path)):
+                patch_dir = os.path.join(type_path, patch)
+                if not os.path.isdir(patch_dir):
+                    continue
+                rules = load_compatible(os.path.join(patch_dir, "compatible"))
+                if rules is None or not is_compatible(rules, config):
+                    print("Skipping patch: %s" % patch_dir)
+                    continue
+                print("Adding %s patch: %s" % (patch_type, patch_dir))
+                installers[patch_type](patch_dir)
+
+        script = "#!/bin/bash\n" + "".join("sudo systemctl enable %s\n" % name for name in self.enabled_services)
+        self.write_file(self.device_path("/usr/local/bin", SERVICES_SCRIPT), script, 0o755)
+        self.manifest.add("binaries", "/usr/local/bin/" + SERVICES_SCRIPT)
+
+    def device_path(self, *path):
+        return os.path.join(self.rootfs, *[part.lstrip("/") for part in path])
+
+    def patch_files(self, patch_dir, pattern="*"):
+        return sorted(
+            path for path in glob.glob(os.path.join(patch_dir, pattern))
+            if os.path.isfile(path) and os.path.basename(path) != "compatible"
+        )
+
+    def add_service(self, patch_dir):
+        name = os.path.basename(patch_dir)
+        service_path = os.path.join(patch_dir, name + ".service")
+        binaries = [os.path.join(patch_dir, name + ext) for ext in [".py", ".sh"]]
+        binaries = [path for path in binaries if os.path.isfile(path)]
+        if not binaries:
+            raise OverlayError("No .sh or .py file found for %s in %s" % (name, patch_dir))
+        if not os.path.isfile(service_path):
+            print("Skipping patch: %s" % patch_dir)
+            return
+
+        self.install(service_path, self.device_path("/etc/systemd/system", name + ".service"))
+        self.manifest.add("services", "/etc/systemd/system/%s.service" % name)
+
+        binary_name = os.path.basename(binaries[0])
+        self.install(binaries[0], self.device_path("/usr/local/bin", binary_name), 0o755)
+        self.manifest.add("binaries", "/usr/local/bin/" + binary_name)
+
+        self.enabled_services.append(name + ".service")
+
+    def add_udev(self, patch_dir):
+        for path in self.patch_files(patch_dir, "*.rules"):
+            name = os.path.basename(path)
+            self.install(path, self.device_path("/etc/udev/rules.d", name))
+            self.manifest.add("udev", "/etc/udev/rules.d/" + name)
+
+    def add_deb(self, patch_dir):
+        for path in self.patch_files(patch_dir, "*.deb"):
+            name = os.path.basename(path)
+            # dcs_deploy runs a chroot session, install the package in it after all overlays
+            if self.config.chroot_queue:
+                self.install(path, self.device_path(DEB_CACHE, name))
+                self.queue_command(self.rootfs, self.config,
+                                   "dpkg -i %s/%s && rm -f %s/%s" % (DEB_CACHE, name, DEB_CACHE, name))
+                print("Queued installation of %s into %s/" % (name, self.rootfs))
+            else:
+                print("Installing %s into %s/" % (name, self.rootfs))
+                if self.run(["dpkg", "--root=" + self.rootfs, "--force-architecture", "-i", path], self.config):
+                    raise OverlayError("Failed to install %s into %s/" % (name, self.rootfs))
+            self.manifest.add("deb", name)
+
+    def add_lib(self, patch_dir):
+        # Libraries are imported by services and utilities, place them next to both
+        for path in self.patch_files(patch_dir, "*.py"):
+            name = os.path.basename(path)
+            self.install(path, self.device_path("/usr/local/bin", name))
+            self.manifest.add("binaries", "/usr/local/bin/" + name)
+            self.install(path, self.device_path(UTIL_DEVICE_FOLDER, name))
+            self.manifest.add("binaries", "%s/%s" % (UTIL_DEVICE_FOLDER, name))
+
+    def add_utility(self, patch_dir):
+        for path in self.patch_files(patch_dir):
+            name = os.path.basename(path)
+            self.install(path, self.device_path(UTIL_DEVICE_FOLDER, name), 0o755)
+            self.manifest.add("binaries", "%s/%s" % (UTIL_DEVICE_FOLDER, name))
+
+    def apply_patch(self, patch_dir):
+        for path in self.patch_files(patch_dir):
+            print("Applying patch: %s" % path)
+            if self.run(["bash", path, self.rootfs] + self.config.to_args(), self.config):
+                raise OverlayError("Patch %s failed!" % path)
+
+    def add_docs(self, patch_dir):
+        for path in self.patch_files(patch_dir):
+            name = os.path.basename(path)
+            self.install(path, self.device_path(DOCS_DEVICE_FOLDER, name))
+            self.manifest.add("binaries", "%s/%s" % (DOCS_DEVICE_FOLDER, name))
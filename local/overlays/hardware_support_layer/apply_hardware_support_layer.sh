@@ -186,6 +186,17 @@ add_deb() {
     local deb_name=$1     # The name of the .deb package (e.g., package_name.deb)
     local deb_path=$2     # The full path to the .deb package
 
+    # dcs_deploy runs a chroot session, install the package in it after all overlays
+    if [[ -n $DCS_CHROOT_QUEUE ]]; then
+        local deb_cache="/var/cache/dcs_deploy/debs"
+        sudo mkdir -p "${L4T_rootfs_path}${deb_cache}"
+        sudo cp "$deb_path" "${L4T_rootfs_path}${deb_cache}/"
+        echo "dpkg -i ${deb_cache}/${deb_name} && rm -f ${deb_cache}/${deb_name}" >> "$DCS_CHROOT_QUEUE"
+        add_deb_to_json "$deb_name"
+        echo "Queued installation of $deb_name into ${L4T_rootfs_path}/"
+        return 0
+    fi
+
     # Perform cross-architecture installation into the L4T rootfs
     echo "Installing $deb_name into ${L4T_rootfs_path}/"
     sudo dpkg --root="${L4T_rootfs_path}" --force-architecture -i "$deb_path"
@@ -201,6 +212,22 @@ add_deb() {
     echo "Successfully installed $deb_name into ${L4T_rootfs_path}/"
 }
 
+add_lib()
+{
+    local lib_name=$1
+    local lib_path=$2
+
+    # Libraries are imported by services and utilities, place them next to both
+    sudo cp $lib_path ${bin_destination}/
+    add_binary_to_json "/usr/local/bin/${lib_name}"
+
+    if [[ ! -d $util_destination ]]; then
+        sudo mkdir -p $util_destination
+    fi
+    sudo cp $lib_path ${util_destination}/
+    add_binary_to_json "$util_device_folder/${lib_name}"
+}
+
 add_docs()
 {
     local docs_name=$1
@@ -278,6 +305,16 @@ for patch_dir in $patches_dirs; do
                 else
                     echo "Skipping patch: $patch_dir"
                 fi
+            elif [[ $patch_dir == *"libs"* ]]; then
+                echo "Adding lib patch: $patch_dir"
+                lib_name=$(find "$patch_dir" -maxdepth 1 -type f -name "*.py" -exec basename {} \;)
+                lib_path="$patch_dir/$lib_name"
+
+                if [[ -f $lib_path ]]; then
+                    add_lib "$lib_name" "$lib_path"
+                else
+                    echo "Skipping patch: $patch_dir"
+                fi
             elif [[ $patch_dir == *"utilities"* ]]; then
                 echo "Adding utility patch: $patch_dir"
                 script_name=$(find "$patch_dir" -maxdepth 1 -type f ! -name "compatible" -exec basename {} \;)
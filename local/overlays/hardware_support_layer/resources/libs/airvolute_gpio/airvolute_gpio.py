@@ -0,0 +1,343 @@
+# Copyright (c) 2025 Airvolute s.r.o.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+GPIO access shared by the on-device utilities.
+
+The backend is selected at import time:
+    gpiod2 - libgpiod v2 python bindings
+    gpiod1 - libgpiod v1 python bindings (python3-libgpiod)
+    sysfs  - /sys/class/gpio, used when libgpiod is not available or
+             when a line has no gpiochip description
+
+Lines are requested once and their handles are kept open, so value
+changes do not spawn any process. Lines of one request living on the
+same gpiochip are set at once (atomically when libgpiod is used).
+
+Example:
+    HUB_NRST = GpioLine("gpiochip0", 106, 454, "PQ.06")
+    with GpioLines([HUB_NRST], values=[0]) as lines:
+        lines.set_values([1])
+'''
+
+import collections
+import errno
+import os
+import time
+
+try:
+    import gpiod
+except ImportError:
+    gpiod = None
+
+if gpiod is not None and hasattr(gpiod, "request_lines"):
+    BACKEND = "gpiod2"
+elif gpiod is not None:
+    BACKEND = "gpiod1"
+else:
+    BACKEND = "sysfs"
+
+SYSFS_GPIO_PATH = "/sys/class/gpio"
+
+# Time to wait for the sysfs line directory (and its udev permissions)
+# to appear after export.
+SYSFS_EXPORT_TIMEOUT = 1.0
+SYSFS_EXPORT_POLL_INTERVAL = 0.001
+
+DEFAULT_CONSUMER = "airvolute-gpio"
+
+# chip      - gpiochip name (f.e. gpiochip0), None when unknown
+# offset    - line offset within chip
+# sysfs     - sysfs kernel number, None when unknown
+# sysfs_name - sysfs directory name after export (f.e. PQ.06), defaults to gpio<sysfs>
+GpioLine = collections.namedtuple(
+    "GpioLine",
+    ["chip", "offset", "sysfs", "sysfs_name"],
+    defaults=[None, None, None, None]
+)
+
+
+class GpioError(Exception):
+    pass
+
+
+def get_line_backend(line):
+    '''
+    Returns backend used for line.
+    '''
+    if BACKEND != "sysfs" and line.chip is not None:
+        return BACKEND
+
+    if line.sysfs is None:
+        raise GpioError("GPIO line %s can not be accessed using sysfs!" % (line,))
+
+    return "sysfs"
+
+
+class _Gpiod1Chip:
+    def __init__(self, chip_name, offsets, consumer, output, values):
+        self.offsets = offsets
+        self.chip = gpiod.Chip(chip_name)
+        try:
+            self.bulk = self.chip.get_lines(offsets)
+            if output:
+                self.bulk.request(
+                    consumer=consumer,
+                    type=gpiod.LINE_REQ_DIR_OUT,
+                    default_vals=values
+                )
+            else:
+                self.bulk.request(consumer=consumer, type=gpiod.LINE_REQ_DIR_IN)
+        except Exception:
+            self.chip.close()
+            raise
+
+    def set_values(self, values):
+        self.bulk.set_values(values)
+
+    def get_values(self):
+        return list(self.bulk.get_values())
+
+    def release(self):
+        self.bulk.release()
+        self.chip.close()
+
+
+class _Gpiod2Chip:
+    def __init__(self, chip_name, offsets, consumer, output, values):
+        self.offsets = offsets
+        config = {}
+        for index, offset in enumerate(offsets):
+            if output:
+                config[offset] = gpiod.LineSettings(
+                    direction=gpiod.line.Direction.OUTPUT,
+                    output_value=self._to_value(values[index])
+                )
+            else:
+                config[offset] = gpiod.LineSettings(direction=gpiod.line.Direction.INPUT)
+
+        self.request = gpiod.request_lines(
+            os.path.join("/dev", chip_name),
+            consumer=consumer,
+            config=config
+        )
+
+    @staticmethod
+    def _to_value(value):
+        return gpiod.line.Value.ACTIVE if value else gpiod.line.Value.INACTIVE
+
+    def set_values(self, values):
+        self.request.set_values({
+            offset: self._to_value(value)
+            for offset, value in zip(self.offsets, values)
+        })
+
+    def get_values(self):
+        return [
+            1 if value == gpiod.line.Value.ACTIVE else 0
+            for value in self.request.get_values(self.offsets)
+        ]
+
+    def release(self):
+        self.request.release()
+
+
+class _SysfsLines:
+    '''
+    Lines accessed through sysfs. Value files are kept open and written
+    directly, lines exported by this object are unexported on release.
+    '''
+    def __init__(self, lines, output, values):
+        self.lines = lines
+        self.exported = []
+        self.fds = []
+        try:
+            for index, line in enumerate(lines):
+                line_path = self._export(line)
+                if output:
+                    # "low"/"high" sets direction and value in one write
+                    direction = "high" if values[index] else "low"
+                else:
+                    direction = "in"
+                self._write(os.path.join(line_path, "direction"), direction)
+                self.fds.append(os.open(
+                    os.path.join(line_path, "value"),
+                    os.O_RDWR if output else os.O_RDONLY
+                ))
+        except Exception:
+            self.release()
+            raise
+
+    @staticmethod
+    def _write(path, data):
+        with open(path, "w") as f:
+            f.write(data)
+
+    def _get_line_path(self, line):
+        names = [line.sysfs_name] if line.sysfs_name else []
+        names.append("gpio%d" % line.sysfs)
+        for name in names:
+            line_path = os.path.join(SYSFS_GPIO_PATH, name)
+            if os.path.isdir(line_path):
+                return line_path
+        return None
+
+    def _export(self, line):
+        line_path = self._get_line_path(line)
+        if line_path is not None:
+            return line_path
+
+        try:
+            self._write(os.path.join(SYSFS_GPIO_PATH, "export"), str(line.sysfs))
+        except OSError as e:
+            # Exported in the meantime by someone else
+            if e.errno != errno.EBUSY:
+                raise GpioError("Could not export GPIO %d: %s" % (line.sysfs, e))
+        else:
+            self.exported.append(line)
+
+        deadline = time.monotonic() + SYSFS_EXPORT_TIMEOUT
+        while True:
+            line_path = self._get_line_path(line)
+            if line_path is not None and os.access(os.path.join(line_path, "value"), os.W_OK):
+                return line_path
+            if time.monotonic() >= deadline:
+                raise GpioError("GPIO %d did not appear in %s!" % (line.sysfs, SYSFS_GPIO_PATH))
+            time.sleep(SYSFS_EXPORT_POLL_INTERVAL)
+
+    def set_values(self, values):
+        for fd, value in zip(self.fds, values):
+            os.pwrite(fd, b"1" if value else b"0", 0)
+
+    def get_values(self):
+        return [1 if os.pread(fd, 1, 0) == b"1" else 0 for fd in self.fds]
+
+    def release(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+        for line in self.exported:
+            try:
+                self._write(os.path.join(SYSFS_GPIO_PATH, "unexport"), str(line.sysfs))
+            except OSError:
+                pass
+        self.exported = []
+
+
+class GpioLines:
+    '''
+    Set of requested GPIO lines.
+
+    lines     - list of GpioLine
+    direction - "out" or "in"
+    values    - initial output values, defaults to 0 for all lines
+    '''
+    def __init__(self, lines, direction="out", values=None, consumer=DEFAULT_CONSUMER):
+        if direction not in ["in", "out"]:
+            raise ValueError("Wrong gpio direction to set!")
+
+        self.lines = list(lines)
+        self.output = direction == "out"
+        if values is None:
+            values = [0] * len(self.lines)
+        self._check_values(values)
+        # Last written output values
+        self.values = list(values)
+
+        # Group lines by handle, keep (handle, [line indexes]) pairs
+        groups = collections.OrderedDict()
+        for index, line in enumerate(self.lines):
+            backend = get_line_backend(line)
+            key = (backend, line.chip if backend != "sysfs" else None)
+            groups.setdefault(key, []).append(index)
+
+        self.handles = []
+        try:
+            for (backend, chip_name), indexes in groups.items():
+                group_lines = [self.lines[index] for index in indexes]
+                group_values = [values[index] for index in indexes]
+                if backend == "sysfs":
+                    handle = _SysfsLines(group_lines, self.output, group_values)
+                else:
+                    handle_class = _Gpiod2Chip if backend == "gpiod2" else _Gpiod1Chip
+                    handle = handle_class(
+                        chip_name,
+                        [line.offset for line in group_lines],
+                        consumer,
+                        self.output,
+                        group_values
+                    )
+                self.handles.append((handle, indexes))
+        except Exception:
+            self.release()
+            raise
+
+    def _check_values(self, values):
+        if len(values) != len(self.lines):
+            raise ValueError("Expected %d gpio values, got %d!" % (len(self.lines), len(values)))
+        for value in values:
+            if value not in [0, 1]:
+                raise ValueError("Wrong gpio value to set!")
+
+    def set_values(self, values):
+        '''
+        Set all lines. Values are given in order of lines, or as dict
+        {GpioLine: value} to change only some of them.
+        '''
+        if not self.output:
+            raise GpioError("Lines are requested as inputs!")
+
+        if isinstance(values, dict):
+            new_values = self.get_values()
+            for line, value in values.items():
+                new_values[self.lines.index(line)] = value
+            values = new_values
+
+        self._check_values(values)
+        for handle, indexes in self.handles:
+            handle_values = [values[index] for index in indexes]
+            if handle_values != [self.values[index] for index in indexes]:
+                handle.set_values(handle_values)
+        self.values = list(values)
+
+    def set_value(self, line, value):
+        self.set_values({line: value})
+
+    def get_values(self):
+        '''
+        Returns values in order of lines.
+        '''
+        if self.output:
+            return list(self.values)
+
+        values = [0] * len(self.lines)
+        for handle, indexes in self.handles:
+            for index, value in zip(indexes, handle.get_values()):
+                values[index] = value
+        return values
+
+    def get_value(self, line):
+        return self.get_values()[self.lines.index(line)]
+
+    def release(self):
+        for handle, _ in self.handles:
+            handle.release()
+        self.handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,291 @@
+# Copyright (c) 2025 Airvolute s.r.o.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+USB re-enumeration helpers shared by the on-device utilities.
+
+USB devices are identified by their sysfs names, which follow the
+topology: 1-2.3 is port 3 of the hub attached to port 2 of root hub of
+bus 1. Re-enumeration can be limited to a single port (logical port
+disconnect) or to a single hub (hub driver rebind), so other USB
+devices keep running.
+
+The FMU/cube USB mux selects which of the two devices is connected to the
+single port behind it, switch_device() sets the mux and re-enumerates that
+port only.
+'''
+
+import os
+import time
+
+from airvolute_gpio import GpioLines
+
+USB_SYSFS_PATH = "/sys/bus/usb"
+
+# USB vendor ids of devices behind the FMU/cube mux
+DEVICE_VENDORS = {
+    'fmu': ["26ac", "1209"],
+    'cube': ["2dae"],
+}
+
+# Mux GPIO value selecting the device
+MUX_VALUES = {
+    'fmu': 1,
+    'cube': 0,
+}
+
+# Port the selected device enumerated on last time, used when no device
+# behind the mux is enumerated at the moment of switching
+MUX_PORT_PATH = "/var/lib/airvolute/usb_mux_port"
+
+DEFAULT_WAIT_TIMEOUT = 5.0
+WAIT_POLL_INTERVAL = 0.02
+
+# Time the port is kept logically disconnected
+PORT_DISABLE_TIME = 0.05
+
+
+class UsbError(Exception):
+    pass
+
+
+def get_devices_path():
+    return os.path.join(USB_SYSFS_PATH, "devices")
+
+
+def read_attribute(name, attribute):
+    '''
+    Returns stripped content of sysfs attribute of USB device or None.
+    '''
+    try:
+        with open(os.path.join(get_devices_path(), name, attribute)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def write_attribute(path, value):
+    try:
+        with open(path, "w") as f:
+            f.write(value)
+    except OSError as e:
+        raise UsbError("Could not write %s to %s: %s" % (value, path, e))
+
+
+def list_devices(vendors=None):
+    '''
+    Returns dict {device name: devnum} of enumerated USB devices (hubs included),
+    optionally filtered by list of vendor ids (f.e. ["2dae"]).
+    '''
+    try:
+        names = os.listdir(get_devices_path())
+    except OSError:
+        return {}
+
+    devices = {}
+    for name in names:
+        # Skip interfaces (1-2:1.0) and root hubs (usb1)
+        if ":" in name or not name[0].isdigit():
+            continue
+
+        if vendors is not None and read_attribute(name, "idVendor") not in vendors:
+            continue
+
+        devnum = read_attribute(name, "devnum")
+        if devnum is not None:
+            devices[name] = devnum
+
+    return devices
+
+
+def find_port(vendors):
+    '''
+    Returns port of the single enumerated device from vendors, None otherwise.
+    '''
+    devices = list_devices(vendors)
+    if len(devices) != 1:
+        return None
+
+    return list(devices)[0]
+
+
+def split_port(port):
+    '''
+    Returns (parent hub interface, port directory) for device port name.
+
+    1-2.3 -> (1-2:1.0, 1-2-port3)
+    1-2   -> (1-0:1.0, usb1-port2)
+    '''
+    try:
+        bus, path = port.split("-", 1)
+        hops = path.split(".")
+        for number in [bus] + hops:
+            if not number.isdigit():
+                raise ValueError(number)
+        port_number = int(hops[-1])
+    except ValueError:
+        raise UsbError("Invalid USB port: %s" % port)
+
+    if len(hops) == 1:
+        return "%s-0:1.0" % bus, "usb%s-port%d" % (bus, port_number)
+
+    parent = "%s-%s" % (bus, ".".join(hops[:-1]))
+    return "%s:1.0" % parent, "%s-port%d" % (parent, port_number)
+
+
+def get_hub_driver_path():
+    '''
+    Detects the correct path for USB drivers (either /drivers or /hub/drivers).
+    '''
+    drivers_path = os.path.join(USB_SYSFS_PATH, "drivers")
+    if os.path.exists(os.path.join(drivers_path, "unbind")):
+        return drivers_path
+    elif os.path.exists(os.path.join(drivers_path, "hub", "unbind")):
+        return os.path.join(drivers_path, "hub")
+
+    raise UsbError("Unable to detect USB driver path.")
+
+
+def rebind_hub(interface):
+    '''
+    Rebind hub driver of hub interface (f.e. 1-0:1.0 for root hub of bus 1).
+    All devices behind the hub are re-enumerated.
+    '''
+    driver_path = get_hub_driver_path()
+    write_attribute(os.path.join(driver_path, "unbind"), interface)
+    write_attribute(os.path.join(driver_path, "bind"), interface)
+
+
+def reset_port(port):
+    '''
+    Re-enumerate device on port only. When the kernel does not offer port
+    disable attribute, the parent hub is rebound instead.
+    '''
+    interface, port_dir = split_port(port)
+    disable_path = os.path.join(get_devices_path(), interface, port_dir, "disable")
+
+    if os.path.exists(disable_path):
+        write_attribute(disable_path, "1")
+        time.sleep(PORT_DISABLE_TIME)
+        write_attribute(disable_path, "0")
+    else:
+        rebind_hub(interface)
+
+
+def is_driver_bound(name):
+    '''
+    Returns True when all interfaces of device have a driver bound.
+    '''
+    interfaces = [
+        entry for entry in os.listdir(get_devices_path())
+        if entry.startswith(name + ":")
+    ]
+    if not interfaces:
+        return False
+
+    return all(
+        os.path.exists(os.path.join(get_devices_path(), interface, "driver"))
+        for interface in interfaces
+    )
+
+
+def wait_for_device(vendors, previous, port=None, timeout=DEFAULT_WAIT_TIMEOUT):
+    '''
+    Wait until a device from vendors is newly enumerated and has its drivers bound.
+
+    previous - list_devices() result from before the re-enumeration,
+               devices with unchanged devnum are not considered new
+    port     - accept device only on this port
+
+    Returns device name or None on timeout.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        for name, devnum in list_devices(vendors).items():
+            if port is not None and name != port:
+                continue
+            if previous.get(name) == devnum:
+                continue
+            if is_driver_bound(name):
+                return name
+
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(WAIT_POLL_INTERVAL)
+
+
+def read_mux_port():
+    try:
+        with open(MUX_PORT_PATH) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def write_mux_port(port):
+    try:
+        os.makedirs(os.path.dirname(MUX_PORT_PATH), exist_ok=True)
+        with open(MUX_PORT_PATH, "w") as f:
+            f.write(port + "\n")
+    except OSError:
+        pass
+
+
+def reset_usb(port=None):
+    '''
+    Re-enumerate USB behind the mux. Only the given port is reset, without
+    port the whole root hub 1-0:1.0 is rebound and all USB devices reset.
+    '''
+    if port is None:
+        rebind_hub("1-0:1.0")
+    else:
+        reset_port(port)
+
+
+def switch_device(mux_line, device, port=None, full_reset=False, timeout=DEFAULT_WAIT_TIMEOUT):
+    '''
+    Select device ('fmu' or 'cube') by the USB mux and re-enumerate it.
+
+    mux_line   - GpioLine driving the mux
+    port       - USB port behind the mux, detected when not set
+    full_reset - reset all USB devices instead of the mux port only
+
+    Returns USB device name of the selected device.
+    '''
+    if device not in MUX_VALUES:
+        raise ValueError("Invalid device selection. Choose 'fmu' or 'cube'.")
+
+    if full_reset:
+        port = None
+    elif port is None:
+        port = find_port(DEVICE_VENDORS['fmu'] + DEVICE_VENDORS['cube']) or read_mux_port()
+        if port is None:
+            raise UsbError("USB port behind the mux not found, set the port or request a full reset.")
+
+    previous = list_devices()
+    # The line is held until the device enumerates. Tegra keeps driving the
+    # last value after the line is released, which the mux relies on (the
+    # sysfs version of this utility unexported the line right after writing).
+    with GpioLines([mux_line], values=[MUX_VALUES[device]], consumer="fmu-cube-usb-switch"):
+        reset_usb(port)
+
+        # Any device newly enumerated on the mux port is the selected one
+        vendors = None if port is not None else DEVICE_VENDORS[device]
+        name = wait_for_device(vendors, previous, port=port, timeout=timeout)
+
+    if name is None:
+        raise UsbError("%s did not enumerate within %s s." % (device, timeout))
+
+    write_mux_port(name)
+    return name
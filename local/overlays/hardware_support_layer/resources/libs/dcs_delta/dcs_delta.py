@@ -0,0 +1,838 @@
+# Copyright (c) 2025 Airvolute s.r.o.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+File level delta updates of the root filesystem.
+
+    make    - compare two rootfs trees and write delta bundle (run on the host
+              by dcs_deploy.py make-delta)
+    info    - print content of delta bundle
+    apply   - apply delta bundle to the running system (or to --root)
+    recover - roll back interrupted apply, run at boot by dcs_delta_recover service
+
+Bundle is xz compressed tar with manifest.json followed by payloads of files.
+Payload of a changed file is either the whole file or a block diff against the
+file on the device ("copy from old file" and "literal data" operations).
+
+Apply first verifies files the diffs are based on and prepares all new files in
+a staging directory on the same filesystem. Then the files are moved in place
+with rename(2). Replaced and deleted files are kept (hard linked) in a backup
+directory until the whole bundle is committed by removing the journal in
+/var/lib/dcs_delta. The journal allows rolling back an update interrupted eg. by
+power loss.
+
+Example:
+    sudo python3 /usr/local/bin/dcs_delta.py apply update.dcsdelta
+'''
+
+import argparse
+import base64
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import stat
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+import fcntl
+
+BUNDLE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+# state of apply, relative to root
+STATE_DIR = os.path.join("var", "lib", "dcs_delta")
+RELEASE_FILE = os.path.join("etc", "nv_tegra_release")
+# mount points of virtual filesystems and runtime state are not part of the update
+EXCLUDED = set(["dev", "proc", "sys", "run", "tmp", STATE_DIR])
+
+HASH_BLOCK_SIZE = 1024 * 1024
+COPY_BLOCK_SIZE = 1024 * 1024
+
+DIFF_MAGIC = b"DCSDIFF1"
+DIFF_BLOCK_SIZE = 4096
+# moved content is searched for by the first bytes of a block near the expected offset
+DIFF_ANCHOR_SIZE = 32
+DIFF_SEARCH_WINDOW = 64 * 1024
+DIFF_SEARCH_CANDIDATES = 8
+# diff is used only when literal data take less than this part of the file
+DIFF_MAX_LITERAL_RATIO = 0.5
+DEFAULT_DIFF_MIN_SIZE = 1024 * 1024
+
+
+class DeltaError(Exception):
+    pass
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f TB" % size
+
+
+def parse_size(size):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = size.strip().upper().rstrip("B")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source_file:
+        for block in iter(lambda: source_file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_type(st):
+    if stat.S_ISDIR(st.st_mode):
+        return "dir"
+    if stat.S_ISREG(st.st_mode):
+        return "file"
+    if stat.S_ISLNK(st.st_mode):
+        return "symlink"
+    if stat.S_ISCHR(st.st_mode):
+        return "char"
+    if stat.S_ISBLK(st.st_mode):
+        return "block"
+    if stat.S_ISFIFO(st.st_mode):
+        return "fifo"
+    # sockets are created by running programs, they are not part of the image
+    return None
+
+
+def read_xattrs(path):
+    xattrs = {}
+    try:
+        for name in os.listxattr(path, follow_symlinks=False):
+            value = os.getxattr(path, name, follow_symlinks=False)
+            xattrs[name] = base64.b64encode(value).decode()
+    except OSError:
+        pass
+    return xattrs
+
+
+def get_metadata(path, st):
+    return {
+        "mode": stat.S_IMODE(st.st_mode),
+        "uid": st.st_uid,
+        "gid": st.st_gid,
+        "mtime": st.st_mtime_ns,
+        "xattrs": read_xattrs(path),
+    }
+
+
+def set_metadata(path, metadata, kind):
+    # chown clears setuid bits and file capabilities, so it goes first
+    os.lchown(path, metadata["uid"], metadata["gid"])
+    if kind != "symlink":
+        os.chmod(path, metadata["mode"])
+    try:
+        current = set(os.listxattr(path, follow_symlinks=False))
+    except OSError:
+        current = set()
+    for name in current - set(metadata["xattrs"]):
+        os.removexattr(path, name, follow_symlinks=False)
+    for name, value in metadata["xattrs"].items():
+        os.setxattr(path, name, base64.b64decode(value), follow_symlinks=False)
+    os.utime(path, ns=(metadata["mtime"], metadata["mtime"]), follow_symlinks=False)
+
+
+def walk(root, prune=None, relative=""):
+    '''
+    Yield relative paths of tree in sorted order, parents before children.
+    Directories for which prune(path) is True are not entered. EXCLUDED paths are skipped.
+    '''
+    for name in sorted(os.listdir(os.path.join(root, relative) if relative else root)):
+        path = os.path.join(relative, name) if relative else name
+        if path in EXCLUDED:
+            continue
+        yield path
+        full_path = os.path.join(root, path)
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            if prune is None or not prune(path):
+                yield from walk(root, prune, path)
+
+
+def read_release(root):
+    try:
+        with open(os.path.join(root, RELEASE_FILE)) as release_file:
+            return release_file.readline().strip()
+    except OSError:
+        return None
+
+
+def common_prefix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class DiffWriter:
+    def __init__(self, diff_file, new_size):
+        self.diff_file = diff_file
+        self.literal = bytearray()
+        self.literal_size = 0
+        diff_file.write(DIFF_MAGIC + struct.pack(">Q", new_size))
+
+    def copy(self, offset, length):
+        self.flush()
+        self.diff_file.write(b"C" + struct.pack(">QQ", offset, length))
+
+    def add_literal(self, data):
+        self.literal += data
+        self.literal_size += len(data)
+        if len(self.literal) >= COPY_BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.literal:
+            self.diff_file.write(b"L" + struct.pack(">Q", len(self.literal)))
+            self.diff_file.write(self.literal)
+            self.literal = bytearray()
+
+    def close(self):
+        self.flush()
+        self.diff_file.write(b"E")
+
+
+def make_diff(old_path, new_path, diff_file):
+    '''
+    Write block diff of new file against old file. Unchanged parts are found at the
+    expected offset, at aligned offsets of the old file and near the expected offset
+    (moved content). Returns number of literal bytes in the diff.
+    '''
+    with open(old_path, "rb") as old_file, open(new_path, "rb") as new_file:
+        old = mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ)
+        new = mmap.mmap(new_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            old_size, new_size = len(old), len(new)
+            index = {}
+            for offset in range(0, old_size - DIFF_BLOCK_SIZE + 1, DIFF_BLOCK_SIZE):
+                index.setdefault(hash(old[offset:offset + DIFF_BLOCK_SIZE]), offset)
+
+            writer = DiffWriter(diff_file, new_size)
+            position = 0
+            expected = 0
+            while position < new_size:
+                block = new[position:position + DIFF_BLOCK_SIZE]
+                match = None
+                if old[expected:expected + len(block)] == block:
+                    match = expected
+                else:
+                    candidate = index.get(hash(block)) if len(block) == DIFF_BLOCK_SIZE else None
+                    if candidate is not None and old[candidate:candidate + DIFF_BLOCK_SIZE] == block:
+                        match = candidate
+                    elif len(block) >= DIFF_ANCHOR_SIZE:
+                        anchor = block[:DIFF_ANCHOR_SIZE]
+                        end = min(old_size, expected + DIFF_SEARCH_WINDOW + len(block))
+                        candidate = old.find(anchor, max(0, expected - DIFF_SEARCH_WINDOW), end)
+                        for _ in range(DIFF_SEARCH_CANDIDATES):
+                            if candidate == -1:
+                                break
+                            if old[candidate:candidate + len(block)] == block:
+                                match = candidate
+                                break
+                            candidate = old.find(anchor, candidate + 1, end)
+
+                if match is None:
+                    writer.add_literal(block)
+                    position += len(block)
+                    expected += len(block)
+                    continue
+
+                length = len(block)
+                while position + length < new_size and match + length < old_size:
+                    step = min(DIFF_BLOCK_SIZE, new_size - position - length, old_size - match - length)
+                    new_part = new[position + length:position + length + step]
+                    old_part = old[match + length:match + length + step]
+                    if new_part != old_part:
+                        length += common_prefix(new_part, old_part)
+                        break
+                    length += step
+                writer.copy(match, length)
+                position += length
+                expected = match + length
+            writer.close()
+            return writer.literal_size
+        finally:
+            old.close()
+            new.close()
+
+
+def apply_diff(old_path, diff_stream, output_file):
+    '''
+    Write file reconstructed from old file and diff into output_file.
+    '''
+    def read_exact(size):
+        data = diff_stream.read(size)
+        if len(data) != size:
+            raise DeltaError("diff of %s is truncated" % old_path)
+        return data
+
+    if read_exact(len(DIFF_MAGIC)) != DIFF_MAGIC:
+        raise DeltaError("invalid diff of %s" % old_path)
+    new_size = struct.unpack(">Q", read_exact(8))[0]
+    written = 0
+    with open(old_path, "rb") as old_file:
+        while True:
+            op = read_exact(1)
+            if op == b"E":
+                break
+            if op == b"C":
+                offset, length = struct.unpack(">QQ", read_exact(16))
+                old_file.seek(offset)
+                while length > 0:
+                    data = old_file.read(min(length, COPY_BLOCK_SIZE))
+                    if not data:
+                        raise DeltaError("%s is shorter than the diff expects" % old_path)
+                    output_file.write(data)
+                    length -= len(data)
+                    written += len(data)
+            elif op == b"L":
+                length = struct.unpack(">Q", read_exact(8))[0]
+                while length > 0:
+                    data = read_exact(min(length, COPY_BLOCK_SIZE))
+                    output_file.write(data)
+                    length -= len(data)
+                    written += len(data)
+            else:
+                raise DeltaError("invalid diff operation %r of %s" % (op, old_path))
+    if written != new_size:
+        raise DeltaError("diff of %s produced %d bytes instead of %d" % (old_path, written, new_size))
+
+
+def make_bundle(old_root, new_root, output, diff_min_size=DEFAULT_DIFF_MIN_SIZE, checksum=False):
+    '''
+    Compare rootfs trees and write delta bundle updating old_root to new_root.
+    '''
+    old_root = os.path.abspath(old_root)
+    new_root = os.path.abspath(new_root)
+    entries = []
+    changed_paths = set()
+    first_links = {}
+    tmp_dir = tempfile.mkdtemp(prefix="dcs_delta_")
+    stats = {"add": 0, "change": 0, "replace": 0, "meta": 0, "diff": 0}
+    try:
+        for path in walk(new_root):
+            new_path = os.path.join(new_root, path)
+            old_path = os.path.join(old_root, path)
+            new_st = os.lstat(new_path)
+            kind = get_type(new_st)
+            if kind is None:
+                continue
+            entry = {"path": path, "type": kind}
+            entry.update(get_metadata(new_path, new_st))
+            try:
+                old_st = os.lstat(old_path)
+                old_kind = get_type(old_st)
+            except (FileNotFoundError, NotADirectoryError):
+                old_st = None
+                old_kind = None
+
+            if kind == "file" and new_st.st_nlink > 1:
+                inode = (new_st.st_dev, new_st.st_ino)
+                if inode in first_links:
+                    target = first_links[inode]
+                    entry["type"] = "hardlink"
+                    entry["linkname"] = target
+                    old_target = os.path.join(old_root, target)
+                    unchanged = (target not in changed_paths and old_kind == "file" and os.path.isfile(old_target) and
+                                 os.path.samestat(old_st, os.lstat(old_target)))
+                    if not unchanged:
+                        entry["action"] = "add" if old_st is None else "replace"
+                        entries.append(entry)
+                        changed_paths.add(path)
+                        stats[entry["action"]] += 1
+                    continue
+                first_links[inode] = path
+
+            if kind == "symlink":
+                entry["linkname"] = os.readlink(new_path)
+            if kind in ["char", "block"]:
+                entry["rdev"] = new_st.st_rdev
+
+            if old_st is None:
+                entry["action"] = "add"
+            elif old_kind != kind:
+                entry["action"] = "replace"
+            else:
+                content_changed = False
+                if kind == "file":
+                    content_changed = (old_st.st_size != new_st.st_size or
+                                       ((checksum or old_st.st_mtime_ns != new_st.st_mtime_ns) and
+                                        file_sha256(old_path) != file_sha256(new_path)))
+                elif kind == "symlink":
+                    content_changed = os.readlink(old_path) != entry["linkname"]
+                elif kind in ["char", "block"]:
+                    content_changed = old_st.st_rdev != new_st.st_rdev
+                if content_changed:
+                    entry["action"] = "change"
+                elif get_metadata(old_path, old_st) != get_metadata(new_path, new_st):
+                    entry["action"] = "meta"
+                else:
+                    continue
+
+            if kind == "file" and entry["action"] != "meta":
+                entry["size"] = new_st.st_size
+                entry["sha256"] = file_sha256(new_path)
+                entry["data"] = "data/%d" % len(entries)
+                entry["payload"] = "full"
+                if (entry["action"] == "change" and new_st.st_size >= diff_min_size and
+                        old_st.st_size >= DIFF_BLOCK_SIZE):
+                    diff_path = os.path.join(tmp_dir, str(len(entries)))
+                    with open(diff_path, "wb") as diff_file:
+                        literal_size = make_diff(old_path, new_path, diff_file)
+                    if literal_size < new_st.st_size * DIFF_MAX_LITERAL_RATIO:
+                        entry["payload"] = "diff"
+                        entry["base_sha256"] = file_sha256(old_path)
+                        stats["diff"] += 1
+                    else:
+                        os.remove(diff_path)
+            entries.append(entry)
+            changed_paths.add(path)
+            stats[entry["action"]] += 1
+
+        # only the topmost deleted path is recorded, removed directory goes with its content
+        deleted = []
+        def prune(path):
+            new_path = os.path.join(new_root, path)
+            return not os.path.isdir(new_path) or os.path.islink(new_path)
+        for path in walk(old_root, prune):
+            if not os.path.lexists(os.path.join(new_root, path)):
+                deleted.append(path)
+
+        manifest = {
+            "version": BUNDLE_VERSION,
+            "created": time.time(),
+            "base_release": read_release(old_root),
+            "target_release": read_release(new_root),
+            "deleted": deleted,
+            "entries": entries,
+        }
+        manifest_data = json.dumps(manifest).encode()
+        tmp_output = output + ".%d.tmp" % os.getpid()
+        with tarfile.open(tmp_output, "w:xz") as bundle:
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(manifest_data)
+            info.mtime = int(manifest["created"])
+            bundle.addfile(info, fileobj=_BytesReader(manifest_data))
+            for i, entry in enumerate(entries):
+                if "data" not in entry:
+                    continue
+                source = os.path.join(tmp_dir, str(i)) if entry["payload"] == "diff" else os.path.join(new_root, entry["path"])
+                info = tarfile.TarInfo(entry["data"])
+                info.size = os.path.getsize(source)
+                info.mtime = int(manifest["created"])
+                with open(source, "rb") as source_file:
+                    bundle.addfile(info, fileobj=source_file)
+        os.replace(tmp_output, output)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print("Delta %s -> %s" % (manifest["base_release"], manifest["target_release"]))
+    print("added: %d, changed: %d (%d as diff), replaced: %d, metadata only: %d, deleted: %d" % (
+        stats["add"], stats["change"], stats["diff"], stats["replace"], stats["meta"], len(deleted)))
+    print("Bundle %s: %s" % (output, format_size(os.path.getsize(output))))
+    return 0
+
+
+class _BytesReader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.offset
+        data = self.data[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+def read_manifest(bundle):
+    member = bundle.next()
+    if member is None or member.name != MANIFEST_NAME:
+        raise DeltaError("%s is not a delta bundle" % bundle.name)
+    manifest = json.load(bundle.extractfile(member))
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise DeltaError("unsupported bundle version %s" % manifest.get("version"))
+    return manifest
+
+
+class DeltaUpdate:
+    '''
+    Apply of delta bundle to root. State (journal, staged and backed up files) is kept
+    in <root>/var/lib/dcs_delta.
+    '''
+    def __init__(self, root="/"):
+        self.root = os.path.abspath(root)
+        self.state_path = os.path.join(self.root, STATE_DIR)
+        self.staging_path = os.path.join(self.state_path, "staging")
+        self.backup_path = os.path.join(self.state_path, "backup")
+        self.journal_path = os.path.join(self.state_path, "journal.json")
+        self.lock_file = None
+
+    def lock(self):
+        os.makedirs(self.state_path, exist_ok=True)
+        self.lock_file = open(os.path.join(self.state_path, "lock"), "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise DeltaError("another update is running")
+
+    def target(self, path):
+        return os.path.join(self.root, path)
+
+    def check_filesystem(self, path):
+        '''
+        Files are moved in place by rename, staging must be on the same filesystem.
+        '''
+        existing = os.path.dirname(self.target(path))
+        while not os.path.lexists(existing):
+            existing = os.path.dirname(existing)
+        return os.stat(existing).st_dev == os.stat(self.state_path).st_dev
+
+    def verify(self, manifest, force):
+        '''
+        Check the bundle can be applied. Different release is allowed with force, diffs
+        can be applied only to the exact file they are made for.
+        '''
+        errors = []
+        release = read_release(self.root)
+        if manifest["base_release"] is not None and release != manifest["base_release"]:
+            message = "bundle is made for %s, system is %s" % (manifest["base_release"], release)
+            if force:
+                print("Warning: " + message)
+            else:
+                errors.append(message)
+        for entry in manifest["entries"]:
+            target = self.target(entry["path"])
+            if entry.get("payload") == "diff":
+                if not os.path.isfile(target) or os.path.islink(target):
+                    errors.append("%s is missing, diff can not be applied" % entry["path"])
+                elif file_sha256(target) != entry["base_sha256"]:
+                    errors.append("%s differs from the file the diff is made for" % entry["path"])
+            if not self.check_filesystem(entry["path"]):
+                errors.append("%s is on another filesystem than %s" % (entry["path"], self.state_path))
+        for path in manifest["deleted"]:
+            if os.path.lexists(self.target(path)) and not self.check_filesystem(path):
+                errors.append("%s is on another filesystem than %s" % (path, self.state_path))
+
+        for error in errors:
+            print("Error: " + error)
+        if errors:
+            raise DeltaError("bundle can not be applied (%d errors)" % len(errors))
+
+    def stage(self, bundle, manifest):
+        '''
+        Prepare new files, symlinks and special files in staging directory.
+        '''
+        entries = {entry["data"]: (i, entry) for i, entry in enumerate(manifest["entries"]) if "data" in entry}
+        for member in bundle:
+            if member.name not in entries:
+                continue
+            i, entry = entries.pop(member.name)
+            staged = os.path.join(self.staging_path, str(i))
+            payload = bundle.extractfile(member)
+            with open(staged, "wb") as staged_file:
+                if entry["payload"] == "diff":
+                    apply_diff(self.target(entry["path"]), payload, staged_file)
+                else:
+                    shutil.copyfileobj(payload, staged_file, COPY_BLOCK_SIZE)
+                staged_file.flush()
+                os.fsync(staged_file.fileno())
+            if file_sha256(staged) != entry["sha256"]:
+                raise DeltaError("checksum of %s does not match" % entry["path"])
+            set_metadata(staged, entry, "file")
+        if entries:
+            raise DeltaError("bundle is missing data of %d files" % len(entries))
+
+        for i, entry in enumerate(manifest["entries"]):
+            if entry["action"] == "meta":
+                continue
+            staged = os.path.join(self.staging_path, str(i))
+            if entry["type"] == "symlink":
+                os.symlink(entry["linkname"], staged)
+            elif entry["type"] in ["char", "block"]:
+                device_type = stat.S_IFCHR if entry["type"] == "char" else stat.S_IFBLK
+                os.mknod(staged, entry["mode"] | device_type, entry["rdev"])
+            elif entry["type"] == "fifo":
+                os.mkfifo(staged, entry["mode"])
+            else:
+                continue
+            set_metadata(staged, entry, entry["type"])
+
+    def plan(self, manifest):
+        '''
+        Operations of commit in order. State of targets before the update is recorded,
+        so the commit can be rolled back.
+        '''
+        ops = []
+        for path in manifest["deleted"]:
+            if os.path.lexists(self.target(path)):
+                ops.append({"path": path, "action": "delete", "backup": "%d" % len(ops)})
+        for i, entry in enumerate(manifest["entries"]):
+            target = self.target(entry["path"])
+            op = {"path": entry["path"], "action": entry["action"], "type": entry["type"], "entry": i,
+                  "existed": os.path.lexists(target), "backup": None, "old_metadata": None}
+            if entry["action"] == "meta":
+                old_kind = get_type(os.lstat(target)) if op["existed"] else None
+                if old_kind is None:
+                    continue
+                op["old_metadata"] = get_metadata(target, os.lstat(target))
+                op["old_type"] = old_kind
+            elif op["existed"]:
+                op["backup"] = "%d" % len(ops)
+                if entry["type"] == "dir" and os.path.isdir(target) and not os.path.islink(target):
+                    # directory stays, only its metadata changes
+                    op["backup"] = None
+                    op["old_metadata"] = get_metadata(target, os.lstat(target))
+                    op["old_type"] = "dir"
+            ops.append(op)
+        return ops
+
+    def get_parent_times(self, ops):
+        '''
+        Modification times of directories containing changed paths, they are restored on rollback.
+        '''
+        parent_times = {}
+        for op in ops:
+            parent = os.path.dirname(op["path"])
+            if parent not in parent_times and os.path.isdir(self.target(parent)):
+                parent_times[parent] = os.stat(self.target(parent)).st_mtime_ns
+        return parent_times
+
+    def write_journal(self, journal):
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w") as journal_file:
+            json.dump(journal, journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self.sync_state_dir()
+
+    def sync_state_dir(self):
+        directory = os.open(self.state_path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def commit(self, manifest, ops):
+        entries = manifest["entries"]
+        for op in ops:
+            target = self.target(op["path"])
+            backup = os.path.join(self.backup_path, op["backup"]) if op["backup"] is not None else None
+            if op["action"] == "delete":
+                os.rename(target, backup)
+                continue
+            entry = entries[op["entry"]]
+            if op["action"] == "meta":
+                if op["type"] != "dir":
+                    set_metadata(target, entry, op["type"])
+                continue
+            if op["type"] == "dir":
+                if backup is not None:
+                    os.rename(target, backup)
+                if not os.path.isdir(target):
+                    os.mkdir(target, 0o700)
+                continue
+            if backup is not None:
+                if os.path.isdir(target) and not os.path.islink(target):
+                    os.rename(target, backup)
+                else:
+                    os.link(target, backup, follow_symlinks=False)
+            if op["type"] == "hardlink":
+                staged = os.path.join(self.staging_path, "%d.link" % op["entry"])
+                os.link(self.target(entry["linkname"]), staged)
+            else:
+                staged = os.path.join(self.staging_path, str(op["entry"]))
+            os.rename(staged, target)
+
+        # adding files changes modification time of directories, set their metadata at the end
+        for op in reversed(ops):
+            if op["action"] != "delete" and op["type"] == "dir":
+                set_metadata(self.target(op["path"]), entries[op["entry"]], "dir")
+
+    def rollback(self, journal):
+        ops = journal["ops"]
+        for op in reversed(ops):
+            target = self.target(op["path"])
+            backup = os.path.join(self.backup_path, op["backup"]) if op["backup"] is not None else None
+            if backup is not None and os.path.lexists(backup):
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                elif os.path.lexists(target) and os.path.isdir(backup) and not os.path.islink(backup):
+                    os.unlink(target)
+                os.rename(backup, target)
+            elif op["action"] != "delete" and not op["existed"] and os.path.lexists(target):
+                if os.path.isdir(target) and not os.path.islink(target):
+                    try:
+                        os.rmdir(target)
+                    except OSError:
+                        pass
+                else:
+                    os.unlink(target)
+            if op.get("old_metadata") is not None and os.path.lexists(target):
+                set_metadata(target, op["old_metadata"], op["old_type"])
+        for parent, mtime in journal["parent_times"].items():
+            if os.path.isdir(self.target(parent)):
+                os.utime(self.target(parent), ns=(mtime, mtime))
+
+    def cleanup(self):
+        '''
+        Finish update after it was committed (or rolled back) and synced. Removal of the journal
+        is the commit point: backups are deleted only when the update can not be rolled back
+        anymore, otherwise rollback after power loss would restore only part of the old files.
+        '''
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+            self.sync_state_dir()
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+        shutil.rmtree(self.backup_path, ignore_errors=True)
+
+    def recover(self):
+        '''
+        Roll back update interrupted during commit. Returns True when there was one.
+        '''
+        if not os.path.exists(self.journal_path):
+            self.cleanup()
+            return False
+        with open(self.journal_path) as journal_file:
+            journal = json.load(journal_file)
+        print("Rolling back interrupted update %s ..." % journal["bundle"])
+        self.rollback(journal)
+        os.sync()
+        self.cleanup()
+        print("Update %s rolled back." % journal["bundle"])
+        return True
+
+    def apply(self, bundle_path, dry_run=False, force=False):
+        self.lock()
+        self.recover()
+        with tarfile.open(bundle_path, "r|*") as bundle:
+            manifest = read_manifest(bundle)
+            print("Applying %s (%s -> %s) to %s" % (bundle_path, manifest["base_release"],
+                                                    manifest["target_release"], self.root))
+            self.verify(manifest, force)
+            required = sum(entry.get("size", 0) for entry in manifest["entries"] if "data" in entry)
+            free = shutil.disk_usage(self.state_path).free
+            print("%d entries, %d deleted, %s of new files (free space: %s)" % (
+                len(manifest["entries"]), len(manifest["deleted"]), format_size(required), format_size(free)))
+            if free < required * 1.05:
+                raise DeltaError("not enough space, required %s, free %s" % (format_size(required), format_size(free)))
+            if dry_run:
+                return 0
+
+            os.makedirs(self.staging_path)
+            os.makedirs(self.backup_path)
+            try:
+                self.stage(bundle, manifest)
+            except BaseException:
+                self.cleanup()
+                raise
+
+        ops = self.plan(manifest)
+        journal = {"bundle": os.path.basename(bundle_path), "started": time.time(), "ops": ops,
+                   "parent_times": self.get_parent_times(ops)}
+        self.write_journal(journal)
+        try:
+            self.commit(manifest, ops)
+            os.sync()
+        except BaseException as e:
+            print("Commit failed (%s), rolling back ..." % str(e))
+            self.rollback(journal)
+            os.sync()
+            self.cleanup()
+            raise
+        self.cleanup()
+        print("Update %s applied, %s" % (bundle_path, manifest["target_release"]))
+        return 0
+
+
+def print_info(bundle_path):
+    with tarfile.open(bundle_path, "r|*") as bundle:
+        manifest = read_manifest(bundle)
+    print("base:   %s" % manifest["base_release"])
+    print("target: %s" % manifest["target_release"])
+    print("created: %s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(manifest["created"])))
+    for entry in manifest["entries"]:
+        details = entry.get("payload", "")
+        if "size" in entry:
+            details += " " + format_size(entry["size"])
+        print("%-8s %-8s %s %s" % (entry["action"], entry["type"], entry["path"], details))
+    for path in manifest["deleted"]:
+        print("%-8s %-8s %s" % ("delete", "", path))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File level delta updates of the root filesystem.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    make = subparsers.add_parser("make", help="Write delta bundle updating OLD rootfs to NEW rootfs")
+    make.add_argument("old", help="Rootfs the bundle is applied to")
+    make.add_argument("new", help="Updated rootfs")
+    make.add_argument("-o", "--output", required=True, help="Bundle path")
+    make.add_argument("--diff-min-size", default=str(DEFAULT_DIFF_MIN_SIZE),
+                      help="Changed files of at least this size are stored as block diff when it is smaller. Default: 1M")
+    make.add_argument("--checksum", action="store_true",
+                      help="Compare content of all files, not only of files with different size or modification time")
+
+    info = subparsers.add_parser("info", help="Print content of delta bundle")
+    info.add_argument("bundle")
+
+    apply = subparsers.add_parser("apply", help="Apply delta bundle")
+    apply.add_argument("bundle")
+    apply.add_argument("--root", default="/", help="Root filesystem to update (eg. mounted inactive slot). Default: /")
+    apply.add_argument("--dry-run", action="store_true", help="Only verify the bundle can be applied")
+    apply.add_argument("--force", action="store_true", help="Apply also to a different release")
+
+    recover = subparsers.add_parser("recover", help="Roll back interrupted apply")
+    recover.add_argument("--root", default="/", help="Root filesystem. Default: /")
+
+    args = parser.parse_args()
+    try:
+        if args.command == "make":
+            return make_bundle(args.old, args.new, args.output, parse_size(args.diff_min_size), args.checksum)
+        if args.command == "info":
+            return print_info(args.bundle)
+        if args.command == "apply":
+            return DeltaUpdate(args.root).apply(args.bundle, args.dry_run, args.force)
+        if args.command == "recover":
+            update = DeltaUpdate(args.root)
+            update.lock()
+            update.recover()
+            return 0
+    except (DeltaError, OSError, tarfile.TarError) as e:
+        print("Error: %s" % str(e))
+        return 1
+    parser.print_usage()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
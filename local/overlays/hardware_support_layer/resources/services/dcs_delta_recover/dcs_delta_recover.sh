@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# Delta update interrupted while its files were moved in place (eg. by power loss)
+# is rolled back, so the system runs either the old or the new release. The update
+# is committed by removing the journal, leftover staging and backup files of
+# a committed update are only deleted.
+if [ -f /var/lib/dcs_delta/journal.json ] || [ -d /var/lib/dcs_delta/backup ] || [ -d /var/lib/dcs_delta/staging ]; then
+    python3 /usr/local/bin/dcs_delta.py recover
+fi
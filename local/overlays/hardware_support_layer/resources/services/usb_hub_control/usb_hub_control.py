@@ -1,301 +1,312 @@
-# Copyright (c) 2025 Airvolute s.r.o.
-#
-# This program is free software: you can redistribute it and/or modify it under
-# the terms of the GNU General Public License as published by the Free Software
-# Foundation, either version 3 of the License, or (at your option) any later
-# version.
-#
-# This program is distributed in the hope that it will be useful, but WITHOUT
-# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
-# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License along with
-# this program. If not, see <http://www.gnu.org/licenses/>.
-
-import smbus2
-import time
-import sys
-import os
-from smbus2 import SMBus, i2c_msg
-
-
-# GPIO with numbers
-cam_mclk0 = [440, "PP.00"]
-cam_mclk1 = [441, "PP.01"]
-cam_mclk2 = [453, "PQ.05"]
-serial1_rts = [460, "PR.04"]
-serial1_cts = [461, "PR.05"]
-pwm_out1 = [433, "PN.01"]
-pwm_out2 = [391, "PH.00"]
-se_ext_drdy = [492, "PAC.06"]
-fmu_drdy = [486, "PAC.00"]
-imu_drdy = [397, "PH.06"]
-gpio_exp4 = [312, "gpio312"]
-gpio_exp5 = [313, "gpio313"]
-usb_mux_gpio = [314, "gpio314"]
-usb_hub_nrst = [454, "PQ.06"]
-usb_hub_vbusdet = [341, "PEE.02"]
-eth_swt_nrst = [331, "PCC.03"]
-can_stby = [446, "PP.06"]
-
-def set_gpiod(chipname, line_offset, value):
-    chip = gpiod.Chip(chipname)
-    line = chip.get_line(line_offset)
-
-    line.request(consumer="usb-hub-control", type=gpiod.LINE_REQ_DIR_OUT, default_val=value)
-
-    line.release()
-    chip.close()
-
-# To export_gpio function, gpios are transfered as their numbers. After export their GPIO names (f.e. PA.00) are used
-def export_gpio(gpio_kernel_number):
-    command = 'echo ' + str(gpio_kernel_number[0]) + ' > /sys/class/gpio/export'
-    os.system(command)
-    time.sleep(0.1)
-
-
-def unexport_gpio(gpio_kernel_number):
-    command = 'echo ' + str(gpio_kernel_number[0]) + ' > /sys/class/gpio/unexport'
-    os.system(command)
-
-
-def set_direction(gpio_kernel_number, direction):
-    if direction == "in" or direction == "out":
-        command = 'echo ' + direction + ' > /sys/class/gpio/' + gpio_kernel_number[1] + '/direction'
-        os.system(command)
-    else:
-        print("Wrong gpio direction to set !")
-
-
-def write_gpio(gpio_kernel_number, value):
-    if value == 1 or value == 0:
-        command = 'echo ' + str(value) + ' > /sys/class/gpio/' + gpio_kernel_number[1] + '/value'
-        os.system(command)
-    else:
-        print("Wrong gpio value to set !")
-
-
-def read_gpio(gpio_kernel_number):
-    command = 'cat /sys/class/gpio/' + gpio_kernel_number[1] + '/value'
-    ret1 = subprocess.check_output(command, shell=True)
-    return ret1[0]
-
-
-def usb2534_write_cfg_register(i2c_bus, device_address, register_address, value):
-    '''
-    register_address = 2byte (0x0000)
-    value = 1byte (0x00)
-
-    Function written following Microchip's AN.26.18 pg.4
-    https://ww1.microchip.com/downloads/aemDocuments/documents/OTH/ApplicationNotes/ApplicationNotes/00001801C.pdf
-    '''
-    if register_address < 0 or register_address > 0xFFFF:
-        raise ValueError("Register address must be a 2-byte value (0-65535).")
-    reg_msb = (register_address >> 8) & 0xFF
-    reg_lsb = register_address & 0xFF
-
-
-    bus = smbus2.SMBus(i2c_bus)
-    wr_data1 = [0x00, 0x00, 0x05, 0x00, 0x02, reg_msb, reg_lsb, value]
-    wr_data2 = [0x99, 0x37, 0x00]
-    write_msg1 = i2c_msg.write(device_address, wr_data1)
-    write_msg2 = i2c_msg.write(device_address, wr_data2)
-    try:
-        bus.i2c_rdwr(write_msg1, write_msg2)
-        bus.close()
-    except Exception as e:
-        print(f"Error write cfg register: {e}")
-        bus.close()
-
-
-def usb2534_read_cfg_register(i2c_bus, device_address, register_address):
-    '''
-    register_address = 2byte (0x0000)
-
-    Function written following Microchip's AN.26.18 pg.4
-    https://ww1.microchip.com/downloads/aemDocuments/documents/OTH/ApplicationNotes/ApplicationNotes/00001801C.pdf
-    '''
-    if register_address < 0 or register_address > 0xFFFF:
-        raise ValueError("Register address must be a 2-byte value (0-65535).")
-    reg_msb = (register_address >> 8) & 0xFF
-    reg_lsb = register_address & 0xFF
-
-
-    bus = smbus2.SMBus(i2c_bus)
-    wr_data1 = [0x00, 0x00, 0x04, 0x01, 0x01, reg_msb, reg_lsb]
-    wr_data2 = [0x99, 0x37, 0x00]
-    wr_data3 = [0x00, 0x04]
-    write_msg1 = i2c_msg.write(device_address, wr_data1)
-    write_msg2 = i2c_msg.write(device_address, wr_data2)
-    write_msg3 = i2c_msg.write(device_address, wr_data3)
-    read_msg = i2c_msg.read(device_address, 2)
-    try:
-        bus.i2c_rdwr(write_msg1, write_msg2, write_msg3, read_msg)
-        bus.close()
-    except Exception as e:
-        print(f"Error read cfg register: {e}")
-        bus.close()
-
-    return list(read_msg)[1]
-
-
-def usb2534_write_runtime_register(i2c_bus, device_address, register_address, value):
-    bus = smbus2.SMBus(i2c_bus)
-    wr_data = [register_address, value]
-    write_msg= i2c_msg.write(device_address, wr_data)
-    try:
-        bus.i2c_rdwr(write_msg)
-        bus.close()
-    except Exception as e:
-        print(f"Error write runtime register: {e}")
-        bus.close()
-
-
-def usb2534_read_runtime_register(i2c_bus, device_address, register_address):
-    bus = smbus2.SMBus(i2c_bus)
-    wr_data = [register_address]
-    write_msg= i2c_msg.write(device_address, wr_data)
-    read_msg = i2c_msg.read(device_address, 1)
-    try:
-        bus.i2c_rdwr(write_msg, read_msg)
-        bus.close()
-    except Exception as e:
-        print(f"Error read runtime register: {e}")
-        bus.close()
-
-    return list(read_msg)[0]
-
-
-def usb2534_start_hub(i2c_bus, device_address):
-    '''
-    Start USB HUB by I2C command write 0x00 to 0xAA55 register
-    '''
-    bus = smbus2.SMBus(i2c_bus)
-    wr_data1 = [0xAA, 0x55, 0x00]
-    write_msg1 = i2c_msg.write(device_address, wr_data1)
-    try:
-        bus.i2c_rdwr(write_msg1)
-        bus.close()
-    except Exception as e:
-        print(f"Error write cfg register: {e}")
-        bus.close()
-
-bus_number = 0
-dev_addr = 0x2d
-dev_addr_run = 0x2c
-
-print("Reseting USB HUB...")
-kernel_version = os.popen("uname -r").read().strip()
-
-version_tuple = tuple(map(int, kernel_version.split('-')[0].split('.')))
-
-if version_tuple > (5, 10, 120):
-    try:
-        import gpiod
-    except ImportError:
-        print("Error: The required 'python3-libgpiod' package is not installed.")
-        print("sudo apt install python3-libgpiod")
-        exit(1)
-
-    set_gpiod("gpiochip0", 106, 0)
-    time.sleep(0.5)
-    set_gpiod("gpiochip1", 25, 0)
-    time.sleep(1)
-    set_gpiod("gpiochip0", 106, 1)
-    set_gpiod("gpiochip1", 25, 1)
-else:
-    export_gpio(usb_hub_nrst)
-    export_gpio(usb_hub_vbusdet)
-    set_direction(usb_hub_nrst, 'out')
-    set_direction(usb_hub_vbusdet, 'out')
-    
-    # reset hub
-    write_gpio(usb_hub_vbusdet, 0)
-    time.sleep(0.5)
-    write_gpio(usb_hub_nrst, 0)
-    
-    time.sleep(1)
-    
-    write_gpio(usb_hub_vbusdet, 1)
-    write_gpio(usb_hub_nrst, 1)
-    unexport_gpio(usb_hub_nrst)
-    unexport_gpio(usb_hub_vbusdet)
-
-
-print("Setting up USB HUB through I2C...")
-
-################################################I2C TESTING ################################
-read_reg = 0x00
-
-#Time delay > 300ms has to be there after reseting the HUB !!!
-time.sleep(0.4)
-
-#HUB_CFG1 (Default = 0x9B)
-usb2534_write_cfg_register(bus_number, dev_addr, 0x3006, 0x9B)
-
-#HUB_CFG2 (Default = 0x20 | 0x28 - COMPOUND enabled)
-usb2534_write_cfg_register(bus_number, dev_addr, 0x3007, 0x28)
-
-#HUB_CFG3 (Default = 0x08 | PRTMAP_EN = 0, STRING_EN = 1 : 0x01)
-usb2534_write_cfg_register(bus_number, dev_addr, 0x3008, 0x01)
-
-#NON-REMOVABLE DEVICE (default = 0x06 | PORT 4 non-removable : 0x10)
-usb2534_write_cfg_register(bus_number, dev_addr, 0x3009, 0x10)
-
-#USB2_HUB_CTL (default = 0x00 | LPM_DISABLE = 1 : 0x02 )
-usb2534_write_cfg_register(bus_number, dev_addr, 0x3104, 0x02)
-
-#INTERNAL_PORT (Allow enumeration of 5.th internal port - solves issue with other device enumeration)
-usb2534_write_cfg_register(bus_number, dev_addr, 0x4130, 0x01)
-
-
-#----PORT 1 SETUP----
-#HSIC_P1_CFG (default 0x00, Power mode = 1 : 0x01)
-#usb2534_write_cfg_register(bus_number, dev_addr, 0x6643, 0x01)
-
-#PORT_CFG_SEL_1 (default = 0x01 | PERMANENT = 1 : 0x10 )
-#usb2534_write_cfg_register(bus_number, dev_addr, 0x3C00, 0x10)
-
-#--PORT 4 SETUP---
-#HSIC_P4_CFG (default 0x00, Power mode = 1 : 0x01)
-#usb2534_write_cfg_register(bus_number, dev_addr, 0x7243, 0x01)
-
-#PORT_CFG_SEL_4 (default = 0x01 | PERMANENT = 1 : 0x10 )
-#usb2534_write_cfg_register(bus_number, dev_addr, 0x3C0C, 0x10)
-
-
-
-
-read_reg = usb2534_read_cfg_register(bus_number, dev_addr, 0x3006)
-print("Read 0x3006 register value:", hex(read_reg))
-read_reg = usb2534_read_cfg_register(bus_number, dev_addr, 0x3007)
-print("Read 0x3007 register value:", hex(read_reg))
-read_reg = usb2534_read_cfg_register(bus_number, dev_addr, 0x3008)
-print("Read 0x3008 register value:", hex(read_reg))
-read_reg = usb2534_read_cfg_register(bus_number, dev_addr, 0x3009)
-print("Read 0x3009 register value:", hex(read_reg))
-read_reg = usb2534_read_cfg_register(bus_number, dev_addr, 0x3104)
-print("Read 0x3104 register value:", hex(read_reg))
-read_reg = usb2534_read_cfg_register(bus_number, dev_addr, 0x3C0C)
-print("Read 0x3C0C register value:", hex(read_reg))
-
-#Start USB HUB by command
-usb2534_start_hub(bus_number, dev_addr)
-
-
-
-#RUNTIME SECTION
-'''
-Errata sheet
-https://ww1.microchip.com/downloads/aemDocuments/documents/UNG/ProductDocuments/Errata/USB253x-USB3x13-USB46x4-Errata-80000583E.pdf
-'''
-#ERRATA NUMBER11 fix (in config)
-# REg 3128 ext. descriptor
-#usb2534_write_cfg_register(bus_number, dev_addr, 0x3128, 0x03)
-# REg 3129 ext. descriptor
-#usb2534_write_cfg_register(bus_number, dev_addr, 0x3129, 0x06)
-
-#ERRATA NUMBER12 fix (in runtime)
-#usb2534_write_runtime_register(bus_number, dev_addr_run, 0xE9, 0x00)
-#read_reg= usb2534_read_runtime_register(bus_number, dev_addr_run, 0xE9)
-#print("Read 0xE9 register value:", hex(read_reg))
\ No newline at end of file
+# Copyright (c) 2025 Airvolute s.r.o.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import sys
+import os
+from smbus2 import SMBus, i2c_msg
+
+from airvolute_gpio import BACKEND as GPIO_BACKEND, GpioLine, GpioLines
+
+
+USB_HUB_NRST = GpioLine("gpiochip0", 106, 454, "PQ.06")
+USB_HUB_VBUSDET = GpioLine("gpiochip1", 25, 341, "PEE.02")
+
+
+bus_number = 0
+dev_addr = 0x2d
+dev_addr_run = 0x2c
+
+# Electrical hold times of the reset sequence: VBUS_DET is low for
+# RESET_ASSERT_DELAY before RESET_N is asserted, RESET_N is held low for
+# RESET_HOLD_TIME. These are the values the board was validated with, they
+# are not waits for readiness (that is wait_ready()) and must not be shortened
+# without measuring the reset on the board.
+RESET_ASSERT_DELAY = 0.5
+RESET_HOLD_TIME = 1.0
+
+# After reset the hub loads its defaults and only then starts answering on
+# I2C. It is polled instead of waiting a fixed time (> 300 ms before).
+READY_TIMEOUT = 2.0
+READY_POLL_INTERVAL = 0.01
+
+# Linux limits the number of messages in one I2C_RDWR transfer.
+I2C_RDWR_MAX_MSGS = 42
+
+# Configuration registers applied before the hub is started.
+# (register address, value, description)
+HUB_CFG_REGISTERS = [
+    (0x3006, 0x9B, "HUB_CFG1 (Default = 0x9B)"),
+    (0x3007, 0x28, "HUB_CFG2 (Default = 0x20 | 0x28 - COMPOUND enabled)"),
+    (0x3008, 0x01, "HUB_CFG3 (Default = 0x08 | PRTMAP_EN = 0, STRING_EN = 1 : 0x01)"),
+    (0x3009, 0x10, "NON-REMOVABLE DEVICE (default = 0x06 | PORT 4 non-removable : 0x10)"),
+    (0x3104, 0x02, "USB2_HUB_CTL (default = 0x00 | LPM_DISABLE = 1 : 0x02)"),
+    (0x4130, 0x01, "INTERNAL_PORT (Allow enumeration of 5.th internal port - solves issue with other device enumeration)"),
+
+    #----PORT 1 SETUP----
+    # (0x6643, 0x01, "HSIC_P1_CFG (default 0x00, Power mode = 1 : 0x01)"),
+    # (0x3C00, 0x10, "PORT_CFG_SEL_1 (default = 0x01 | PERMANENT = 1 : 0x10)"),
+
+    #--PORT 4 SETUP---
+    # (0x7243, 0x01, "HSIC_P4_CFG (default 0x00, Power mode = 1 : 0x01)"),
+    # (0x3C0C, 0x10, "PORT_CFG_SEL_4 (default = 0x01 | PERMANENT = 1 : 0x10)"),
+
+    #ERRATA NUMBER11 fix (in config)
+    # (0x3128, 0x03, "ext. descriptor"),
+    # (0x3129, 0x06, "ext. descriptor"),
+]
+
+
+class Usb2534:
+    '''
+    USB2534 hub accessed through one SMBus session.
+
+    Config register access follows Microchip's AN.26.18 pg.4
+    https://ww1.microchip.com/downloads/aemDocuments/documents/OTH/ApplicationNotes/ApplicationNotes/00001801C.pdf
+
+    Any object providing smbus2's i2c_rdwr() and close() can be passed
+    as bus, which allows running this against a fake SMBus.
+    '''
+    def __init__(self, bus, device_address=dev_addr, runtime_address=dev_addr_run):
+        self.bus = bus
+        self.device_address = device_address
+        self.runtime_address = runtime_address
+
+    @classmethod
+    def open(cls, i2c_bus, device_address=dev_addr, runtime_address=dev_addr_run):
+        return cls(SMBus(i2c_bus), device_address, runtime_address)
+
+    def close(self):
+        self.bus.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _split_register_address(register_address):
+        if register_address < 0 or register_address > 0xFFFF:
+            raise ValueError("Register address must be a 2-byte value (0-65535).")
+        return (register_address >> 8) & 0xFF, register_address & 0xFF
+
+    def wait_ready(self, timeout=READY_TIMEOUT, interval=READY_POLL_INTERVAL):
+        '''
+        Poll the hub until it acknowledges its address on I2C.
+
+        Returns True when the hub answered within timeout.
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.bus.i2c_rdwr(i2c_msg.read(self.device_address, 1))
+                return True
+            except OSError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(interval)
+
+    def _cfg_write_msgs(self, register_address, value):
+        reg_msb, reg_lsb = self._split_register_address(register_address)
+        wr_data1 = [0x00, 0x00, 0x05, 0x00, 0x02, reg_msb, reg_lsb, value]
+        wr_data2 = [0x99, 0x37, 0x00]
+        return [
+            i2c_msg.write(self.device_address, wr_data1),
+            i2c_msg.write(self.device_address, wr_data2)
+        ]
+
+    def _cfg_read_msgs(self, register_address):
+        reg_msb, reg_lsb = self._split_register_address(register_address)
+        wr_data1 = [0x00, 0x00, 0x04, 0x01, 0x01, reg_msb, reg_lsb]
+        wr_data2 = [0x99, 0x37, 0x00]
+        wr_data3 = [0x00, 0x04]
+        read_msg = i2c_msg.read(self.device_address, 2)
+        msgs = [
+            i2c_msg.write(self.device_address, wr_data1),
+            i2c_msg.write(self.device_address, wr_data2),
+            i2c_msg.write(self.device_address, wr_data3),
+            read_msg
+        ]
+        return msgs, read_msg
+
+    def _transfer(self, msg_groups):
+        '''
+        Send groups of messages in as few I2C_RDWR transfers as possible.
+        A group is never split between two transfers.
+        '''
+        batch = []
+        for msgs in msg_groups:
+            if batch and len(batch) + len(msgs) > I2C_RDWR_MAX_MSGS:
+                self.bus.i2c_rdwr(*batch)
+                batch = []
+            batch.extend(msgs)
+
+        if batch:
+            self.bus.i2c_rdwr(*batch)
+
+    def read_cfg_registers(self, register_addresses):
+        '''
+        Read config registers in one batch.
+
+        Returns dict {register_address: value}.
+        '''
+        reads = [self._cfg_read_msgs(address) for address in register_addresses]
+        self._transfer([msgs for msgs, _ in reads])
+
+        return {
+            address: list(read_msg)[1]
+            for address, (_, read_msg) in zip(register_addresses, reads)
+        }
+
+    def read_cfg_register(self, register_address):
+        return self.read_cfg_registers([register_address])[register_address]
+
+    def write_cfg_registers(self, registers):
+        '''
+        Write config registers given as dict {register_address: value}
+        in one batch.
+        '''
+        self._transfer([
+            self._cfg_write_msgs(address, value)
+            for address, value in registers.items()
+        ])
+
+    def write_cfg_register(self, register_address, value):
+        self.write_cfg_registers({register_address: value})
+
+    def apply_cfg(self, register_map):
+        '''
+        Bring config registers to the values from register_map.
+        Only registers holding a different value are written.
+
+        Returns dict {register_address: (old_value, new_value)} of changed registers.
+        '''
+        wanted = {address: value for address, value, _ in register_map}
+        current = self.read_cfg_registers(list(wanted))
+        changed = {
+            address: value
+            for address, value in wanted.items()
+            if current[address] != value
+        }
+
+        if not changed:
+            return {}
+
+        self.write_cfg_registers(changed)
+
+        written = self.read_cfg_registers(list(changed))
+        for address, value in changed.items():
+            if written[address] != value:
+                raise OSError(
+                    "Register 0x%04X readback 0x%02X, expected 0x%02X!" %
+                    (address, written[address], value)
+                )
+
+        return {address: (current[address], value) for address, value in changed.items()}
+
+    def write_runtime_register(self, register_address, value):
+        wr_data = [register_address, value]
+        self.bus.i2c_rdwr(i2c_msg.write(self.runtime_address, wr_data))
+
+    def read_runtime_register(self, register_address):
+        wr_data = [register_address]
+        write_msg = i2c_msg.write(self.runtime_address, wr_data)
+        read_msg = i2c_msg.read(self.runtime_address, 1)
+        self.bus.i2c_rdwr(write_msg, read_msg)
+        return list(read_msg)[0]
+
+    def start_hub(self):
+        '''
+        Start USB HUB by I2C command write 0x00 to 0xAA55 register
+        '''
+        wr_data1 = [0xAA, 0x55, 0x00]
+        self.bus.i2c_rdwr(i2c_msg.write(self.device_address, wr_data1))
+
+
+def reset_hub():
+    kernel_version = os.popen("uname -r").read().strip()
+
+    version_tuple = tuple(map(int, kernel_version.split('-')[0].split('.')))
+
+    # sysfs numbering of these lines is valid only for older kernels
+    if version_tuple > (5, 10, 120) and GPIO_BACKEND == "sysfs":
+        print("Error: The required 'python3-libgpiod' package is not installed.")
+        print("sudo apt install python3-libgpiod")
+        exit(1)
+
+    with GpioLines([USB_HUB_VBUSDET, USB_HUB_NRST], values=[0, 1], consumer="usb-hub-control") as lines:
+        time.sleep(RESET_ASSERT_DELAY)
+        lines.set_value(USB_HUB_NRST, 0)
+        time.sleep(RESET_HOLD_TIME)
+        lines.set_values([1, 1])
+
+
+def setup_hub(hub, register_map=HUB_CFG_REGISTERS):
+    '''
+    Configure hub after reset and start it. Returns True on success.
+    '''
+    if not hub.wait_ready():
+        print("Error: USB HUB did not respond on I2C within %.1f s!" % READY_TIMEOUT)
+        return False
+
+    success = True
+    try:
+        changed = hub.apply_cfg(register_map)
+    except OSError as e:
+        print(f"Error write cfg register: {e}")
+        success = False
+    else:
+        descriptions = {address: description for address, _, description in register_map}
+        for address, (old_value, new_value) in changed.items():
+            print("Set 0x%04X register value: %s -> %s (%s)" %
+                  (address, hex(old_value), hex(new_value), descriptions[address]))
+        if not changed:
+            print("USB HUB registers already hold the required values.")
+
+    #Start USB HUB by command, also when configuration failed, so the hub is usable
+    try:
+        hub.start_hub()
+    except OSError as e:
+        print(f"Error start hub: {e}")
+        success = False
+
+    return success
+
+
+#RUNTIME SECTION
+'''
+Errata sheet
+https://ww1.microchip.com/downloads/aemDocuments/documents/UNG/ProductDocuments/Errata/USB253x-USB3x13-USB46x4-Errata-80000583E.pdf
+'''
+#ERRATA NUMBER12 fix (in runtime)
+#hub.write_runtime_register(0xE9, 0x00)
+#read_reg = hub.read_runtime_register(0xE9)
+#print("Read 0xE9 register value:", hex(read_reg))
+
+
+def main():
+    print("Reseting USB HUB...")
+    reset_hub()
+
+    print("Setting up USB HUB through I2C...")
+    with Usb2534.open(bus_number) as hub:
+        if not setup_hub(hub):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,46 +1,24 @@
-import os
-import time
+import argparse
 import sys
 
-def run_command(command):
-    result = os.system(command)
-    if result != 0:
-        print(f"Command failed: {command}")
-        sys.exit(1)
-
-def detect_usb_path():
-    """
-    Detects the correct path for USB drivers (either /drivers or /hub/drivers).
-    """
-    if os.path.exists('/sys/bus/usb/drivers/unbind'):
-        return '/sys/bus/usb/drivers'
-    elif os.path.exists('/sys/bus/usb/drivers/hub/unbind'):
-        return '/sys/bus/usb/drivers/hub'
-    else:
-        print("Error: Unable to detect USB driver path.")
-        sys.exit(1)
+from airvolute_gpio import GpioError, GpioLine
+from airvolute_usb import DEFAULT_WAIT_TIMEOUT, UsbError, switch_device
 
-def reset_usb():
-    usb_path = detect_usb_path()
-    run_command(f'echo -n "1-0:1.0" | sudo tee {usb_path}/unbind')
-    run_command(f'echo -n "1-0:1.0" | sudo tee {usb_path}/bind')
-
-def enable_device(device):
-    if device == 'fmu':
-        # Set GPIO6=1
-        run_command('sudo gpioset gpiochip2 6=1')
-    elif device == 'cube':
-        # Set GPIO6=0
-        run_command('sudo gpioset gpiochip2 6=0')
-    else:
-        raise ValueError("Invalid device selection. Choose 'fmu' or 'cube'.")
-
-    reset_usb()
+# GPIO6 of gpiochip2
+USB_MUX_GPIO = GpioLine("gpiochip2", 6)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2 or sys.argv[1] not in ['cube', 'fmu']:
-        print("Usage: sudo python fmu_cube_usb_switch.py [cube/fmu]")
+    parser = argparse.ArgumentParser(usage="sudo python %(prog)s [cube/fmu]")
+    parser.add_argument('device', choices=['cube', 'fmu'])
+    parser.add_argument('--port', help="USB port behind the mux (f.e. 1-2.3), detected when not set.")
+    parser.add_argument('--full_reset', action='store_true', help="Reset all USB devices instead of the mux port only.")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_WAIT_TIMEOUT, help="Seconds to wait for the device to enumerate.")
+    args = parser.parse_args()
+
+    try:
+        name = switch_device(USB_MUX_GPIO, args.device, args.port, args.full_reset, args.timeout)
+    except (UsbError, GpioError) as e:
+        print(f"Error: {e}")
         sys.exit(1)
 
-    enable_device(sys.argv[1])
-    time.sleep(3)
+    print(f"{args.device} enumerated as USB device {name}.")
@@ -1,9 +1,15 @@
 import sys
 import os
 import argparse
+import csv
+import secrets
+import string
 import subprocess
+import uuid
 
-USER = os.getenv('USER')
+# User of the flashed device, used when generating configuration offline
+DEFAULT_DEVICE_USER = "dcs_user"
+USER = os.getenv('USER') or DEFAULT_DEVICE_USER
 DEFAULT_SSID = USER.lower()
 DEFAULT_KEY = "dronecore2024"
 DEFAULT_CHANNEL = 1
@@ -11,6 +17,11 @@ SPACE = ' '
 CON_STR = 'sudo nmcli con'
 CON_ARRAY = ['sudo', 'nmcli', 'con']
 DEVNULL = open(os.devnull, 'w')
+NM_CONNECTIONS_DIR = os.path.join('etc', 'NetworkManager', 'system-connections')
+DEFAULT_SSID_TEMPLATE = "DCS_{serial}"
+DEFAULT_KEY_LENGTH = 12
+KEY_ALPHABET = string.ascii_letters + string.digits
+UNITS_FILE = "units.csv"
 
 def get_wifi_interfaces():
     try:
@@ -31,7 +42,8 @@ def get_wifi_interfaces():
 
 def config_wifi(ap, args):
     freq = ('bg', 'a')[args.five_ghz]
-    wifi = get_wifi_interfaces()[0] if get_wifi_interfaces() else "wlan1"
+    interfaces = get_wifi_interfaces()
+    wifi = interfaces[0] if interfaces else "wlan1"
     cmds = [
         CON_ARRAY + ['add', 'type', 'wifi', 'ifname', wifi, 'mode', 'ap', 'con-name', ap, 'ssid', args.ssid],
         CON_ARRAY + ['modify', ap, '802-11-wireless.band', freq],
@@ -47,6 +59,123 @@ def config_wifi(ap, args):
         subprocess.call(cmd, stdout=DEVNULL)
     print("SSID: "+ args.ssid, "Key: " + args.key, "5GHz: " + str(args.five_ghz))
 
+def get_ap_name(user):
+    return user.upper() + '_AP'
+
+def build_keyfile(ap, ssid, key, channel, five_ghz, interface=None):
+    """
+    Returns NetworkManager keyfile equal to the connection created by config_wifi().
+    """
+    freq = ('bg', 'a')[five_ghz]
+    # Same connection always gets the same uuid
+    con_uuid = uuid.uuid5(uuid.NAMESPACE_DNS, ap + '.' + ssid)
+    lines = [
+        '[connection]',
+        'id=' + ap,
+        'uuid=' + str(con_uuid),
+        'type=wifi',
+        'autoconnect=true',
+    ]
+    if interface is not None:
+        lines.append('interface-name=' + interface)
+    lines += [
+        '',
+        '[wifi]',
+        'band=' + freq,
+        'channel=' + str(channel),
+        'mode=ap',
+        'ssid=' + ssid,
+        '',
+        '[wifi-security]',
+        'group=ccmp;',
+        'key-mgmt=wpa-psk',
+        'pairwise=ccmp;',
+        'proto=rsn;',
+        'psk=' + key,
+        '',
+        '[ipv4]',
+        'method=shared',
+        '',
+        '[ipv6]',
+        'addr-gen-mode=stable-privacy',
+        'method=auto',
+        '',
+    ]
+    return '\n'.join(lines)
+
+def write_keyfile(root, ap, content):
+    """
+    Write keyfile into system-connections of root (/ or rootfs path).
+    NetworkManager ignores keyfiles readable by other users.
+    """
+    connections_dir = os.path.join(root, NM_CONNECTIONS_DIR)
+    os.makedirs(connections_dir, exist_ok=True)
+    keyfile_path = os.path.join(connections_dir, ap + '.nmconnection')
+    tmp_path = keyfile_path + '.tmp'
+
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, keyfile_path)
+    return keyfile_path
+
+def generate_key(length=DEFAULT_KEY_LENGTH):
+    return ''.join(secrets.choice(KEY_ALPHABET) for _ in range(length))
+
+def read_serials(serials_path):
+    serials = []
+    with open(serials_path) as f:
+        for line in f:
+            serial = line.strip()
+            if serial and not serial.startswith('#'):
+                serials.append(serial)
+    return serials
+
+def load_units(units_path):
+    if not os.path.isfile(units_path):
+        return {}
+    with open(units_path, newline='') as f:
+        return {row['serial']: row for row in csv.DictReader(f)}
+
+def generate_batch(args, user):
+    """
+    Generate keyfile for each serial number into <output>/<serial>/etc/NetworkManager/...
+    Generated SSIDs and keys are stored in <output>/units.csv, keys of
+    serials already listed there are kept.
+    """
+    if not 8 <= args.key_length <= 63:
+        print("Key length has to be between 8 and 63 characters!")
+        return 1
+
+    ap = get_ap_name(user)
+    units_path = os.path.join(args.output, UNITS_FILE)
+    units = load_units(units_path)
+
+    os.makedirs(args.output, exist_ok=True)
+    for serial in read_serials(args.batch):
+        ssid = args.ssid_template.format(serial=serial)
+        if serial in units and units[serial]['ssid'] == ssid:
+            key = units[serial]['key']
+        else:
+            key = generate_key(args.key_length)
+        units[serial] = {'serial': serial, 'ssid': ssid, 'key': key}
+
+        content = build_keyfile(ap, ssid, key, args.channel, args.five_ghz)
+        write_keyfile(os.path.join(args.output, serial), ap, content)
+        print("Serial: " + serial, "SSID: " + ssid, "Key: " + key)
+
+    fd = os.open(units_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['serial', 'ssid', 'key'])
+        writer.writeheader()
+        for serial in sorted(units):
+            writer.writerow(units[serial])
+    os.replace(units_path + '.tmp', units_path)
+
+    print("Units written to " + units_path)
+    return 0
+
 def exist_connection(ap):
     cmd = CON_ARRAY + ['show', ap]
     ret = subprocess.call(cmd, stdout=DEVNULL, stderr=DEVNULL)
@@ -81,9 +210,40 @@ def main():
                     help="Wifi channel. Default: {}".format(DEFAULT_CHANNEL))
     parser.add_argument("-5g","--five_ghz", action='store_true',
                     help="Wifi frequency 5GHz")
+    parser.add_argument("--user", type=str, default=None,
+                    help="User the access point is named after. Default: current user, {} with --rootfs/--batch".format(DEFAULT_DEVICE_USER))
+    parser.add_argument("-i", "--interface", type=str, default=None,
+                    help="Bind connection to Wi-Fi interface. Default: any interface with --rootfs/--batch")
+    parser.add_argument("-r", "--rootfs", type=str, default=None,
+                    help="Write NetworkManager keyfile into rootfs instead of configuring the running system")
+    parser.add_argument("-b", "--batch", type=str, default=None,
+                    help="File with serial numbers (one per line), generate keyfile for each unit into --output")
+    parser.add_argument("-o", "--output", type=str, default="wifi_units",
+                    help="Output directory of --batch. Default: wifi_units")
+    parser.add_argument("--ssid_template", type=str, default=DEFAULT_SSID_TEMPLATE,
+                    help="SSID of each unit in --batch. Default: {}".format(DEFAULT_SSID_TEMPLATE))
+    parser.add_argument("--key_length", type=int, default=DEFAULT_KEY_LENGTH,
+                    help="Length of generated keys in --batch. Default: {}".format(DEFAULT_KEY_LENGTH))
     args = parser.parse_args()
 
-    ap = USER.upper() + '_AP'
+    if args.rootfs is not None or args.batch is not None:
+        user = args.user if args.user is not None else DEFAULT_DEVICE_USER
+        if args.batch is not None:
+            return generate_batch(args, user)
+
+        if not 8 <= len(args.key) <= 63:
+            print("Key has to be between 8 and 63 characters long!")
+            return 1
+
+        ssid = args.ssid if args.ssid != DEFAULT_SSID else user.lower()
+        ap = get_ap_name(user)
+        content = build_keyfile(ap, ssid, args.key, args.channel, args.five_ghz, args.interface)
+        keyfile_path = write_keyfile(args.rootfs, ap, content)
+        print("SSID: "+ ssid, "Key: " + args.key, "5GHz: " + str(args.five_ghz))
+        print("Keyfile written to " + keyfile_path)
+        return 0
+
+    ap = get_ap_name(args.user if args.user is not None else USER)
 
     if exist_connection(ap):
         set_connection(ap, False)
@@ -95,4 +255,4 @@ def main():
         set_connection(ap, True)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# dcs_overlay.py - Python interface of local overlays, counterpart of arg_parser.sh
+#
+# Overlay declares a subclass of LocalOverlay in apply_<name>.py (directory
+# overlay) or <name>.py (file overlay). dcs_deploy runs it in-process when it
+# runs as root, otherwise through this script under sudo:
+#
+#   sudo python3 dcs_overlay.py <overlay.py> <rootfs> <target_device> <jetpack_version> <hwrev> \
+#       <board_expansion> <storage> <rootfs_type> [key=value ...]
+
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+# Keys of the compatible file mapped to OverlayConfig attributes
+COMPATIBLE_KEYS = {
+    "device": "target_device",
+    "storage": "storage",
+    "board": "hwrev",
+    "board_expansion": "board_expansion",
+    "l4t_version": "jetpack_version",
+    "rootfs_type": "rootfs_type",
+}
+
+MANIFEST_PATH = "home/dcs_user/Airvolute/logs/dcs-deploy/dcs_deploy_data.json"
+
+
+class OverlayError(Exception):
+    pass
+
+
+class OverlayConfig:
+    """
+    Flashing configuration the overlay is applied for, the same values shell overlays
+    get as positional arguments.
+    """
+    FIELDS = ["target_device", "jetpack_version", "hwrev", "board_expansion", "storage", "rootfs_type"]
+
+    def __init__(self, target_device:str, jetpack_version:str, hwrev:str, board_expansion:str,
+                 storage:str, rootfs_type:str, chroot_queue:str = None):
+        self.target_device = target_device
+        self.jetpack_version = jetpack_version
+        self.hwrev = hwrev
+        self.board_expansion = board_expansion
+        self.storage = storage
+        self.rootfs_type = rootfs_type
+        # file of the chroot session commands are queued into (DCS_CHROOT_QUEUE), None without session
+        self.chroot_queue = chroot_queue
+
+    def to_args(self) -> list:
+        return [getattr(self, field) for field in self.FIELDS]
+
+    def __repr__(self):
+        return "OverlayConfig(%s)" % ", ".join("%s=%s" % (field, getattr(self, field)) for field in self.FIELDS)
+
+
+class Option:
+    """
+    Typed named argument of the overlay. Values from config_db.json are used as they are,
+    values given on the command line (key=value) are converted to the type.
+    """
+    REQUIRED = object()
+    TRUE_VALUES = ["true", "yes", "on", "1"]
+    FALSE_VALUES = ["false", "no", "off", "0"]
+
+    def __init__(self, type = str, default = REQUIRED, help:str = ""):
+        self.type = type
+        self.default = default
+        self.help = help
+
+    def is_required(self) -> bool:
+        return self.default is Option.REQUIRED
+
+    def convert(self, name:str, value):
+        if isinstance(value, self.type):
+            return value
+        if self.type is bool:
+            if str(value).lower() in self.TRUE_VALUES:
+                return True
+            if str(value).lower() in self.FALSE_VALUES:
+                return False
+            raise OverlayError("Option %s expects true or false, got '%s'!" % (name, value))
+        try:
+            return self.type(value)
+        except (TypeError, ValueError):
+            raise OverlayError("Option %s expects %s, got '%s'!" % (name, self.type.__name__, value))
+
+
+def load_compatible(path:str) -> list:
+    """
+    Load compatibility rules of a compatible file. Returns None when there is no such file.
+    """
+    try:
+        with open(path, "r") as compatible_file:
+            return json.load(compatible_file)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise OverlayError("Invalid compatible file %s: %s" % (path, str(e)))
+
+
+def is_compatible(rules:list, config:OverlayConfig) -> bool:
+    """
+    Config is compatible when all fields of any rule match. A field matches when it lists
+    the value of the config, is missing, empty or contains "".
+    """
+    for rule in rules:
+        for key, attribute in COMPATIBLE_KEYS.items():
+            values = rule.get(key, [])
+            if values and "" not in values and getattr(config, attribute) not in values:
+                break
+        else:
+            return True
+    return False
+
+
+class Manifest:
+    """
+    dcs_deploy_data.json of the rootfs listing everything installed by overlays. It is loaded
+    once and written when the overlay finishes instead of being rewritten for every entry.
+    """
+    def __init__(self, rootfs:str):
+        self.path = os.path.join(rootfs, MANIFEST_PATH)
+        self.data = None
+        self.changed = False
+
+    def load(self):
+        try:
+            with open(self.path, "r") as manifest_file:
+                self.data = json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            self.data = None
+        if not isinstance(self.data, dict) or "services" not in self.data or "binaries" not in self.data:
+            print("Initialized JSON file at %s" % self.path)
+            self.data = {"services": [], "binaries": []}
+            self.changed = True
+
+    def add(self, section:str, path:str):
+        if self.data is None:
+            self.load()
+        entries = self.data.setdefault(section, [])
+        if path not in entries:
+            entries.append(path)
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self.data, manifest_file, indent=2)
+            manifest_file.write("\n")
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+
+class LocalOverlay:
+    """
+    Base of Python local overlays. Subclass declares OPTIONS ({name: Option}), COMPATIBLE
+    (rules in the format of the compatible file, None for any configuration) and implements
+    apply(rootfs, config). apply returns exit code of the overlay (None is 0), errors are raised
+    as OverlayError or OSError.
+    """
+    OPTIONS = {}
+    COMPATIBLE = None
+
+    def __init__(self, overlay_dir:str, options:dict = None):
+        self.overlay_dir = overlay_dir
+        self.options = self.parse_options(options or {})
+        self.manifest = None
+
+    @classmethod
+    def parse_options(cls, options:dict) -> dict:
+        unknown = set(options) - set(cls.OPTIONS)
+        if unknown:
+            raise OverlayError("Unknown argument: %s" % ", ".join(sorted(unknown)))
+
+        parsed = {}
+        for name, option in cls.OPTIONS.items():
+            if name in options:
+                parsed[name] = option.convert(name, options[name])
+            elif option.is_required():
+                raise OverlayError("Missing argument: %s" % name)
+            else:
+                parsed[name] = option.default
+        return parsed
+
+    def is_compatible(self, config:OverlayConfig) -> bool:
+        return self.COMPATIBLE is None or is_compatible(self.COMPATIBLE, config)
+
+    def apply(self, rootfs:str, config:OverlayConfig):
+        raise NotImplementedError
+
+    def get_manifest(self, rootfs:str) -> Manifest:
+        if self.manifest is None:
+            self.manifest = Manifest(rootfs)
+            self.manifest.load()
+        return self.manifest
+
+    def install(self, src:str, dst:str, mode:int = None) -> str:
+        """
+        Copy file like cp, dst may be a directory. Missing parent directories are created.
+        Returns the installed path.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy(src, dst)
+        if mode is not None:
+            os.chmod(dst, mode)
+        return dst
+
+    def write_file(self, path:str, content:str, mode:int = 0o644):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as output_file:
+            output_file.write(content)
+        os.chmod(path, mode)
+
+    def queue_command(self, rootfs:str, config:OverlayConfig, command:str) -> int:
+        """
+        Run command in the rootfs: queued into the chroot session, or run by chroot without it.
+        """
+        if config.chroot_queue:
+            with open(config.chroot_queue, "a") as queue_file:
+                queue_file.write(command + "\n")
+            return 0
+        return subprocess.call(["chroot", rootfs, "/bin/sh", "-c", command])
+
+    def run(self, args:list, config:OverlayConfig) -> int:
+        """
+        Run a host command (eg. a shell script of the overlay) with DCS_CHROOT_QUEUE of the session.
+        """
+        env = dict(os.environ)
+        env.pop("DCS_CHROOT_QUEUE", None)
+        if config.chroot_queue:
+            env["DCS_CHROOT_QUEUE"] = config.chroot_queue
+        return subprocess.call(args, env=env)
+
+
+def load_overlay(path:str):
+    """
+    Import overlay module and return its LocalOverlay subclass.
+    """
+    lib_path = os.path.dirname(os.path.abspath(__file__))
+    if lib_path not in sys.path:
+        sys.path.insert(0, lib_path)
+
+    module_name = "dcs_overlay_" + os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    if spec is None:
+        raise OverlayError("Overlay %s can not be imported!" % path)
+    module = importlib.util.module_from_spec(spec)
+    # overlay runs as root, no root owned __pycache__ is left in the overlay directory
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+    classes = [
+        obj for obj in vars(module).values()
+        if isinstance(obj, type) and issubclass(obj, LocalOverlay) and obj.__module__ == module_name
+    ]
+    if len(classes) != 1:
+        raise OverlayError("Overlay %s has to define exactly one LocalOverlay class, found %d!" % (path, len(classes)))
+    return classes[0]
+
+
+def apply_overlay(path:str, rootfs:str, config:OverlayConfig, options:dict = None) -> int:
+    """
+    Load, check and apply overlay. Returns exit code of the overlay, errors are printed.
+    """
+    if not os.path.isdir(rootfs):
+        print("Error: L4T_rootfs_path does not exist: %s" % rootfs)
+        return 1
+
+    overlay = None
+    try:
+        overlay_class = load_overlay(path)
+        overlay = overlay_class(os.path.dirname(os.path.abspath(path)), options)
+        if not overlay.is_compatible(config):
+            print("Overlay %s is not compatible with %s, skipping." % (overlay_class.__name__, config))
+            return 0
+        ret = overlay.apply(rootfs, config) or 0
+        if overlay.manifest is not None:
+            overlay.manifest.save()
+        return ret
+    except (OverlayError, OSError, subprocess.SubprocessError) as e:
+        print("Error: overlay %s failed: %s" % (path, str(e)))
+        return 1
+
+
+def main(argv:list) -> int:
+    if len(argv) < 8:
+        print("usage: dcs_overlay.py <overlay.py> <rootfs> <target_device> <jetpack_version> <hwrev> "
+              "<board_expansion> <storage> <rootfs_type> [key=value ...]")
+        return 2
+
+    options = {}
+    for arg in argv[8:]:
+        key, separator, value = arg.partition("=")
+        if not separator:
+            print("Error: argument %s is not key=value!" % arg)
+            return 2
+        options[key] = value
+
+    config = OverlayConfig(*argv[2:8], chroot_queue=os.environ.get("DCS_CHROOT_QUEUE") or None)
+    return apply_overlay(argv[0], argv[1], config, options)
+
+
+if __name__ == "__main__":
+    # overlays import this module as dcs_overlay, it must not be loaded second time
+    sys.modules.setdefault("dcs_overlay", sys.modules[__name__])
+    sys.exit(main(sys.argv[1:]))
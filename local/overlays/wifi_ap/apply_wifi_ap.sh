@@ -0,0 +1,45 @@
+#!/bin/bash
+# stop when any error occures
+set -o pipefail
+set -e
+
+# Writes Wi-Fi access point NetworkManager keyfile into the rootfs, so the AP
+# is up on the first boot without running wifi_generator.py on the device.
+#
+# Optional named arguments (from local_overlays in config_db.json):
+#   ssid=<ssid> key=<key> channel=<channel> five_ghz=true user=<user> interface=<ifname>
+
+# lib path
+SCRIPT_PATH=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+LIB_PATH=$SCRIPT_PATH/../lib
+
+# Include the arg_parser.sh script
+source $LIB_PATH/arg_parser.sh
+
+init_variables "$1" "$2" "$3" "$4" "$5" "$6" "$7"
+
+wifi_generator=$SCRIPT_PATH/../hardware_support_layer/resources/utilities/wifi_generator/wifi_generator.py
+generator_args=(--rootfs "$L4T_rootfs_path")
+
+for arg in "${@:8}"; do
+    key="${arg%%=*}"
+    value="${arg#*=}"
+    case "$key" in
+        ssid) generator_args+=(--ssid "$value") ;;
+        key) generator_args+=(--key "$value") ;;
+        channel) generator_args+=(--channel "$value") ;;
+        user) generator_args+=(--user "$value") ;;
+        interface) generator_args+=(--interface "$value") ;;
+        five_ghz)
+            if [[ "$value" == "true" ]]; then
+                generator_args+=(--five_ghz)
+            fi
+            ;;
+        *)
+            echo "Error: Unknown argument: $arg"
+            exit 1
+            ;;
+    esac
+done
+
+sudo python3 "$wifi_generator" "${generator_args[@]}"
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Copy directory tree (unpacked rootfs) with a pool of copy threads.
+
+The tree is walked in one thread, copying file data and applying metadata is handed to
+copy threads. Result is the same as of "cp -a" run by the same user:
+- owner, mode (including setuid/setgid), times and xattrs are preserved, ownership only when running as root,
+- hard links within the tree stay hard links, symlinks are copied as they are,
+- device nodes and fifos are created, sockets are skipped,
+- directory metadata is applied at the end (deepest first).
+
+File data is reflinked (FICLONE) when source and destination are on filesystem supporting it
+(btrfs, xfs), so the copy takes no space and almost no time. Otherwise data is copied by
+copy_file_range in the kernel.
+
+Usage:
+    sudo python3 -B parallel_copy.py [-j 16] [--reflink auto|always|never] <source> <destination>
+"""
+
+import argparse
+import errno
+import fcntl
+import os
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from parallel_extract import DEFAULT_JOBS, format_size
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+CHUNK_SIZE = 16 * 1024 * 1024
+# entries handed to a copy thread at once
+BATCH_FILES = 64
+BATCH_SIZE = 64 * 1024 * 1024
+# errors of FICLONE meaning that the filesystem (or the pair of filesystems) does not support reflinks
+REFLINK_UNSUPPORTED = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS)
+
+
+class ParallelCopier:
+    def __init__(self, destination, jobs = DEFAULT_JOBS, reflink = "auto"):
+        self.destination = os.path.abspath(destination)
+        self.jobs = max(1, jobs)
+        self.reflink = reflink != "never"
+        self.reflink_required = reflink == "always"
+        self.same_owner = os.geteuid() == 0
+        self.directories = []
+        self.hard_links = {}
+        self.batch = []
+        self.batch_size = 0
+        self.errors = []
+        self.lock = threading.Lock()
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.reflinked_files = 0
+
+    def error(self, name, e):
+        with self.lock:
+            self.errors.append((name, e))
+        print("parallel_copy: %s: %s" % (name, str(e)), file=sys.stderr)
+
+    @staticmethod
+    def copy_xattrs(source, path, fd = None):
+        try:
+            names = os.listxattr(source, follow_symlinks=False)
+        except OSError as e:
+            if e.errno in (errno.ENOTSUP, errno.EPERM):
+                return
+            raise
+        for name in names:
+            value = os.getxattr(source, name, follow_symlinks=False)
+            if fd is not None:
+                os.setxattr(fd, name, value)
+            else:
+                os.setxattr(path, name, value, follow_symlinks=False)
+
+    def apply_metadata(self, source, path, st, fd = None):
+        """
+        Owner has to be set before mode, chown clears setuid/setgid bits.
+        """
+        is_link = stat.S_ISLNK(st.st_mode)
+        if self.same_owner:
+            if fd is not None:
+                os.fchown(fd, st.st_uid, st.st_gid)
+            else:
+                os.chown(path, st.st_uid, st.st_gid, follow_symlinks=False)
+        if not is_link:
+            self.copy_xattrs(source, path, fd)
+            if fd is not None:
+                os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            else:
+                os.chmod(path, stat.S_IMODE(st.st_mode))
+        times = (st.st_atime_ns, st.st_mtime_ns)
+        if fd is not None:
+            os.utime(fd, ns=times)
+        elif not is_link:
+            os.utime(path, ns=times)
+        elif os.utime in os.supports_follow_symlinks:
+            os.utime(path, ns=times, follow_symlinks=False)
+
+    @staticmethod
+    def create(path, create):
+        """
+        Create entry by create(path). Entry existing in the destination (eg. README.txt of empty
+        L4T rootfs) is replaced like by cp.
+        """
+        try:
+            return create(path)
+        except FileExistsError:
+            if os.path.isdir(path) and not os.path.islink(path):
+                raise
+            os.unlink(path)
+            return create(path)
+
+    def copy_data(self, source_fd, fd, size) -> bool:
+        """
+        Copy file data. Returns True when the data was reflinked.
+        """
+        if self.reflink and size > 0:
+            try:
+                fcntl.ioctl(fd, FICLONE, source_fd)
+                return True
+            except OSError as e:
+                if e.errno not in REFLINK_UNSUPPORTED or self.reflink_required:
+                    raise
+                # do not try again for every file
+                self.reflink = False
+        copied = 0
+        while copied < size:
+            try:
+                count = os.copy_file_range(source_fd, fd, min(CHUNK_SIZE, size - copied))
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                count = os.write(fd, os.read(source_fd, min(CHUNK_SIZE, size - copied)))
+            if count == 0:
+                # file was truncated while copying
+                break
+            copied += count
+        return False
+
+    def copy_file(self, source, path, st):
+        try:
+            source_fd = os.open(source, os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                fd = self.create(path, lambda path: os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600))
+                try:
+                    reflinked = self.copy_data(source_fd, fd, st.st_size)
+                    self.apply_metadata(source, path, st, fd)
+                finally:
+                    os.close(fd)
+            finally:
+                os.close(source_fd)
+            with self.lock:
+                self.copied_files += 1
+                self.copied_bytes += st.st_size
+                self.reflinked_files += 1 if reflinked else 0
+        except OSError as e:
+            self.error(source, e)
+
+    def copy_special(self, source, path, st):
+        try:
+            if stat.S_ISLNK(st.st_mode):
+                target = os.readlink(source)
+                self.create(path, lambda path: os.symlink(target, path))
+            elif stat.S_ISFIFO(st.st_mode):
+                self.create(path, lambda path: os.mkfifo(path, 0o600))
+            else:
+                self.create(path, lambda path: os.mknod(path, stat.S_IFMT(st.st_mode) | 0o600, st.st_rdev))
+            self.apply_metadata(source, path, st)
+        except OSError as e:
+            self.error(source, e)
+
+    def link_file(self, source, path, st):
+        """
+        Link to the first copied path of the inode, after it is written.
+        """
+        first_path, future = self.hard_links[(st.st_dev, st.st_ino)]
+        future.result()
+        try:
+            self.create(path, lambda path: os.link(first_path, path, follow_symlinks=False))
+        except OSError as e:
+            self.error(source, e)
+
+    def copy_batch(self, batch):
+        for copy, source, path, st in batch:
+            copy(source, path, st)
+
+    def submit(self, pool):
+        """
+        Hand collected entries to a copy thread. Entries are handed over in batches, a thread
+        per small file costs more than copying it.
+        """
+        future = pool.submit(self.copy_batch, self.batch)
+        for copy, source, path, st in self.batch:
+            if copy == self.copy_file and st.st_nlink > 1:
+                self.hard_links[(st.st_dev, st.st_ino)] = (path, future)
+        self.batch = []
+        self.batch_size = 0
+
+    def copy_entry(self, source, path, st, pool):
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                os.mkdir(path, 0o700)
+            except FileExistsError:
+                if not os.path.isdir(path) or os.path.islink(path):
+                    raise
+            self.directories.append((source, path, st))
+            return True
+        if stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1 and (st.st_dev, st.st_ino) in self.hard_links:
+                self.link_file(source, path, st)
+                return False
+            self.batch.append((self.copy_file, source, path, st))
+            self.batch_size += st.st_size
+            if st.st_nlink > 1:
+                # later links of the inode wait for this copy
+                self.submit(pool)
+        elif stat.S_ISSOCK(st.st_mode):
+            print("parallel_copy: %s: socket, skipping" % source, file=sys.stderr)
+        else:
+            self.batch.append((self.copy_special, source, path, st))
+        if len(self.batch) >= BATCH_FILES or self.batch_size >= BATCH_SIZE:
+            self.submit(pool)
+        return False
+
+    def copy(self, source_root) -> int:
+        source_root = os.path.abspath(source_root)
+        os.makedirs(self.destination, exist_ok=True)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            stack = [(source_root, self.destination)]
+            while stack:
+                source_dir, destination_dir = stack.pop()
+                try:
+                    entries = sorted(os.scandir(source_dir), key=lambda entry: entry.name)
+                except OSError as e:
+                    self.error(source_dir, e)
+                    continue
+                for entry in entries:
+                    path = os.path.join(destination_dir, entry.name)
+                    try:
+                        if self.copy_entry(entry.path, path, entry.stat(follow_symlinks=False), pool):
+                            stack.append((entry.path, path))
+                    except OSError as e:
+                        self.error(entry.path, e)
+            if self.batch:
+                self.submit(pool)
+
+        # root of the tree gets metadata of the source too, deepest directories first,
+        # so setting times of a directory is not undone by its children
+        self.directories.append((source_root, self.destination, os.lstat(source_root)))
+        for source, path, st in sorted(self.directories, key=lambda item: item[1], reverse=True):
+            try:
+                self.apply_metadata(source, path, st)
+            except OSError as e:
+                self.error(source, e)
+
+        print("Copied %d files (%s, %d reflinked) in %.1f s" % (
+            self.copied_files, format_size(self.copied_bytes), self.reflinked_files, time.monotonic() - start))
+        if self.reflink_required and self.copied_files != self.reflinked_files:
+            print("parallel_copy: not all files were reflinked", file=sys.stderr)
+            return 2
+        return 0 if len(self.errors) == 0 else 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy directory tree with a pool of copy threads.")
+    parser.add_argument("source", help="Directory to copy")
+    parser.add_argument("destination", help="Destination directory, created when missing")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS, help="Number of copy threads. Default: %d" % DEFAULT_JOBS)
+    parser.add_argument("--reflink", choices=["auto", "always", "never"], default="auto",
+                        help="Reflink file data when filesystem supports it. Default: auto")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        print("parallel_copy: %s is not a directory" % args.source, file=sys.stderr)
+        return 2
+    return ParallelCopier(args.destination, args.jobs, args.reflink).copy(args.source)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
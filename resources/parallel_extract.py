@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+"""
+Extract tar archive with a pool of writer threads.
+
+The archive is decompressed and read in one stream. Creating files and applying their
+metadata (owner, mode, times, xattrs) is handed to writer threads, so extraction of archives
+with many small files (rootfs) is not limited by one process doing it file by file.
+
+Result is the same as of "tar xpf" run by the same user:
+- directories are created in archive order, their metadata is applied at the end (deepest first),
+- hard links are created after their target is written, in archive order,
+- symlinks pointing outside of their directory (absolute or with "..") are created at the end,
+- owners are mapped by user/group name when it exists on the host, numeric ids are used otherwise,
+  ownership is applied only when running as root,
+- device nodes and fifos are created, xattrs stored in pax headers are restored.
+
+Usage:
+    sudo python3 parallel_extract.py -C <destination> [-j 16] [--exclude-from file] archive.tbz2
+    lbzip2 -dc archive.tbz2 | sudo python3 parallel_extract.py -C <destination> -
+    python3 parallel_extract.py --benchmark 200000 [-j 16]   # synthetic archive, tar vs parallel
+"""
+
+import argparse
+import base64
+import grp
+import os
+import pwd
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_JOBS = min(32, (os.cpu_count() or 1) * 2)
+# files up to this size are read into memory and written by writer threads
+SMALL_FILE_SIZE = 4 * 1024 * 1024
+# memory used by files waiting for writer threads
+BUFFER_LIMIT = 256 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+def normalize(name):
+    while name.startswith("./"):
+        name = name[2:]
+    return name.strip("/")
+
+
+def open_archive(archive_path):
+    """
+    Open archive as stream. bzip2 archives are decompressed by lbzip2 when available,
+    zstd archives by zstd, "-" reads uncompressed tar from stdin. Returns (tarfile, decompress process or None).
+    """
+    if archive_path == "-":
+        return tarfile.open(fileobj=sys.stdin.buffer, mode="r|", bufsize=CHUNK_SIZE), None
+    decompress_command = None
+    if ("tbz2" in archive_path or "tar.bz2" in archive_path) and shutil.which("lbzip2"):
+        decompress_command = ["lbzip2", "-dc", archive_path]
+    elif archive_path.endswith(".zst"):
+        decompress_command = ["zstd", "-dc", archive_path]
+    if decompress_command is not None:
+        decompress = subprocess.Popen(decompress_command, stdout=subprocess.PIPE)
+        return tarfile.open(fileobj=decompress.stdout, mode="r|", bufsize=CHUNK_SIZE), decompress
+    return tarfile.open(archive_path, mode="r|*", bufsize=CHUNK_SIZE), None
+
+
+class ByteBudget:
+    """
+    Limit memory held by files waiting for writer threads.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            # one file bigger than the limit is still let through alone
+            while self.used > 0 and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class ParallelExtractor:
+    def __init__(self, destination, jobs = DEFAULT_JOBS, excluded = None, stream_size = None):
+        self.destination = os.path.abspath(destination)
+        self.jobs = max(1, jobs)
+        self.excluded = excluded if excluded is not None else set()
+        self.stream_size = stream_size
+        self.same_owner = os.geteuid() == 0
+        self.budget = ByteBudget(BUFFER_LIMIT)
+        self.pending = {}
+        self.directories = []
+        self.known_directories = {self.destination}
+        self.delayed_symlinks = []
+        self.errors = []
+        self.errors_lock = threading.Lock()
+        self.uid_cache = {}
+        self.gid_cache = {}
+        self.last_progress = -1
+
+    def error(self, name, e):
+        with self.errors_lock:
+            self.errors.append((name, e))
+        print("parallel_extract: %s: %s" % (name, str(e)), file=sys.stderr)
+
+    def is_excluded(self, name):
+        if not self.excluded:
+            return False
+        parts = name.split("/")
+        return any("/".join(parts[:i]) in self.excluded for i in range(1, len(parts) + 1))
+
+    def get_owner(self, member):
+        """
+        Owner as tar maps it: by name when the name exists on this host, by id otherwise.
+        """
+        key = (member.uname, member.uid)
+        if key not in self.uid_cache:
+            try:
+                self.uid_cache[key] = pwd.getpwnam(member.uname).pw_uid if member.uname else member.uid
+            except KeyError:
+                self.uid_cache[key] = member.uid
+        key = (member.gname, member.gid)
+        if key not in self.gid_cache:
+            try:
+                self.gid_cache[key] = grp.getgrnam(member.gname).gr_gid if member.gname else member.gid
+            except KeyError:
+                self.gid_cache[key] = member.gid
+        return self.uid_cache[(member.uname, member.uid)], self.gid_cache[(member.gname, member.gid)]
+
+    @staticmethod
+    def get_xattrs(member):
+        xattrs = []
+        for key, value in member.pax_headers.items():
+            if key.startswith("SCHILY.xattr."):
+                xattrs.append((key[len("SCHILY.xattr."):], value.encode("utf-8", "surrogateescape")))
+            elif key.startswith("LIBARCHIVE.xattr."):
+                xattrs.append((urllib.parse.unquote(key[len("LIBARCHIVE.xattr."):]), base64.b64decode(value)))
+        return xattrs
+
+    def apply_metadata(self, path, member, fd = None):
+        """
+        Owner has to be set before mode, chown clears setuid/setgid bits.
+        """
+        target = fd if fd is not None else path
+        is_link = member.issym()
+        if self.same_owner:
+            uid, gid = self.get_owner(member)
+            if fd is not None:
+                os.fchown(fd, uid, gid)
+            else:
+                os.chown(path, uid, gid, follow_symlinks=False)
+        for name, value in self.get_xattrs(member):
+            if fd is not None:
+                os.setxattr(fd, name, value)
+            else:
+                os.setxattr(path, name, value, follow_symlinks=False)
+        # -p: permissions are applied exactly, umask is ignored
+        if not is_link:
+            if fd is not None:
+                os.fchmod(fd, member.mode)
+            else:
+                os.chmod(path, member.mode)
+        if is_link:
+            if os.utime in os.supports_follow_symlinks:
+                os.utime(path, (member.mtime, member.mtime), follow_symlinks=False)
+        else:
+            os.utime(target, (member.mtime, member.mtime))
+
+    def remove_existing(self, path, keep_directory = False):
+        if not os.path.lexists(path):
+            return
+        if os.path.isdir(path) and not os.path.islink(path):
+            if keep_directory:
+                return
+            # like tar, only empty directory is replaced
+            os.rmdir(path)
+        else:
+            os.unlink(path)
+
+    def create(self, path, create_function):
+        """
+        Create path, existing file is replaced (like tar does). Destination is usually empty,
+        so existence is checked only when creating fails.
+        """
+        try:
+            return create_function()
+        except FileExistsError:
+            self.remove_existing(path)
+            return create_function()
+
+    def wait_path(self, path):
+        """
+        Wait until previous member with the same path is written.
+        """
+        future = self.pending.pop(path, None)
+        if future is not None:
+            future.result()
+
+    def write_file(self, path, member, data):
+        try:
+            fd = self.create(path, lambda: os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600))
+            try:
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[os.write(fd, view):]
+                self.apply_metadata(path, member, fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.error(member.name, e)
+        finally:
+            self.budget.release(len(data))
+
+    def write_special(self, path, member):
+        try:
+            if member.isfifo():
+                self.create(path, lambda: os.mkfifo(path, 0o600))
+            else:
+                kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+                self.create(path, lambda: os.mknod(path, kind | 0o600, os.makedev(member.devmajor, member.devminor)))
+            self.apply_metadata(path, member)
+        except OSError as e:
+            self.error(member.name, e)
+
+    def apply_later(self, path, member):
+        try:
+            self.apply_metadata(path, member)
+        except OSError as e:
+            self.error(member.name, e)
+
+    def write_large_file(self, path, member, archive):
+        """
+        Big files are written directly from the stream, only their metadata goes to writer threads.
+        """
+        source = archive.extractfile(member)
+        fd = self.create(path, lambda: os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600))
+        try:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                view = memoryview(chunk)
+                while len(view) > 0:
+                    view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    def report_progress(self, member):
+        if not self.stream_size:
+            return
+        done = min(member.offset_data + member.size, self.stream_size)
+        percent = done * 200 // self.stream_size
+        if percent != self.last_progress:
+            self.last_progress = percent
+            print("\r %3d%% (%s / %s)" % (done * 100 // self.stream_size, format_size(done), format_size(self.stream_size)),
+                  end="", flush=True)
+
+    def extract_member(self, member, archive, pool):
+        name = normalize(member.name)
+        if name.split("/").count("..") > 0:
+            print("parallel_extract: %s: member name contains '..', skipping" % member.name, file=sys.stderr)
+            return
+        if self.is_excluded(name):
+            return
+        path = os.path.join(self.destination, name) if name else self.destination
+        parent = os.path.dirname(path)
+        if name and parent not in self.known_directories:
+            # archive without directory members
+            os.makedirs(parent, exist_ok=True)
+            self.known_directories.add(parent)
+        self.wait_path(path)
+
+        if member.isdir():
+            try:
+                os.mkdir(path, 0o700)
+            except FileExistsError:
+                self.remove_existing(path, keep_directory=True)
+                if not os.path.isdir(path):
+                    os.mkdir(path, 0o700)
+            self.known_directories.add(path)
+            self.directories.append((path, member))
+        elif member.isfile():
+            if member.size <= SMALL_FILE_SIZE:
+                data = archive.extractfile(member).read()
+                self.budget.acquire(len(data))
+                self.pending[path] = pool.submit(self.write_file, path, member, data)
+            else:
+                self.write_large_file(path, member, archive)
+                self.pending[path] = pool.submit(self.apply_later, path, member)
+        elif member.islnk():
+            target = os.path.join(self.destination, normalize(member.linkname))
+            self.wait_path(target)
+            self.create(path, lambda: os.link(target, path, follow_symlinks=False))
+        elif member.issym():
+            if member.linkname.startswith("/") or ".." in member.linkname.split("/"):
+                # symlink leading out of its directory could redirect later members, create it at the end
+                self.delayed_symlinks.append((path, member))
+                return
+            self.create(path, lambda: os.symlink(member.linkname, path))
+            self.pending[path] = pool.submit(self.apply_later, path, member)
+        elif member.ischr() or member.isblk() or member.isfifo():
+            self.pending[path] = pool.submit(self.write_special, path, member)
+        else:
+            print("parallel_extract: %s: unsupported member type %s, skipping" % (member.name, member.type), file=sys.stderr)
+
+    def extract(self, archive_path):
+        archive, decompress = open_archive(archive_path)
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                for member in archive:
+                    try:
+                        self.extract_member(member, archive, pool)
+                    except OSError as e:
+                        self.error(member.name, e)
+                    self.report_progress(member)
+                    # do not keep finished futures
+                    if len(self.pending) > self.jobs * 1024:
+                        self.pending = {path: future for path, future in self.pending.items() if not future.done()}
+        except (tarfile.TarError, EOFError) as e:
+            self.error(archive_path, e)
+        finally:
+            archive.close()
+            if decompress is not None:
+                decompress.stdout.close()
+                if decompress.wait() != 0:
+                    self.error(archive_path, OSError("decompression failed"))
+        if self.stream_size:
+            print()
+
+        for path, member in self.delayed_symlinks:
+            try:
+                self.create(path, lambda: os.symlink(member.linkname, path))
+                self.apply_metadata(path, member)
+            except OSError as e:
+                self.error(member.name, e)
+
+        # deepest directories first, so setting times of a directory is not undone by its children
+        for path, member in sorted(self.directories, key=lambda item: item[0], reverse=True):
+            try:
+                self.apply_metadata(path, member)
+            except OSError as e:
+                self.error(member.name, e)
+        return 0 if len(self.errors) == 0 else 2
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f TB" % size
+
+
+def load_exclude_file(exclude_file):
+    with open(exclude_file) as excludes:
+        return set(normalize(line.rstrip("\n")) for line in excludes if line.strip())
+
+
+def create_synthetic_archive(archive_path, file_count):
+    """
+    Archive resembling rootfs: many small files in nested directories, symlinks, hard links,
+    setuid files and a fifo.
+    """
+    source = tempfile.mkdtemp(prefix="parallel_extract_src_")
+    try:
+        for i in range(file_count):
+            directory = os.path.join(source, "usr", "d%03d" % (i % 97), "s%02d" % (i % 13))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, "f%07d" % i)
+            with open(path, "wb") as synthetic_file:
+                synthetic_file.write(os.urandom(i % 9 * 512))
+            os.chmod(path, [0o644, 0o755, 0o600, 0o4755][i % 4])
+            os.utime(path, (1600000000 + i, 1600000000 + i))
+            if i % 50 == 0:
+                os.symlink("f%07d" % i, path + ".link")
+            if i % 200 == 0:
+                os.link(path, path + ".hard")
+            if i % 500 == 0:
+                os.symlink("/usr/d000/s00/f0000000", path + ".abs")
+        os.mkfifo(os.path.join(source, "fifo"))
+        with tarfile.open(archive_path, "w", format=tarfile.PAX_FORMAT) as archive:
+            archive.add(source, arcname=".")
+    finally:
+        shutil.rmtree(source)
+
+
+def snapshot(root):
+    """
+    Describe extracted tree (type, mode, owner, size, mtime, link target, hard link groups).
+    """
+    entries = {}
+    inodes = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        for name in dir_names + sorted(file_names):
+            path = os.path.join(dir_path, name)
+            st = os.lstat(path)
+            link = os.readlink(path) if stat.S_ISLNK(st.st_mode) else None
+            group = inodes.setdefault((st.st_dev, st.st_ino), os.path.relpath(path, root)) if st.st_nlink > 1 else None
+            entries[os.path.relpath(path, root)] = (st.st_mode, st.st_uid, st.st_gid,
+                                                    st.st_size if not stat.S_ISDIR(st.st_mode) else 0,
+                                                    int(st.st_mtime), link, group)
+    return entries
+
+
+def benchmark(file_count, jobs):
+    work_dir = tempfile.mkdtemp(prefix="parallel_extract_bench_")
+    try:
+        archive_path = os.path.join(work_dir, "synthetic.tar")
+        print("Creating synthetic archive with %d files ..." % file_count)
+        create_synthetic_archive(archive_path, file_count)
+
+        tar_dir = os.path.join(work_dir, "tar")
+        os.mkdir(tar_dir)
+        start = time.monotonic()
+        ret = subprocess.call(["tar", "xpf", archive_path, "--directory", tar_dir])
+        tar_time = time.monotonic() - start
+        print("tar xpf:                 %7.2f s (ret %d)" % (tar_time, ret))
+
+        parallel_dir = os.path.join(work_dir, "parallel")
+        os.mkdir(parallel_dir)
+        start = time.monotonic()
+        ret = ParallelExtractor(parallel_dir, jobs).extract(archive_path)
+        parallel_time = time.monotonic() - start
+        print("parallel_extract -j %-3d: %7.2f s (ret %d, %.2fx)" % (jobs, parallel_time, ret, tar_time / parallel_time))
+
+        tar_tree = snapshot(tar_dir)
+        parallel_tree = snapshot(parallel_dir)
+        differences = [name for name in set(tar_tree) | set(parallel_tree) if tar_tree.get(name) != parallel_tree.get(name)]
+        for name in sorted(differences)[:20]:
+            print("differs: %s tar=%s parallel=%s" % (name, tar_tree.get(name), parallel_tree.get(name)))
+        print("Extracted trees are %s." % ("identical" if len(differences) == 0 else "different"))
+        return 0 if ret == 0 and len(differences) == 0 else 1
+    finally:
+        subprocess.call(["rm", "-rf", work_dir])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract tar archive with a pool of writer threads.")
+    parser.add_argument("archive", nargs="?", help="Archive to extract, - for uncompressed tar on stdin")
+    parser.add_argument("-C", "--directory", help="Destination directory")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS, help="Number of writer threads. Default: %d" % DEFAULT_JOBS)
+    parser.add_argument("--exclude-from", help="File with member names (one per line) excluded with their subtrees")
+    parser.add_argument("--stream-size", type=int, help="Uncompressed size of the archive, progress is reported when set")
+    parser.add_argument("--benchmark", type=int, metavar="FILES", help="Compare with tar on synthetic archive with FILES files")
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        return benchmark(args.benchmark, args.jobs)
+
+    if args.archive is None or args.directory is None:
+        parser.print_usage()
+        return 2
+
+    excluded = load_exclude_file(args.exclude_from) if args.exclude_from is not None else None
+    extractor = ParallelExtractor(args.directory, args.jobs, excluded, args.stream_size)
+    return extractor.extract(args.archive)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#!/bin/bash
+# Do the device setup that does not need to run on the device itself,
+# so the first boot keeps only per-device work (SSH host keys).
+# stop when any error occures
+set -o pipefail
+set -e
+
+# Check if a path was provided as an argument
+if [ -z "$1" ]; then
+  echo "provision_rootfs.sh Usage: $0 /path/to/rootfs [user]"
+  exit 1
+fi
+
+ROOTFS="$1"
+USER_NAME="${2:-dcs_user}"
+USER_GROUPS="i2c gpio dialout spi"
+QEMU=/usr/bin/qemu-aarch64-static
+
+if [ ! -d "$ROOTFS" ]; then
+  echo "Error: rootfs path '$ROOTFS' does not exist."
+  exit 1
+fi
+
+# Run aarch64 binaries of the rootfs through qemu-user-static
+qemu_installed=false
+if [ ! -f "${ROOTFS}${QEMU}" ]; then
+  cp "$QEMU" "${ROOTFS}${QEMU}"
+  qemu_installed=true
+fi
+
+cleanup() {
+  if $qemu_installed; then
+    rm -f "${ROOTFS}${QEMU}"
+  fi
+}
+trap cleanup EXIT
+
+# Run command in the rootfs. When dcs_deploy runs a chroot session, the command
+# is queued (DCS_CHROOT_QUEUE) and run in the session after provisioning.
+run_in_rootfs() {
+  if [ -n "$DCS_CHROOT_QUEUE" ]; then
+    printf '%q ' "$@" >> "$DCS_CHROOT_QUEUE"
+    echo >> "$DCS_CHROOT_QUEUE"
+  else
+    chroot "$ROOTFS" "$@"
+  fi
+}
+
+# Group membership
+if grep -q "^${USER_NAME}:" "$ROOTFS/etc/passwd"; then
+  for group in $USER_GROUPS; do
+    if ! grep -q "^${group}:" "$ROOTFS/etc/group"; then
+      echo "Creating group $group"
+      run_in_rootfs groupadd --system "$group"
+    fi
+  done
+  echo "Adding $USER_NAME to groups: $USER_GROUPS"
+  run_in_rootfs usermod -a -G "${USER_GROUPS// /,}" "$USER_NAME"
+else
+  echo "User $USER_NAME does not exist in rootfs. Skipping group membership."
+fi
+
+# Enable hardware services collected by the hardware support layer
+services_script="$ROOTFS/usr/local/bin/handle_hardware_services.sh"
+if [ -f "$services_script" ]; then
+  for service in $(sed -n 's/^sudo systemctl enable \(.*\)$/\1/p' "$services_script"); do
+    echo "Enabling $service"
+    systemctl --root="$ROOTFS" enable "$service"
+  done
+fi
+
+# Kernel module dependencies
+for modules_dir in "$ROOTFS"/lib/modules/*/; do
+  if [ -d "$modules_dir" ]; then
+    kernel_version=$(basename "$modules_dir")
+    echo "Generating module dependencies for $kernel_version"
+    depmod -b "$ROOTFS" "$kernel_version"
+  fi
+done
+
+# Ownership of the Airvolute folder, ids are taken from the rootfs
+airvolute_dir="$ROOTFS/home/$USER_NAME/Airvolute"
+if [ -d "$airvolute_dir" ]; then
+  user_ids=$(awk -F: -v user="$USER_NAME" '$1 == user { print $3 ":" $4 }' "$ROOTFS/etc/passwd")
+  if [ -n "$user_ids" ]; then
+    echo "Setting owner of $airvolute_dir to $user_ids"
+    chown -R "$user_ids" "$airvolute_dir"
+  fi
+fi
+
+echo "Rootfs provisioning completed"
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Tests of USB helpers in airvolute_usb.py of the hardware support layer. The sysfs USB tree is
+replaced by a temporary directory.
+
+    python3 -m pytest tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+RESOURCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "local", "overlays",
+                              "hardware_support_layer", "resources")
+sys.path.insert(0, os.path.join(RESOURCES_PATH, "libs", "airvolute_gpio"))
+sys.path.insert(0, os.path.join(RESOURCES_PATH, "libs", "airvolute_usb"))
+import airvolute_usb
+
+
+class SplitPortTest(unittest.TestCase):
+    def test_root_hub_port(self):
+        self.assertEqual(airvolute_usb.split_port("1-2"), ("1-0:1.0", "usb1-port2"))
+
+    def test_hub_port(self):
+        self.assertEqual(airvolute_usb.split_port("1-2.3"), ("1-2:1.0", "1-2-port3"))
+        self.assertEqual(airvolute_usb.split_port("2-1.4.2"), ("2-1.4:1.0", "2-1.4-port2"))
+
+    def test_invalid_port(self):
+        for port in ["usb1", "1-2:1.0", "1-", "x-2", "1-2.a"]:
+            with self.assertRaises(airvolute_usb.UsbError, msg=port):
+                airvolute_usb.split_port(port)
+
+
+class WaitForDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.sysfs_path = tempfile.mkdtemp(prefix="airvolute_usb_")
+        self.addCleanup(shutil.rmtree, self.sysfs_path)
+        self.original_path = airvolute_usb.USB_SYSFS_PATH
+        airvolute_usb.USB_SYSFS_PATH = self.sysfs_path
+        self.addCleanup(setattr, airvolute_usb, "USB_SYSFS_PATH", self.original_path)
+        os.makedirs(os.path.join(self.sysfs_path, "devices", "usb1"))
+
+    def add_device(self, name, vendor, devnum, bound=True):
+        device_path = os.path.join(self.sysfs_path, "devices", name)
+        os.makedirs(device_path, exist_ok=True)
+        for attribute, value in [("idVendor", vendor), ("devnum", devnum)]:
+            with open(os.path.join(device_path, attribute), "w") as f:
+                f.write("%s\n" % value)
+        os.makedirs(os.path.join(self.sysfs_path, "devices", name + ":1.0"), exist_ok=True)
+        if bound:
+            self.bind_driver(name)
+
+    def bind_driver(self, name):
+        os.makedirs(os.path.join(self.sysfs_path, "devices", name + ":1.0", "driver"), exist_ok=True)
+
+    def test_list_devices(self):
+        self.add_device("1-2", "0424", 2)
+        self.add_device("1-2.3", "2dae", 5)
+        self.assertEqual(airvolute_usb.list_devices(), {"1-2": "2", "1-2.3": "5"})
+        self.assertEqual(airvolute_usb.list_devices(["2dae"]), {"1-2.3": "5"})
+        self.assertEqual(airvolute_usb.find_port(["2dae", "26ac"]), "1-2.3")
+
+    def test_unchanged_device_is_not_new(self):
+        self.add_device("1-2.3", "2dae", 5)
+        previous = airvolute_usb.list_devices()
+        self.assertIsNone(airvolute_usb.wait_for_device(["2dae"], previous, timeout=0.05))
+
+        self.add_device("1-2.3", "26ac", 6)
+        self.assertEqual(airvolute_usb.wait_for_device(None, previous, port="1-2.3", timeout=0.05), "1-2.3")
+
+    def test_device_on_other_port_is_ignored(self):
+        previous = airvolute_usb.list_devices()
+        self.add_device("1-2.4", "2dae", 7)
+        self.assertIsNone(airvolute_usb.wait_for_device(None, previous, port="1-2.3", timeout=0.05))
+        self.assertEqual(airvolute_usb.wait_for_device(["2dae"], previous, timeout=0.05), "1-2.4")
+
+    def test_waits_for_driver(self):
+        previous = airvolute_usb.list_devices()
+        self.add_device("1-2.3", "2dae", 8, bound=False)
+        self.assertIsNone(airvolute_usb.wait_for_device(["2dae"], previous, timeout=0.05))
+
+        timer = threading.Timer(0.05, self.bind_driver, ["1-2.3"])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(airvolute_usb.wait_for_device(["2dae"], previous, timeout=5), "1-2.3")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Tests of the serve mode job queue. Jobs run FakeRunner instead of dcs_deploy: the job process
+reports its start, leaves a background child (like sudo tar or flash.sh started by a real job)
+and runs until the test releases it, so the order of jobs does not depend on timing.
+
+    python3 -m pytest tests
+"""
+
+import os
+import select
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dcs_deploy
+
+# seconds to wait for a state which is expected to come, tests do not wait otherwise
+TIMEOUT = 10
+
+
+class FakeRunner:
+    """
+    Job process of the tests, job arguments are <name> [fail] [ignore_term]. The job reports
+    pid of its child through started pipe and waits for a byte in released pipe. Pipes are
+    inherited by forked jobs and, unlike multiprocessing events, do not hang when a job is killed.
+    """
+    def __init__(self, names):
+        self.started = {name: os.pipe() for name in names}
+        self.released = {name: os.pipe() for name in names}
+        self.child_pids = {}
+
+    def close(self):
+        for started, released in zip(self.started.values(), self.released.values()):
+            os.write(released[1], b"x")
+            for fd in started + released:
+                os.close(fd)
+
+    def __call__(self, job_argv, command, config_db, log_path, work_dir):
+        # as run_deploy_job, the process group of the job is its own session
+        os.setsid()
+        name = job_argv[1]
+        options = job_argv[2:]
+        if "ignore_term" in options:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        child_pid = os.fork()
+        if child_pid == 0:
+            while True:
+                signal.pause()
+        os.write(self.started[name][1], b"%d\n" % child_pid)
+
+        select.select([self.released[name][0]], [], [], TIMEOUT * 6)
+        os.kill(child_pid, signal.SIGKILL)
+        os.waitpid(child_pid, 0)
+        os._exit(1 if "fail" in options else 0)
+
+
+class FastScheduler(dcs_deploy.DeployScheduler):
+    # terminated processes left behind by jobs are reaped by init, give it some time
+    CANCEL_TIMEOUT = 5
+    POLL_INTERVAL = 0.01
+
+
+class DeploySchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="dcs_deploy_scheduler_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_scheduler(self, names, **limits):
+        self.runner = FakeRunner(names)
+        # jobs do not outlive a failed test
+        self.addCleanup(self.runner.close)
+        return FastScheduler({}, os.path.join(self.tmp_dir, "jobs"), job_runner=self.runner, **limits)
+
+    @staticmethod
+    def submit(scheduler, name, config_key, device = None, command = "flash", options = ()):
+        return scheduler.submit(command, [name] + list(options), config_key, device)
+
+    def is_started(self, name, timeout = 0):
+        return select.select([self.runner.started[name][0]], [], [], timeout)[0] != []
+
+    def wait_started(self, *names):
+        for name in names:
+            self.assertTrue(self.is_started(name, TIMEOUT), "job %s did not start" % name)
+            self.runner.child_pids[name] = int(os.read(self.runner.started[name][0], 32))
+
+    def release(self, *names):
+        for name in names:
+            os.write(self.runner.released[name][1], b"x")
+
+    def wait_state(self, scheduler, job, state):
+        end = time.monotonic() + TIMEOUT
+        with scheduler.lock:
+            while job.state != state:
+                self.assertLess(time.monotonic(), end, "job %s is not %s" % (job.id, state))
+                scheduler.lock.wait(timeout=0.01)
+
+    def wait_done(self, scheduler):
+        end = time.monotonic() + TIMEOUT
+        with scheduler.lock:
+            while not all(job.is_done() for job in scheduler.jobs.values()):
+                self.assertLess(time.monotonic(), end, "jobs did not finish")
+                scheduler.lock.wait(timeout=0.01)
+
+    def assert_queued(self, job, name):
+        self.assertEqual(job.state, dcs_deploy.DeployJob.QUEUED)
+        self.assertFalse(self.is_started(name))
+
+    @staticmethod
+    def is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        # reaped by init only after it exits, zombie does not count
+        with open("/proc/%d/stat" % pid) as stat_file:
+            return stat_file.read().rsplit(")", 1)[1].split()[0] != "Z"
+
+    def test_per_config_limit(self):
+        scheduler = self.create_scheduler(["a1", "a2", "b1"], max_jobs=4, per_config=1, per_device=4)
+        first = self.submit(scheduler, "a1", "config_a", device="1-1")
+        second = self.submit(scheduler, "a2", "config_a", device="1-2")
+        other = self.submit(scheduler, "b1", "config_b", device="1-3")
+        self.wait_started("a1", "b1")
+        self.assert_queued(second, "a2")
+
+        self.release("a1")
+        self.wait_started("a2")
+        self.release("a2", "b1")
+        self.wait_done(scheduler)
+        for job in [first, second, other]:
+            self.assertEqual(job.state, dcs_deploy.DeployJob.SUCCEEDED)
+
+    def test_per_device_limit(self):
+        scheduler = self.create_scheduler(["d1", "d2", "p1"], max_jobs=4, per_config=4, per_device=1)
+        first = self.submit(scheduler, "d1", "config_a", device="1-1")
+        second = self.submit(scheduler, "d2", "config_b", device="1-1")
+        # prepare does not occupy the device
+        prepare = self.submit(scheduler, "p1", "config_c", device="1-1", command="prepare")
+        self.wait_started("d1", "p1")
+        self.assert_queued(second, "d2")
+
+        self.release("d1")
+        self.wait_started("d2")
+        self.release("d2", "p1")
+        self.wait_done(scheduler)
+        for job in [first, second, prepare]:
+            self.assertEqual(job.state, dcs_deploy.DeployJob.SUCCEEDED)
+
+    def test_max_jobs(self):
+        scheduler = self.create_scheduler(["m1", "m2"], max_jobs=1, per_config=4, per_device=4)
+        self.submit(scheduler, "m1", "config_a")
+        second = self.submit(scheduler, "m2", "config_b")
+        self.wait_started("m1")
+        self.assert_queued(second, "m2")
+
+        self.release("m1")
+        self.wait_started("m2")
+        self.release("m2")
+        self.wait_done(scheduler)
+
+    def test_failed_job(self):
+        scheduler = self.create_scheduler(["f1"])
+        job = self.submit(scheduler, "f1", "config_a", options=["fail"])
+        self.release("f1")
+        self.wait_done(scheduler)
+
+        self.assertEqual(job.state, dcs_deploy.DeployJob.FAILED)
+        self.assertEqual(job.exit_code, 1)
+
+    def test_cancel_queued(self):
+        scheduler = self.create_scheduler(["q1", "q2"], max_jobs=1)
+        running = self.submit(scheduler, "q1", "config_a")
+        queued = self.submit(scheduler, "q2", "config_b")
+        self.wait_started("q1")
+        scheduler.cancel(queued.id)
+        self.assertEqual(queued.state, dcs_deploy.DeployJob.CANCELLED)
+
+        self.release("q1")
+        self.wait_done(scheduler)
+        self.assertEqual(running.state, dcs_deploy.DeployJob.SUCCEEDED)
+        self.assertFalse(self.is_started("q2"))
+
+    def test_cancel_terminates_process_group(self):
+        scheduler = self.create_scheduler(["c1", "c2"], per_config=1)
+        job = self.submit(scheduler, "c1", "config_a")
+        waiting = self.submit(scheduler, "c2", "config_a")
+        self.wait_started("c1")
+        child_pid = self.runner.child_pids["c1"]
+
+        scheduler.cancel(job.id)
+        self.wait_state(scheduler, job, dcs_deploy.DeployJob.CANCELLED)
+        # job is marked cancelled only after commands it started are gone
+        self.assertFalse(self.is_running(child_pid))
+        self.assertFalse(job.killed)
+
+        self.wait_started("c2")
+        self.release("c2")
+        self.wait_done(scheduler)
+        self.assertEqual(waiting.state, dcs_deploy.DeployJob.SUCCEEDED)
+
+    def test_cancel_kills_after_timeout(self):
+        scheduler = self.create_scheduler(["k1"])
+        scheduler.CANCEL_TIMEOUT = 0.2
+        job = self.submit(scheduler, "k1", "config_a", options=["ignore_term"])
+        self.wait_started("k1")
+        child_pid = self.runner.child_pids["k1"]
+
+        start = time.monotonic()
+        scheduler.cancel(job.id)
+        self.wait_state(scheduler, job, dcs_deploy.DeployJob.CANCELLED)
+        self.assertTrue(job.killed)
+        self.assertGreaterEqual(time.monotonic() - start, scheduler.CANCEL_TIMEOUT)
+        self.assertFalse(self.is_running(child_pid))
+
+
+if __name__ == "__main__":
+    unittest.main()
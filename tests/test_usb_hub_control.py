@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Tests of USB2534 configuration in usb_hub_control.py of the hardware support layer. The hub is
+replaced by a fake SMBus implementing config register access of Microchip's AN26.18.
+
+    python3 -m pytest tests
+"""
+
+import os
+import sys
+import unittest
+
+RESOURCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "local", "overlays",
+                              "hardware_support_layer", "resources")
+sys.path.insert(0, os.path.join(RESOURCES_PATH, "libs", "airvolute_gpio"))
+sys.path.insert(0, os.path.join(RESOURCES_PATH, "services", "usb_hub_control"))
+try:
+    import usb_hub_control
+except ImportError as e:
+    # smbus2 is installed on the device
+    raise unittest.SkipTest("usb_hub_control needs %s" % e.name)
+
+CFG_WRITE = [0x00, 0x00, 0x05, 0x00, 0x02]
+CFG_READ = [0x00, 0x00, 0x04, 0x01, 0x01]
+CFG_EXECUTE = [0x99, 0x37, 0x00]
+CFG_READ_POINTER = [0x00, 0x04]
+
+
+class FakeUsb2534Bus:
+    """
+    SMBus of the hub. Config register command is staged by the first write, executed by CFG_EXECUTE
+    and the result of read is returned by the read after CFG_READ_POINTER.
+    """
+    def __init__(self, registers, read_only = (), not_ready_polls = 0):
+        self.registers = dict(registers)
+        self.read_only = set(read_only)
+        self.not_ready_polls = not_ready_polls
+        self.transfers = []
+        self.command = None
+        self.result = None
+
+    def i2c_rdwr(self, *msgs):
+        if len(msgs) > usb_hub_control.I2C_RDWR_MAX_MSGS:
+            raise OSError("I2C_RDWR with %d messages" % len(msgs))
+        self.transfers.append(len(msgs))
+        for msg in msgs:
+            if msg.addr != usb_hub_control.dev_addr:
+                raise OSError("no device at 0x%02x" % msg.addr)
+            if msg.flags & 1:
+                self.read(msg)
+            else:
+                self.write(list(msg))
+
+    def read(self, msg):
+        if self.not_ready_polls > 0:
+            self.not_ready_polls -= 1
+            raise OSError("hub is not ready")
+        data = self.result if self.result is not None else [0] * msg.len
+        for i, value in enumerate(data[:msg.len]):
+            msg.buf[i] = bytes([value])
+
+    def write(self, data):
+        if data[:5] in (CFG_WRITE, CFG_READ):
+            self.command = data
+        elif data == CFG_EXECUTE:
+            register = (self.command[5] << 8) | self.command[6]
+            if self.command[:5] == CFG_WRITE:
+                if register not in self.read_only:
+                    self.registers[register] = self.command[7]
+            else:
+                self.result = [1, self.registers.get(register, 0)]
+        elif data != CFG_READ_POINTER:
+            raise OSError("unexpected write %s" % data)
+
+    def close(self):
+        pass
+
+
+class Usb2534Test(unittest.TestCase):
+    def create_hub(self, registers = None, **kwargs):
+        self.bus = FakeUsb2534Bus(registers or {}, **kwargs)
+        return usb_hub_control.Usb2534(self.bus)
+
+    def test_write_is_split_at_max_messages(self):
+        hub = self.create_hub()
+        registers = {0x3000 + i: i for i in range(30)}
+        hub.write_cfg_registers(registers)
+
+        # 2 messages per register write
+        self.assertEqual(self.bus.transfers, [42, 18])
+        self.assertEqual(self.bus.registers, registers)
+
+    def test_read_groups_are_not_split(self):
+        registers = {0x3000 + i: i for i in range(12)}
+        hub = self.create_hub(registers)
+        values = hub.read_cfg_registers(list(registers))
+
+        # 4 messages per register read, 10 reads fit into one transfer
+        self.assertEqual(self.bus.transfers, [40, 8])
+        self.assertEqual(values, registers)
+
+    def test_apply_cfg_writes_only_changed_registers(self):
+        defaults = {address: value for address, value, _ in usb_hub_control.HUB_CFG_REGISTERS}
+        defaults[0x3007] = 0x20
+        defaults[0x3009] = 0x06
+        hub = self.create_hub(defaults)
+
+        changed = hub.apply_cfg(usb_hub_control.HUB_CFG_REGISTERS)
+        self.assertEqual(changed, {0x3007: (0x20, 0x28), 0x3009: (0x06, 0x10)})
+        # read all, write changed, read back changed
+        self.assertEqual(self.bus.transfers, [24, 4, 8])
+
+        self.bus.transfers = []
+        self.assertEqual(hub.apply_cfg(usb_hub_control.HUB_CFG_REGISTERS), {})
+        self.assertEqual(self.bus.transfers, [24])
+
+    def test_apply_cfg_readback_mismatch(self):
+        hub = self.create_hub({0x3006: 0x00}, read_only=[0x3006])
+        with self.assertRaisesRegex(OSError, "0x3006 readback 0x00, expected 0x9B"):
+            hub.apply_cfg([(0x3006, 0x9B, "HUB_CFG1")])
+
+    def test_wait_ready_polls_until_hub_answers(self):
+        hub = self.create_hub(not_ready_polls=3)
+        self.assertTrue(hub.wait_ready(timeout=1, interval=0))
+        self.assertEqual(len(self.bus.transfers), 4)
+
+        hub = self.create_hub(not_ready_polls=1000)
+        self.assertFalse(hub.wait_ready(timeout=0.05, interval=0.01))
+
+
+if __name__ == "__main__":
+    unittest.main()